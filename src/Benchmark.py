@@ -0,0 +1,309 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from Block import Block
+from BlockChain import BlockChain
+from BlockData import BlockData
+from FileEntry import FileEntry
+from Miner import Miner
+from Owner import Owner
+
+# 各规模的默认配置，--scale 选择
+SCALES = {
+    'small': {'mine_blocks': 16, 'difficulty': 4, 'upload_files': 30, 'file_size': 64 << 10, 'duplicate_ratio': 0.25,
+              'chain_blocks': 500, 'files_per_block': 50, 'crypt_files': 4, 'crypt_size': 8 << 20, 'repeat': 5},
+    'medium': {'mine_blocks': 32, 'difficulty': 5, 'upload_files': 100, 'file_size': 256 << 10,
+               'duplicate_ratio': 0.25, 'chain_blocks': 2000, 'files_per_block': 100, 'crypt_files': 8,
+               'crypt_size': 32 << 20, 'repeat': 5},
+}
+# 与基线比较时，吞吐量低于基线的该比例即视为性能退化
+DEFAULT_TOLERANCE = 0.2
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    '''
+    最近秩百分位数
+    :param sorted_values: 已排序的数值
+    :param p: 0 到 1 之间
+    '''
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def summarize(latencies: list, work: float, unit: str) -> dict:
+    '''
+    :param latencies: 每次操作的耗时（秒）
+    :param work: 所有操作完成的工作量，单位为 unit
+    :return: 延迟百分位数与吞吐量
+    '''
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        'Runs': len(values),
+        'Mean': total / len(values) if values else 0.0,
+        'Min': values[0] if values else 0.0,
+        'P50': percentile(values, 0.5),
+        'P90': percentile(values, 0.9),
+        'P99': percentile(values, 0.99),
+        'Max': values[-1] if values else 0.0,
+        'Throughput': work / total if total else 0.0,
+        'Unit': unit,
+    }
+
+
+class Benchmark:
+    def __init__(self, config: dict, seed: int = 0):
+        '''
+        可复现的基准测试：由固定的随机种子生成合成的区块链与文件语料
+        :param config: 规模配置，见 SCALES
+        :param seed: 随机种子
+        '''
+        self.config = config
+        self.seed = seed
+        self.workdir = None
+
+    def _random(self, name: str) -> random.Random:
+        # 每项测试使用独立的随机序列，增减测试项不影响其他测试的数据
+        return random.Random('{0}-{1}'.format(self.seed, name))
+
+    def make_corpus(self, name: str, count: int, size: int, duplicate_ratio: float = 0.0) -> list:
+        '''
+        生成文件语料，其中 duplicate_ratio 比例的文件与之前的某个文件内容相同（用于去重）
+        :return: 文件路径列表
+        '''
+        rng = self._random(name)
+        corpus_dir = os.path.join(self.workdir, name)
+        os.makedirs(corpus_dir, exist_ok=True)
+        contents = []
+        paths = []
+        for i in range(count):
+            if contents and rng.random() < duplicate_ratio:
+                content = rng.choice(contents)
+            else:
+                content = rng.randbytes(size)
+                contents.append(content)
+            path = os.path.join(corpus_dir, 'file%d' % i)
+            with open(path, 'wb') as f:
+                f.write(content)
+            paths.append(path)
+        return paths
+
+    def make_chain(self, name: str, block_count: int, files_per_block: int) -> BlockChain:
+        '''
+        生成合成的区块链，时间戳与记录都由随机种子决定，难度为 0 不需要挖矿
+        '''
+        rng = self._random(name)
+        owners = [Owner.intern('bench-owner-%d' % i) for i in range(100)]
+        chain = BlockChain()
+        # 合成的记录没有签名
+        chain.require_signatures = False
+        for b in range(block_count):
+            data = BlockData()
+            data.files = [FileEntry(rng.choice(owners), '%064x' % rng.getrandbits(256))
+                          for _ in range(files_per_block)]
+            chain.chain.append(Block(1.7e9 + b, data, chain.chain[-1].hash))
+        return chain
+
+    def bench_mine(self) -> dict:
+        '''
+        Block.mine_block：每个区块的挖矿延迟与算力
+        '''
+        miner = Miner.default()
+        latencies = []
+        attempts = 0
+        for i in range(self.config['mine_blocks']):
+            block = Block(1.7e9 + i, BlockData(), '%064x' % i)
+            time_start = time.perf_counter()
+            block.mine_block(self.config['difficulty'])
+            latencies.append(time.perf_counter() - time_start)
+            attempts += miner.last_result.attempts
+        result = summarize(latencies, self.config['mine_blocks'], 'blocks/s')
+        result['Hashrate'] = attempts / sum(latencies)
+        return result
+
+    def bench_upload(self) -> dict:
+        '''
+        BlockChain.upload_files：每次上传一个文件（哈希、加密、去重存储与出块）
+        '''
+        paths = self.make_corpus('upload', self.config['upload_files'], self.config['file_size'],
+                                 self.config['duplicate_ratio'])
+        chain = BlockChain()
+        # 合成的记录没有签名
+        chain.require_signatures = False
+        chain.upload_dir = os.path.join(self.workdir, 'upload_data') + '/'
+        os.makedirs(chain.upload_dir)
+        latencies = []
+        for path in paths:
+            time_start = time.perf_counter()
+            chain.upload_files([path], 'bench-owner')
+            latencies.append(time.perf_counter() - time_start)
+        stored = len(os.listdir(chain.upload_dir))
+        result = summarize(latencies, len(paths) * self.config['file_size'] / 2**20, 'MB/s')
+        result['Stored Files'] = stored
+        return result
+
+    def bench_verify(self) -> dict:
+        '''
+        verify_blockchain：从创世区块完整检验合成的区块链
+        '''
+        chain = self.make_chain('verify', self.config['chain_blocks'], self.config['files_per_block'])
+        latencies = []
+        for _ in range(self.config['repeat']):
+            BlockChain.signature_verifier.clear()
+            time_start = time.perf_counter()
+            assert chain.verify_blockchain(full=True)
+            latencies.append(time.perf_counter() - time_start)
+        return summarize(latencies, len(chain.chain) * len(latencies), 'blocks/s')
+
+    def bench_persistence(self) -> dict:
+        '''
+        save_to_file / load_from_file：合成区块链的 json 保存与加载
+        '''
+        chain = self.make_chain('persistence', self.config['chain_blocks'], self.config['files_per_block'])
+        path = os.path.join(self.workdir, 'block_chain.json')
+        save_latencies = []
+        load_latencies = []
+        for _ in range(self.config['repeat']):
+            time_start = time.perf_counter()
+            chain.save_to_file(path)
+            save_latencies.append(time.perf_counter() - time_start)
+            time_start = time.perf_counter()
+            loaded = BlockChain.load_from_file(path)
+            load_latencies.append(time.perf_counter() - time_start)
+            assert loaded.get_latest_block().hash == chain.get_latest_block().hash
+        size = os.path.getsize(path) / 2**20
+        return {
+            'save': summarize(save_latencies, size * len(save_latencies), 'MB/s'),
+            'load': summarize(load_latencies, size * len(load_latencies), 'MB/s'),
+        }
+
+    def bench_crypt(self) -> dict:
+        '''
+        BlockData.encrypt_file / decrypt_file：流式加解密大文件
+        '''
+        paths = self.make_corpus('crypt', self.config['crypt_files'], self.config['crypt_size'])
+        encrypt_latencies = []
+        decrypt_latencies = []
+        for path in paths:
+            password = BlockData.calculate_file_hash(path)
+            time_start = time.perf_counter()
+            enc_hash = BlockData.encrypt_file(path, password)
+            encrypt_latencies.append(time.perf_counter() - time_start)
+            time_start = time.perf_counter()
+            BlockData.decrypt_file(path + '.enc', password, path + '.dec', expected_hash=enc_hash)
+            decrypt_latencies.append(time.perf_counter() - time_start)
+        size = self.config['crypt_size'] / 2**20
+        return {
+            'encrypt': summarize(encrypt_latencies, size * len(paths), 'MB/s'),
+            'decrypt': summarize(decrypt_latencies, size * len(paths), 'MB/s'),
+        }
+
+    def run(self, cases: list = None) -> dict:
+        '''
+        运行基准测试
+        :param cases: 要运行的测试名，默认为全部
+        :return: 可序列化为 json 的结果
+        '''
+        benches = {
+            'mine': self.bench_mine,
+            'upload': self.bench_upload,
+            'verify': self.bench_verify,
+            'persistence': self.bench_persistence,
+            'crypt': self.bench_crypt,
+        }
+        cases = cases or list(benches)
+        # 关闭密钥缓存，每次加解密都实际执行密钥派生
+        max_entries = BlockData.key_cache.max_entries
+        BlockData.key_cache.max_entries = 0
+        BlockData.key_cache.clear()
+        results = {}
+        self.workdir = tempfile.mkdtemp()
+        try:
+            for case in cases:
+                if case not in benches:
+                    raise Exception('未知的测试 {0}'.format(case))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = benches[case]()
+                # 有多个子项的测试展开为 测试名.子项
+                if 'Runs' in result:
+                    results[case] = result
+                else:
+                    for name, sub_result in result.items():
+                        results['{0}.{1}'.format(case, name)] = sub_result
+        finally:
+            BlockData.key_cache.max_entries = max_entries
+            shutil.rmtree(self.workdir)
+            self.workdir = None
+        return {
+            'Meta': {
+                'Time': time.time(),
+                'Python': platform.python_version(),
+                'Platform': platform.platform(),
+                'CPU Count': os.cpu_count(),
+                'Seed': self.seed,
+                'Config': self.config,
+            },
+            'Results': results,
+        }
+
+
+def compare(current: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    '''
+    与基线比较各测试的吞吐量。吞吐量由全部操作的总耗时得出，比单次延迟稳定
+    :return: [{'Case', 'Unit', 'Baseline', 'Current', 'Ratio', 'Regression'}, ...]
+    '''
+    rows = []
+    for case, result in current['Results'].items():
+        base = baseline['Results'].get(case)
+        if base is None or not base['Throughput']:
+            continue
+        ratio = result['Throughput'] / base['Throughput']
+        rows.append({'Case': case, 'Unit': result['Unit'], 'Baseline': base['Throughput'],
+                     'Current': result['Throughput'], 'Ratio': ratio, 'Regression': ratio < 1 - tolerance})
+    return rows
+
+
+if __name__ == '__main__':
+    '''
+    运行基准测试，结果以 json 输出，可与保存的基线比较
+        python Benchmark.py [--scale small|medium] [--cases mine upload ...] [--output 结果.json]
+                            [--baseline 基线.json] [--tolerance 0.2]
+    与基线比较发现性能退化时退出码为 1
+    '''
+    parser = argparse.ArgumentParser(description='区块链基准测试')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--cases', nargs='*', help='要运行的测试，默认为全部')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='结果 json 文件，默认输出到标准输出')
+    parser.add_argument('--baseline', help='作为基线的结果 json 文件')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    result = Benchmark(SCALES[args.scale], args.seed).run(args.cases)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    else:
+        print(json.dumps(result, indent=4))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['Meta'].get('Config') != result['Meta']['Config']:
+            print('警告：基线的测试配置与本次不同', file=sys.stderr)
+        rows = compare(result, baseline, args.tolerance)
+        for row in rows:
+            print('{0:<20} 基线 {1:.1f} {2}  本次 {3:.1f} {2}  {4:+.1%}{5}'.format(
+                row['Case'], row['Baseline'], row['Unit'], row['Current'], row['Ratio'] - 1,
+                '  性能退化' if row['Regression'] else ''), file=sys.stderr)
+        if any(row['Regression'] for row in rows):
+            sys.exit(1)
@@ -1,17 +1,30 @@
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-import json
+import hashlib
 import json
+import struct
 import time
 from BlockData import BlockData
+from Metrics import metrics
+from Miner import Miner, NONCE_FORMAT
 
 class Block:
-    def __init__(self, timestamp:float, data:BlockData, previous_hash=''):
+    __slots__ = ('timestamp', 'data', 'previous_hash', 'nonce', 'hash', 'target')
+
+    # 区块头的二进制格式：版本号、上一区块哈希、时间戳、区块数据哈希，nonce 追加在末尾
+    # 版本 2 在末尾增加 256 位目标值；没有目标值的旧区块仍使用版本 1
+    HEADER_VERSION = 2
+    HEADER_FORMATS = {
+        1: struct.Struct('>I32sd32s'),
+        2: struct.Struct('>I32sd32s32s'),
+    }
+    VERSION_FORMAT = struct.Struct('>I')
+
+    def __init__(self, timestamp:float, data:BlockData, previous_hash='', target:int=None):
         """
         区块的初始化
         :param timestamp: 创建时的时间戳
         :param data: 区块数据
         :param previous_hash: 上一个区块的hash
+        :param target: 256 位目标值，区块哈希必须小于该值，为 None 时为旧格式区块
         :param hash: 区块的hash
         """
 
@@ -20,58 +33,151 @@ class Block:
         self.timestamp = timestamp
         self.data = data
         self.previous_hash = previous_hash
+        self.target = target
         self.nonce = 0
         self.hash = self.calculate_hash()
 
-    def calculate_hash(self) -> str:
+    @classmethod
+    def from_fields(cls, timestamp:float, data:BlockData, previous_hash:str, nonce:int, hash:str, target:int=None):
+        '''
+        由已知字段直接构造区块，不重新计算哈希（用于从存储中加载）
+        '''
+        block = cls.__new__(cls)
+        block.timestamp = timestamp
+        block.data = data
+        block.previous_hash = previous_hash
+        block.nonce = nonce
+        block.hash = hash
+        block.target = target
+        return block
+
+    @staticmethod
+    def header_format(version:int) -> struct.Struct:
+        if version not in Block.HEADER_FORMATS:
+            raise Exception('不支持的区块头版本 {0}'.format(version))
+        return Block.HEADER_FORMATS[version]
+
+    @staticmethod
+    def pack_header(previous_hash:str, timestamp:float, merkle_root:bytes, target:int=None) -> bytes:
+        '''
+        打包区块头前缀，有目标值时使用新版本格式
+        '''
+        previous_hash = bytes.fromhex(previous_hash) if previous_hash else bytes(32)
+        if target is None:
+            return Block.HEADER_FORMATS[1].pack(1, previous_hash, timestamp, merkle_root)
+        return Block.HEADER_FORMATS[2].pack(2, previous_hash, timestamp, merkle_root, target.to_bytes(32, 'big'))
+
+    def header_prefix(self, refresh:bool=False) -> bytes:
+        '''
+        区块头中除 nonce 以外的固定部分，挖矿时只需计算一次
+        :param refresh: 是否重新计算区块数据的默克尔根，而不使用缓存
+        :return: 二进制区块头前缀
+        '''
+        return Block.pack_header(self.previous_hash, self.timestamp, self.data.calculate_hash(refresh), self.target)
+
+    def header(self) -> bytes:
+        '''
+        完整的二进制区块头，区块哈希即其 SHA-256
         '''
-        计算该区块的哈希值
+        return self.header_prefix() + NONCE_FORMAT.pack(self.nonce)
+
+    @staticmethod
+    def merkle_root_of(header:bytes) -> bytes:
+        '''
+        从二进制区块头中取出默克尔根
+        '''
+        header_format = Block.header_format(Block.VERSION_FORMAT.unpack_from(header)[0])
+        return header_format.unpack_from(header)[3]
+
+    def calculate_hash(self, refresh:bool=False) -> str:
+        '''
+        计算该区块的哈希值，哈希覆盖包含 nonce 的完整区块头
+        :param refresh: 是否重新计算区块数据的默克尔根，检验区块时使用
         :return : 哈希值，字符串表示
         '''
+        return hashlib.sha256(self.header_prefix(refresh) + NONCE_FORMAT.pack(self.nonce)).hexdigest()
+
+    def legacy_hash(self) -> str:
+        '''
+        旧版本（使用二进制区块头之前）的区块哈希：上一区块哈希、时间戳与区块数据 json 拼接后的 SHA-256，不包含 nonce。
+        只用于识别与迁移旧格式的区块链
+        '''
         block_str = self.previous_hash + str(self.timestamp) + json.dumps(self.data.to_dict(), ensure_ascii=False)
-        
-        # Create a SHA-256 hash object
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        
-        # Update the hash object with the block string encoded as UTF-8
-        digest.update(block_str.encode('utf-8'))
-        
-        # Finalize the hash and return the hexadecimal representation
-        block_hash = digest.finalize().hex()  # Convert to hexadecimal string
-        return block_hash
+        return hashlib.sha256(block_str.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_legacy_chain(blocks:list) -> bool:
+        '''
+        判断区块列表是否为旧格式：创世区块没有目标值，且记录的哈希与旧算法的结果一致
+        '''
+        if not blocks:
+            return False
+        genesis = blocks[0]
+        return type(genesis) is Block and genesis.target is None and genesis.hash == genesis.legacy_hash()
+
+    @staticmethod
+    def migrate_legacy_chain(blocks:list, diffculty:int = 0) -> int:
+        '''
+        将旧格式的区块列表迁移为二进制区块头格式。先按旧算法检验每个区块的哈希与链接，
+        全部正确后从创世区块开始重新计算哈希并重新链接，迁移后所有区块的哈希都会改变
+        :param diffculty: 区块链的挖矿难度，大于 0 时重新挖矿
+        :return: 迁移的区块数
+        '''
+        for height, block in enumerate(blocks):
+            previous_hash = blocks[height - 1].hash if height > 0 else ''
+            if block.previous_hash != previous_hash or block.hash != block.legacy_hash():
+                raise Exception('旧格式区块链在高度 {0} 处的哈希或链接不正确，无法迁移'.format(height))
+        previous_hash = ''
+        for block in blocks:
+            block.previous_hash = previous_hash
+            block.target = None
+            block.nonce = 0
+            if diffculty > 0:
+                block.mine_block(diffculty)
+            else:
+                block.hash = block.calculate_hash(refresh=True)
+            previous_hash = block.hash
+        return len(blocks)
 
-    def mine_block(self, diffculty:int):
+    def mine_block(self, diffculty:int = 0, miner:Miner=None, verbose:bool = False):
         '''
-        :param diffculty: 整型，代表挖矿难度
+        :param diffculty: 整型，代表挖矿难度，区块带有目标值时忽略
+        :param miner: 使用的矿工，默认使用共享的多进程矿工
+        :param verbose: 是否打印挖到的区块。耗时与算力已记入 mine.* 统计
         '''
-        time_start = time.time()
+        if miner is None:
+            miner = Miner.default()
 
         # 计算哈希
-        while self.hash[0:diffculty] != ''.join(['0']*diffculty):
-            self.nonce = self.nonce + 1
-            self.hash = self.calculate_hash()
+        target = self.target if self.target is not None else Miner.difficulty_to_target(diffculty)
+        with metrics.span('mine'):
+            result = miner.mine(self.header_prefix(), target)
+        self.nonce = result.nonce
+        self.hash = result.hash
+        metrics.inc('mine.blocks')
+        metrics.inc('mine.attempts', result.attempts)
+        metrics.observe('mine.hashrate', result.hashrate)
 
-        print("挖到区块:\n \t{0}\n耗时为:\n \t{1}".format(self.hash, time.time()-time_start))
+        if verbose:
+            print("挖到区块:\n \t{0}\n耗时为:\n \t{1}\n算力为:\n \t{2:.0f} H/s".format(self.hash, result.elapsed, result.hashrate))
 
     def to_dict(self):
         '''
         转化为字典
         '''
-        return {
+        data = {
             'Time Stamp': self.timestamp,
             'Block Data': self.data.to_dict(),
             'Previous Hash': self.previous_hash,
             'Block Hash': self.hash,
             'Nonce':self.nonce,
         }
+        if self.target is not None:
+            data['Target'] = '%064x' % self.target
+        return data
     
     @classmethod
     def from_dict(cls, data):
-        block = cls(time.time(), BlockData())
-        block.timestamp = data['Time Stamp']
-        block.data = BlockData.from_dict(data['Block Data'])
-        block.previous_hash = data['Previous Hash']
-        block.hash = data['Block Hash']
-        block.nonce = data['Nonce']
-
-        return block
\ No newline at end of file
+        target = int(data['Target'], 16) if 'Target' in data else None
+        return cls.from_fields(data['Time Stamp'], BlockData.from_dict(data['Block Data']),
+                               data['Previous Hash'], data['Nonce'], data['Block Hash'], target)
\ No newline at end of file
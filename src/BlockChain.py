@@ -4,7 +4,11 @@ import time
 import json
 import os
 import pickle
-from cryptography.hazmat.primitives.asymmetric import rsa
+import shutil
+from functools import partial
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
@@ -12,18 +16,168 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from Block import Block
 from BlockData import BlockData
+from BlockStore import BlockStore
+from FileIndex import FileIndex
+from ChainLock import ChainLock
+from LazyChain import LazyChain
+from Metrics import metrics
+from PrunedBlock import PrunedBlock
+from FileEntry import FileEntry
+from Owner import Owner
+from Miner import Miner, MAX_HASH
+from SignatureVerifier import SignatureVerifier
+
+def _first_bad_hash(start_height:int, block_dicts:list):
+    '''
+    在工作进程中重新计算一段区块的哈希
+    :return: 第一个哈希不匹配的区块高度，全部匹配时返回 None
+    '''
+    for offset, block_data in enumerate(block_dicts):
+        block = PrunedBlock.block_from_dict(block_data)
+        if block.hash != block.calculate_hash():
+            return start_height + offset
+    return None
+
+
+class VerifyResult:
+    def __init__(self, valid:bool, bad_height:int = None, verified_height:int = -1, checked:int = 0):
+        '''
+        区块链检验结果，可直接作为布尔值使用
+        :param valid: 是否通过检验
+        :param bad_height: 第一个不合法的区块高度
+        :param verified_height: 检验通过的最高区块高度
+        :param checked: 本次实际检验的区块数
+        '''
+        self.valid = valid
+        self.bad_height = bad_height
+        self.verified_height = verified_height
+        self.checked = checked
+
+    def __bool__(self) -> bool:
+        return self.valid
+
+    def __repr__(self) -> str:
+        return 'VerifyResult(valid={0}, bad_height={1}, verified_height={2}, checked={3})'.format(
+            self.valid, self.bad_height, self.verified_height, self.checked)
+
 
 class BlockChain:
-    def __init__(self):
+    # 去重后的密文存放目录
+    upload_dir = '../workspace/upload_data/'
+    # 文件记录签名的检验器，缓存已检验通过的记录
+    signature_verifier = SignatureVerifier()
+
+    def __init__(self, chain:list = None, id:str = None):
+        '''
+        :param chain: 已有的区块列表（或 LazyChain），为 None 时创造创世区块
+        :param id: 已有区块链的 ID，为 None 时随机生成
+        '''
         # 创造创世区块
-        self.chain = [self._create_genesis_block()]
+        self.chain = chain if chain is not None else [self._create_genesis_block()]
         # 设置挖矿难度
         self.difficulty = 0
+        # 期望出块间隔（秒）。设置后每 retarget_interval 个区块按实际出块时间调整目标值，否则目标值由 difficulty 决定
+        self.target_block_time = None
+        self.retarget_interval = 16
+        # 是否拒绝没有签名的文件记录。新区块链都要求签名；读取没有该设置的旧区块链时为 False，此时只检验有签名的记录
+        self.require_signatures = True
+        # 设置文件加密使用的密钥派生配置
+        self.kdf = BlockData.DEFAULT_KDF
         # 设置当前Block Chain的ID
-        current_time = time.time()
-        random.seed(current_time)
-        random_number = random.randint(0,2147483647)
-        self.id = hashlib.sha256(str(random_number).encode()).hexdigest()
+        if id is None:
+            current_time = time.time()
+            random.seed(current_time)
+            random_number = random.randint(0,2147483647)
+            id = hashlib.sha256(str(random_number).encode()).hexdigest()
+        self.id = id
+        # 密文哈希索引，首次使用时建立
+        self._index = None
+        # 从快照启动时使用的快照。裁剪过的区块没有数据，索引需要重建时从快照的索引开始
+        self.base_snapshot = None
+        # 只追加的区块存储，未设置时使用 json 文件保存
+        self.store = None
+        # 分块存储，设置后上传的文件按内容分块去重存储
+        self.chunk_store = None
+        # 已检验通过的最高区块高度及其哈希，之后只需检验新区块
+        self.verified_height = -1
+        self.verified_tip = ''
+        # 上次读取或保存的 json 文件的 (修改时间, 大小)，用于判断文件是否被其他用户修改
+        self._file_signature = None
+        # 读取时是否从旧格式迁移，迁移结果尚未写回文件
+        self._migrated = False
+        # commit_block 因最新区块被其他用户改变而重新挖矿的次数
+        self.commit_retries = 0
+        # 已统计存储大小的索引、文件个数与字节数，新文件到来时只统计新增部分
+        self._stored_stats = (None, 0, 0)
+
+    @property
+    def index(self) -> FileIndex:
+        '''
+        密文哈希 -> (区块高度, 所有者) 的索引
+        '''
+        index = self._index
+        if index is None or index.height >= len(self.chain) \
+                or (index.height >= 0 and self.chain[index.height].hash != index.tip_hash):
+            index = self._index = self._base_index()
+        # 只为尚未索引的新区块补充索引
+        for height in range(index.height + 1, len(self.chain)):
+            index.add_block(height, self.chain[height])
+        return index
+
+    def _base_index(self) -> FileIndex:
+        '''
+        重建索引的起点：链中有被裁剪的区块时只能从与之一致的快照索引开始
+        '''
+        snapshot = self.base_snapshot
+        if snapshot is not None and snapshot.height < len(self.chain) \
+                and self.chain[snapshot.height].hash == snapshot.tip_hash:
+            return snapshot.index()
+        # 被裁剪的区块总在链的开头
+        if self.chain and isinstance(self.chain[0], PrunedBlock):
+            raise Exception('区块链中有被裁剪的区块且没有一致的快照（例如重新读取后发生了分叉），'
+                            '无法重建索引，需要从新的快照启动')
+        return FileIndex()
+
+    def stats(self) -> dict:
+        '''
+        区块链的汇总统计，均由索引中随区块增量维护的数据得出，不遍历区块
+        :return: {'Height', 'Tip Hash', 'Entries': 文件记录数, 'Files': 不同文件数, 'Owners': 所有者数,
+                  'Dedup Ratio': 记录数与不同文件数之比, 'Stored Bytes': 共享存储空间中的密文字节数}
+        '''
+        index = self.index
+        if self.chunk_store is not None:
+            stored_bytes = self.chunk_store.stats()['Stored Bytes']
+        else:
+            stats_index, counted, stored_bytes = self._stored_stats
+            if stats_index is not index:
+                # 索引被重建（例如分叉切换）后重新统计
+                counted = stored_bytes = 0
+            # 索引中的文件按首次记录的顺序排列，只需统计新增的文件
+            for file_enc_hash in islice(index.files, counted, None):
+                stored_path = self.stored_file_path(file_enc_hash)
+                if os.path.isfile(stored_path):
+                    stored_bytes += os.path.getsize(stored_path)
+            self._stored_stats = (index, len(index.files), stored_bytes)
+        return {
+            'Height': len(self.chain) - 1,
+            'Tip Hash': self.get_latest_block().hash,
+            'Entries': index.entry_count,
+            'Files': len(index.files),
+            'Owners': len(index.owners),
+            'Dedup Ratio': index.entry_count / len(index.files) if index.files else 1.0,
+            'Stored Bytes': stored_bytes,
+        }
+
+    def add_block(self, block: Block):
+        '''
+        将区块链接到链的最后，并更新索引。区块中有签名不合法（或区块链要求签名而没有签名）的记录时拒绝
+        '''
+        bad = self.first_bad_entry(block.data.files)
+        if bad is not None:
+            raise Exception('区块中的文件记录 {0} 签名不合法或没有签名'.format(block.data.files[bad].file))
+        index = self.index
+        self.chain.append(block)
+        index.add_block(len(self.chain) - 1, block)
 
     @staticmethod
     def _create_genesis_block() -> Block:
@@ -35,6 +189,40 @@ class BlockChain:
         block = Block(timestamp, BlockData(), '')
         return block
 
+    def target_at(self, height:int, chain = None) -> int:
+        '''
+        高度为 height 的区块应当使用的目标值，只由之前区块的目标值与时间戳决定
+        :param chain: 计算所依据的区块序列，默认为本链
+        :return: 256 位目标值，创世区块为 None
+        '''
+        if height == 0:
+            return None
+        base = min(Miner.difficulty_to_target(self.difficulty), MAX_HASH)
+        if self.target_block_time is None:
+            return base
+        chain = self.chain if chain is None else chain
+        previous = chain[height - 1].target
+        if previous is not None:
+            base = previous
+        interval = self.retarget_interval
+        if height % interval != 0 or height <= interval:
+            return base
+        # 每 interval 个区块根据这段时间的实际出块时间调整一次
+        actual = chain[height - 1].timestamp - chain[height - 1 - interval].timestamp
+        return Miner.retarget(base, actual, interval * self.target_block_time)
+
+    def next_target(self) -> int:
+        '''
+        下一个区块的目标值
+        '''
+        return self.target_at(len(self.chain))
+
+    def new_block(self, blockdata:BlockData) -> Block:
+        '''
+        在最新区块之后创建一个尚未挖矿的区块
+        '''
+        return Block(time.time(), blockdata, self.get_latest_block().hash, self.next_target())
+
     def get_latest_block(self) -> Block:
         '''
         获取最新的区块
@@ -42,85 +230,590 @@ class BlockChain:
         '''
         return self.chain[-1]
 
-    def verify_blockchain(self) -> bool:
+    def verify_blockchain(self, full:bool = False, workers:int = None, parallel_threshold:int = 512) -> VerifyResult:
         '''
-        检验区块链数据是否完整
+        检验区块链数据是否完整。每个区块只计算一次哈希，之后顺序检查区块之间的链接
+        :param full: 是否从创世区块开始完整检验（用于审计），否则只检验上次检验之后的新区块
+        :param workers: 并行计算哈希与检验签名的进程数，默认为 CPU 核数
+        :param parallel_threshold: 待检验区块数达到该值时才使用进程池
         :return: 检验结果
         '''
-        for i in range(1,len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
-            # 当前区块的哈希不应被改变
-            if current_block.hash != current_block.calculate_hash():
-                return False
-            # 当前区块记录的前一个区块的哈希，与前一个区块的哈希值匹配
-            if current_block.previous_hash != previous_block.calculate_hash():
+        start = 0
+        if not full and 0 <= self.verified_height < len(self.chain) \
+                and self.chain[self.verified_height].hash == self.verified_tip:
+            start = self.verified_height + 1
+        if start >= len(self.chain):
+            return VerifyResult(True, None, self.verified_height, 0)
+
+        # 当前区块的哈希不应被改变
+        with metrics.span('verify'):
+            bad_height = self._first_bad_hash(start, workers, parallel_threshold)
+
+        # 当前区块记录的前一个区块的哈希，与前一个区块的哈希值匹配；目标值符合调整规则，哈希满足目标值
+        end = len(self.chain) if bad_height is None else bad_height
+        if start == 0 and self.chain[0].previous_hash != '':
+            bad_height = 0
+        else:
+            for i in range(max(start, 1), end):
+                if self.chain[i].previous_hash != self.chain[i-1].hash or not self._valid_target(i):
+                    bad_height = i
+                    break
+
+        # 文件记录的签名。签名检验最耗时，放在最后，只检验哈希与链接都正确的区块
+        end = len(self.chain) if bad_height is None else bad_height
+        with metrics.span('verify_signatures'):
+            bad_offset = self.first_bad_signature(self.chain[start:end], workers)
+        if bad_offset is not None:
+            bad_height = start + bad_offset
+
+        checked = len(self.chain) - start
+        metrics.inc('verify.blocks', checked)
+        if bad_height is None:
+            self.verified_height = len(self.chain) - 1
+        else:
+            self.verified_height = bad_height - 1
+        self.verified_tip = self.chain[self.verified_height].hash if self.verified_height >= 0 else ''
+        return VerifyResult(bad_height is None, bad_height, self.verified_height, checked)
+
+    def _valid_target(self, height:int, chain = None) -> bool:
+        '''
+        检查区块的目标值与工作量。未启用目标值调整时允许没有目标值的旧区块
+        '''
+        chain = self.chain if chain is None else chain
+        block = chain[height]
+        if block.target is None:
+            if self.target_block_time is not None:
                 return False
-            
-        return True
-    
-    def upload_files(self, file_path_list:dict[str], author_hash_str: str):
+            target = min(Miner.difficulty_to_target(self.difficulty), MAX_HASH)
+        elif block.target != self.target_at(height, chain):
+            return False
+        else:
+            target = block.target
+        return int(block.hash, 16) < target
+
+    def first_bad_entry(self, entries:list, workers:int = None):
+        '''
+        检验文件记录的签名。区块链要求签名时没有签名的记录也不合法
+        :return: 第一个不合法记录的下标，全部合法时返回 None
+        '''
+        return BlockChain.signature_verifier.first_invalid(entries, self.require_signatures, workers)
+
+    def first_bad_signature(self, blocks:list, workers:int = None):
+        '''
+        检验一组区块中所有文件记录的签名，所有区块的记录合并后并行检验
+        :return: 第一个含有不合法记录的区块在 blocks 中的下标，全部合法时返回 None
+        '''
+        entries = []
+        offsets = []
+        for offset, block in enumerate(blocks):
+            if isinstance(block, PrunedBlock):
+                # 被裁剪的区块只能检验区块头，其记录在建立快照之前已检验
+                continue
+            entries.extend(block.data.files)
+            offsets.extend([offset] * len(block.data.files))
+        bad = self.first_bad_entry(entries, workers)
+        return offsets[bad] if bad is not None else None
+
+    def _first_bad_hash(self, start:int, workers:int, parallel_threshold:int):
+        '''
+        重新计算从 start 开始的区块哈希，区块之间互不依赖，可以并行
+        :return: 第一个哈希不匹配的区块高度，全部匹配时返回 None
+        '''
+        workers = workers or os.cpu_count() or 1
+        count = len(self.chain) - start
+        if workers == 1 or count < parallel_threshold:
+            for height in range(start, len(self.chain)):
+                block = self.chain[height]
+                if block.hash != block.calculate_hash(refresh=True):
+                    return height
+            return None
+
+        chunk = -(-count // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for chunk_start in range(start, len(self.chain), chunk):
+                blocks = self.chain[chunk_start:chunk_start + chunk]
+                futures.append(executor.submit(_first_bad_hash, chunk_start,
+                                               [block.to_dict() for block in blocks]))
+            # 各分片按高度顺序提交，第一个不为 None 的结果即为最低的错误高度
+            for future in futures:
+                bad_height = future.result()
+                if bad_height is not None:
+                    for other in futures:
+                        other.cancel()
+                    return bad_height
+        return None
+
+    def get_inclusion_proof(self, file_enc_hash:str, owner:str):
+        '''
+        生成“owner 拥有该文件”的紧凑证明：区块头加默克尔路径
+        :return: 证明，链上没有该记录时返回 None
+        '''
+        record = self.index.get(file_enc_hash)
+        if record is None or owner not in record['Owners']:
+            return None
+        height = record['Owners'][owner]
+        block = self.chain[height]
+        if isinstance(block, PrunedBlock):
+            # 区块数据已被裁剪，无法生成证明
+            return None
+        proof = block.data.get_inclusion_proof(file_enc_hash, owner)
+        proof['Height'] = height
+        proof['Header'] = block.header().hex()
+        return proof
+
+    def verify_inclusion_proof(self, proof:dict) -> bool:
+        '''
+        检验包含证明：区块头必须与本地链上对应高度的区块一致，且记录可由默克尔路径推出区块头中的默克尔根
+        '''
+        header = bytes.fromhex(proof['Header'])
+        height = proof['Height']
+        if not 0 <= height < len(self.chain) or hashlib.sha256(header).hexdigest() != self.chain[height].hash:
+            return False
+        return BlockData.verify_inclusion_proof(proof, Block.merkle_root_of(header))
+
+    def upload_files(self, file_path_list:dict[str], author_hash_str: str, signer = None):
         '''
         用户调用以上传自己的文件
         :param file_path_list:要上传的文件列表
         :param author_hash_str:上传者的哈希值，标记身份
+        :param signer:上传者的签名函数（如 KeyStore.sign），设置时对每条记录签名
+        '''
+        with metrics.span('upload'):
+            self._seal_block(self.prepare_upload(file_path_list, author_hash_str, signer=signer))
+
+    def prepare_upload(self, file_path_list:dict[str], author_hash_str: str, file_keys:dict = None,
+                       signer = None) -> BlockData:
+        '''
+        加密并存储文件，返回待打包的区块数据
+        :param file_keys: 设置时记录 密文哈希 -> 文件密码（明文哈希），下载时需要
+        :param signer: 上传者的签名函数，设置时对每条记录签名
         '''
+        if self.require_signatures and signer is None:
+            # 在存储密文之前检查，避免出块被拒绝后留下无引用的密文
+            raise Exception('区块链要求文件记录有签名，上传时需要指定 signer')
         blockdata = BlockData()
+        # 本批次中已上传的密文，避免同一批次内重复上传
+        batch_hashes = set()
         for file_path in file_path_list:
-            # 检测是否已存在(去重操作)
-            flag = False
-            file_enc_hash = blockdata.add_file(file_path, author_hash_str)
-            for block in self.chain:
-                for file in block.data.files:
-                    if file['File'] == file_enc_hash:
-                        flag = True
-            # 若不重复将加密后的文件上传
-            if flag == False:
-                # BlockData.encrypt_file(file_path, 
-                #                    BlockData.calculate_file_hash(file_path))
-                file_name = file_path.split('/')[-1]
-                os.system('mv '+ file_path + '.enc' + ' '+'../workspace/upload_data/' + file_name +'.enc')
-
-        block = Block(time.time(),blockdata, self.get_latest_block().hash)
-        block.mine_block(self.difficulty)
+            file_enc_hash = blockdata.add_file(file_path, author_hash_str, self.chunk_store, self.kdf, file_keys,
+                                               signer)
+            if self.chunk_store is None:
+                self._store_if_new(file_path, file_enc_hash, batch_hashes)
+        metrics.inc('upload.files', len(blockdata.files))
+        return blockdata
+
+    def commit_block(self, blockdata:BlockData, block_chain_file_path:str, max_retries:int = 1000) -> Block:
+        '''
+        多个用户共享区块链文件时安全地提交区块：挖矿在锁外进行，
+        加锁后只读取其他用户的新区块并检查最新区块是否改变，未改变时追加并保存，否则在新的最新区块上重新挖矿
+        :param block_chain_file_path: 共享的 json 文件或区块存储目录
+        :param max_retries: 最多重新挖矿的次数
+        :return: 提交的区块
+        '''
+        lock = ChainLock.for_chain_file(block_chain_file_path)
+        self._refresh(block_chain_file_path)
+        for _ in range(max_retries + 1):
+            block = self.new_block(blockdata)
+            block.mine_block()
+            time_wait = time.perf_counter()
+            with lock:
+                metrics.observe('commit.lock_wait', time.perf_counter() - time_wait)
+                # 已持有锁，迁移后的旧格式区块链随新区块一起保存
+                self._refresh(block_chain_file_path, persist_migration=False)
+                if self.get_latest_block().hash == block.previous_hash:
+                    self.add_block(block)
+                    if self.store is not None:
+                        self.commit_to_store()
+                    else:
+                        self.save_to_file(block_chain_file_path)
+                    return block
+            # 最新区块已被其他用户改变，基于新的最新区块重新挖矿
+            self.commit_retries += 1
+            metrics.inc('commit.retries')
+        raise Exception('提交区块失败：最新区块持续变化，已重试 {0} 次'.format(max_retries))
+
+    def _refresh(self, block_chain_file_path:str, persist_migration:bool = True):
+        if self.store is not None:
+            self.sync_from_store()
+        else:
+            self.refresh_from_file(block_chain_file_path, persist_migration)
+
+    def upload_files_batch(self, file_path_list:dict[str], author_hash_str: str, workers:int = None,
+                           file_keys:dict = None, signer = None, profile_path:str = None) -> dict:
+        '''
+        批量上传文件：哈希、密钥派生与加密在进程池中并行执行，所有文件记录在同一个区块中
+        :param file_path_list:要上传的文件列表，区块中的记录顺序与之相同
+        :param author_hash_str:上传者的哈希值，标记身份
+        :param workers:工作进程数，默认为 CPU 核数
+        :param file_keys:设置时记录 密文哈希 -> 文件密码（明文哈希）
+        :param signer:上传者的签名函数，设置时对每条记录签名
+        :param profile_path:设置时对本批次采样分析，折叠调用栈保存到该文件（只采样当前进程）
+        :return: 各阶段耗时（秒）。hash/kdf/encrypt（分块存储时为 chunk）为各文件耗时之和，其余为实际经过的时间
+        '''
+        if profile_path is not None:
+            with metrics.profile(profile_path):
+                return self.upload_files_batch(file_path_list, author_hash_str, workers, file_keys, signer)
+
+        time_start = time.perf_counter()
+        blockdata, timing = self.prepare_upload_batch(file_path_list, author_hash_str, workers, file_keys, signer)
+        time_dedup = time.perf_counter()
+
+        self._seal_block(blockdata)
+        time_mine = time.perf_counter()
+
+        timing['mine'] = time_mine - time_dedup
+        timing['total'] = time_mine - time_start
+        for stage in ('mine', 'total'):
+            metrics.observe('upload_batch.' + stage, timing[stage])
+        return timing
+
+    def prepare_upload_batch(self, file_path_list:dict[str], author_hash_str: str, workers:int = None,
+                             file_keys:dict = None, signer = None) -> tuple:
+        '''
+        批量上传的准备阶段：在进程池中加密，去重存储密文，返回待打包的区块数据，
+        之后由 _seal_block 或多个用户共享区块链文件时由 commit_block 出块
+        :return: (区块数据, 各阶段耗时)，耗时含义见 upload_files_batch
+        '''
+        if self.require_signatures and signer is None:
+            # 在存储密文之前检查，避免出块被拒绝后留下无引用的密文
+            raise Exception('区块链要求文件记录有签名，上传时需要指定 signer')
+        time_start = time.perf_counter()
+        workers = workers or os.cpu_count() or 1
+        # 同一路径只处理一次，避免多个进程同时写同一个 .enc 文件
+        unique_paths = list(dict.fromkeys(file_path_list))
+        if self.chunk_store is None:
+            ingest = partial(BlockData.ingest_file, kdf=self.kdf)
+        else:
+            ingest = self.chunk_store.ingest_file
+        if workers == 1 or len(unique_paths) == 1:
+            results = [ingest(file_path) for file_path in unique_paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(unique_paths) // (workers * 4))
+                results = list(executor.map(ingest, unique_paths, chunksize=chunksize))
+        results = dict(zip(unique_paths, results))
+        time_ingest = time.perf_counter()
+
+        timing = {'files': len(file_path_list)}
+        for result in results.values():
+            for stage, cost in result['Timing'].items():
+                timing[stage] = timing.get(stage, 0.0) + cost
+                # 工作进程中的阶段无法记录为嵌套阶段，按文件记入直方图
+                metrics.observe('upload_batch.' + stage, cost)
+
+        # 按输入顺序写入区块数据，并去重上传密文
+        blockdata = BlockData()
+        batch_hashes = set()
+        owner = Owner.intern(author_hash_str)
+        for file_path in file_path_list:
+            file_enc_hash = results[file_path]['File']
+            if file_keys is not None:
+                file_keys[file_enc_hash] = results[file_path]['Key']
+            entry = FileEntry(owner, file_enc_hash)
+            if signer is not None:
+                entry.sign(signer)
+            blockdata.files.append(entry)
+            if self.chunk_store is None:
+                self._store_if_new(file_path, file_enc_hash, batch_hashes)
+        time_dedup = time.perf_counter()
+
+        timing['ingest'] = time_ingest - time_start
+        timing['dedup'] = time_dedup - time_ingest
+        for stage in ('ingest', 'dedup'):
+            metrics.observe('upload_batch.' + stage, timing[stage])
+        metrics.inc('upload.files', len(file_path_list))
+        return blockdata, timing
+
+    def _store_if_new(self, file_path:str, file_enc_hash:str, batch_hashes:set):
+        '''
+        若密文不在链上且本批次中未上传过，将其移动到共享存储空间
+        '''
+        # 检测是否已存在(去重操作)
+        with metrics.span('dedup'):
+            flag = self.index.contains(file_enc_hash) or file_enc_hash in batch_hashes
+        # 若不重复将加密后的文件上传
+        if flag == False:
+            metrics.inc('dedup.misses')
+            # 以密文哈希命名，不同文件即使同名也不会互相覆盖
+            target_path = self.stored_file_path(file_enc_hash)
+            with metrics.span('store'):
+                try:
+                    os.replace(file_path + '.enc', target_path)
+                except OSError:
+                    # 跨文件系统时无法直接重命名
+                    shutil.move(file_path + '.enc', target_path)
+            batch_hashes.add(file_enc_hash)
+        else:
+            metrics.inc('dedup.hits')
+
+    def stored_file_path(self, file_enc_hash:str) -> str:
+        '''
+        整文件存储时，密文在共享存储空间中的路径
+        '''
+        return os.path.join(self.upload_dir, file_enc_hash + '.enc')
+
+    def retrieve_file(self, file_enc_hash:str, owner:str, password:str, output, chunk_size:int = None) -> int:
+        '''
+        取回链上记录的文件：检查所有权，按密文哈希找到存储的密文，流式解密并在读取时检验密文哈希
+        :param file_enc_hash: 密文哈希（分块存储时为文件清单哈希）
+        :param owner: 请求者的公钥，必须是链上记录的所有者之一
+        :param password: 文件密码，即明文哈希
+        :param output: 结果文件路径，或可写的二进制流
+        :param chunk_size: 每次处理的字节数，决定内存占用
+        :return: 写出的明文字节数
+        '''
+        if not self.index.is_owner(file_enc_hash, owner):
+            raise Exception('链上没有该用户拥有文件 {0} 的记录'.format(file_enc_hash))
+
+        if isinstance(output, str):
+            # 先写入临时文件，检验通过后才替换为结果文件
+            tmp_path = '{0}.{1}.tmp'.format(output, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as fout:
+                    written = self.retrieve_file(file_enc_hash, owner, password, fout, chunk_size)
+                os.replace(tmp_path, output)
+                return written
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        return self.read_stored_file(file_enc_hash, password, output, chunk_size)
+
+    def read_stored_file(self, file_enc_hash:str, password:str, output, chunk_size:int = None) -> int:
+        '''
+        不检查所有权，按密文哈希从存储空间流式解密，读取时检验密文哈希
+        :param output: 可写的二进制流
+        :return: 写出的明文字节数
+        '''
+        stored_path = self.stored_file_path(file_enc_hash)
+        if os.path.isfile(stored_path):
+            with metrics.span('retrieve'), open(stored_path, 'rb') as fin:
+                return BlockData.decrypt_stream(fin, password, output, file_enc_hash, chunk_size)
+        if self.chunk_store is not None and os.path.isfile(self.chunk_store.manifest_path(file_enc_hash)):
+            # 分块存储逐块读取并检验
+            return self.chunk_store.read_file(file_enc_hash, password, output)
+        raise Exception('存储空间中找不到密文 {0}'.format(file_enc_hash))
+
+    def _seal_block(self, blockdata:BlockData) -> Block:
+        '''
+        将区块数据打包为区块，挖矿后链接到链的最后
+        '''
+        block = self.new_block(blockdata)
+        block.mine_block()
         # 将当前块链接到链的最后
-        self.chain.append(block)
-            
+        self.add_block(block)
+        return block
+
+    def prune(self, height:int) -> int:
+        '''
+        丢弃 height 及之前区块的数据，只保留区块头用于链接。索引先补齐，之后不再需要这些区块的数据。
+        只支持 json 保存的区块链，区块存储的数据保留在磁盘上，按需读取
+        :return: 新裁剪的区块数
+        '''
+        if self.store is not None:
+            raise Exception('区块存储不支持裁剪')
+        if not 0 <= height < len(self.chain):
+            raise Exception('区块高度 {0} 超出范围'.format(height))
+        self.index
+        pruned = 0
+        for i in range(height + 1):
+            if not isinstance(self.chain[i], PrunedBlock):
+                self.chain[i] = PrunedBlock.prune(self.chain[i])
+                pruned += 1
+        return pruned
 
     def to_dict(self):
         return {
             'ID': self.id,
             'Chain': [block.to_dict() for block in self.chain],
             'Difficulty': self.difficulty,
+            'Target Block Time': self.target_block_time,
+            'Retarget Interval': self.retarget_interval,
+            'Require Signatures': self.require_signatures,
+            'KDF': self.kdf,
+        }
+
+    def settings(self) -> dict:
+        '''
+        区块链的共识与加密设置，与 to_dict 及区块存储元信息中的字段相同
+        '''
+        return {
+            'Difficulty': self.difficulty,
+            'Target Block Time': self.target_block_time,
+            'Retarget Interval': self.retarget_interval,
+            'Require Signatures': self.require_signatures,
+            'KDF': self.kdf,
         }
 
+    def apply_settings(self, settings:dict):
+        '''
+        读取 settings 中记录的设置，缺少的字段使用旧版本的默认值
+        '''
+        self.difficulty = settings.get('Difficulty', self.difficulty)
+        self.target_block_time = settings.get('Target Block Time')
+        self.retarget_interval = settings.get('Retarget Interval', self.retarget_interval)
+        self.require_signatures = settings.get('Require Signatures', False)
+        self.kdf = settings.get('KDF', BlockData.DEFAULT_KDF)
+
     @classmethod
-    def from_dict(cls, data):
-        blockchain = cls()
-        blockchain.chain = [Block.from_dict(block_data) for block_data in data['Chain']]
-        blockchain.difficulty = data['Difficulty']
-        blockchain.id = data['ID']
+    def from_dict(cls, data, chain:list = None):
+        '''
+        :param chain: 已构造的区块列表（例如从快照启动时），为 None 时由 data 构造
+        '''
+        if chain is None:
+            chain = [PrunedBlock.block_from_dict(block_data) for block_data in data['Chain']]
+        blockchain = cls(chain, data['ID'])
+        blockchain.apply_settings(data)
+        # 旧格式的区块链使用 json 哈希，检验后迁移为二进制区块头，下次保存时写入新格式
+        if Block.is_legacy_chain(blockchain.chain):
+            Block.migrate_legacy_chain(blockchain.chain, blockchain.difficulty)
+            blockchain._migrated = True
         return blockchain
     
     @staticmethod
-    def load_from_file(file_path:str):
+    def load_from_file(file_path:str, persist_migration:bool = True):
         '''
-        从文件加载一个区块链
+        从文件加载一个区块链。若旁边保存有与之一致的索引文件则直接使用，否则重新建立索引
+        :param persist_migration: 旧格式的文件迁移后是否立即写回。调用者已持有该文件的 ChainLock 时须为 False，
+                                  由调用者之后保存
         '''
         # with open(file_path,'r',encoding='utf-8') as f:
         #     x = pickle.load(f)
         #     return x
 
         # 另一种实现
-        with open(file_path,'r',encoding='utf-8') as f:
+        with metrics.span('load'), open(file_path,'r',encoding='utf-8') as f:
             data = json.load(f)
             blockchain = BlockChain.from_dict(data)
+            blockchain._file_signature = BlockChain._signature(f)
+            if persist_migration:
+                blockchain._persist_migration(file_path)
+            index = FileIndex.load_from_file(FileIndex.index_path(file_path))
+            if index is not None and index.matches(blockchain.chain):
+                blockchain._index = index
             return blockchain
         return None
 
-    def save_to_file(self, file_path:str)->bool:
+    @staticmethod
+    def _signature(f) -> tuple:
+        stat = os.fstat(f.fileno())
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _persist_migration(self, file_path:str):
+        '''
+        从旧格式迁移后立即写回文件，之后其他用户读取时不需要再次迁移（难度大于 0 时需要重新挖矿整条链）。
+        文件在读取之后已被其他用户修改时不写入
+        '''
+        if not self._migrated:
+            return
+        with ChainLock.for_chain_file(file_path):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                if BlockChain._signature(f) != self._file_signature:
+                    return
+            self.save_to_file(file_path)
+        self._migrated = False
+
+    def refresh_from_file(self, file_path:str, persist_migration:bool = True) -> bool:
+        '''
+        若 json 文件在上次读取或保存之后被其他用户修改，重新读取区块链
+        :param persist_migration: 同 load_from_file
+        :return: 是否重新读取
+        '''
+        with open(file_path, 'r', encoding='utf-8') as f:
+            signature = BlockChain._signature(f)
+            if signature == self._file_signature:
+                return False
+            other = BlockChain.from_dict(json.load(f))
+        # 索引在访问时按最新区块补齐或重建
+        self.chain = other.chain
+        self.difficulty = other.difficulty
+        self.target_block_time = other.target_block_time
+        self.retarget_interval = other.retarget_interval
+        self.require_signatures = other.require_signatures
+        self.kdf = other.kdf
+        # 文件中的区块（包括哈希未变的旧区块）都是重新读取的，不能沿用之前的检验结果
+        self.verified_height = -1
+        self.verified_tip = ''
+        self._file_signature = signature
+        self._migrated = other._migrated
+        if persist_migration:
+            self._persist_migration(file_path)
+        return True
+
+    @staticmethod
+    def load_from_store(store_dir:str, lazy:bool = False):
+        '''
+        从区块存储加载一个区块链
+        :param store_dir: 存储目录
+        :param lazy: 是否懒加载。懒加载时只按需解析区块头，区块数据在访问时才解码
+        '''
+        store = BlockStore(store_dir)
+        if len(store) == 0:
+            store.close()
+            raise Exception('区块存储 {0} 为空'.format(store_dir))
+        meta = store.read_meta()
+        chain = LazyChain(store) if lazy else list(store.iter_blocks())
+        blockchain = BlockChain(chain, meta.get('ID'))
+        blockchain.apply_settings(meta)
+        blockchain.store = store
+        return blockchain
+
+    def attach_store(self, store_dir:str):
+        '''
+        为当前区块链设置一个新的区块存储，并写入已有的区块
+        :param store_dir: 存储目录，必须为空
+        '''
+        store = BlockStore(store_dir)
+        if len(store) != 0:
+            store.close()
+            raise Exception('区块存储 {0} 非空'.format(store_dir))
+        self.store = store
+        self.store.write_meta({'ID': self.id, 'Difficulty': self.difficulty, 'KDF': self.kdf,
+                               'Target Block Time': self.target_block_time,
+                               'Retarget Interval': self.retarget_interval,
+                               'Require Signatures': self.require_signatures})
+        self.commit_to_store()
+
+    def commit_to_store(self) -> int:
+        '''
+        将存储中尚未记录的新区块追加到区块存储
+        :return: 追加的区块数
+        '''
+        start = len(self.store)
+        with metrics.span('save'):
+            for block in self.chain[start:]:
+                self.store.append_block(block)
+        metrics.inc('save.blocks', len(self.chain) - start)
+        return len(self.chain) - start
+
+    def sync_from_store(self) -> int:
+        '''
+        读取其他用户追加到区块存储中的新区块，只读取新增部分
+        :return: 新增的区块数
+        '''
+        if isinstance(self.chain, LazyChain):
+            # 懒加载的链直接读取存储，索引在访问时补齐
+            start = len(self.chain)
+            self.store.refresh()
+            return len(self.chain) - start
+        self.store.refresh()
+        start = len(self.chain)
+        if len(self.store) < start or self.store.read_block(start - 1).hash != self.get_latest_block().hash:
+            # 本地链与存储不一致，重新读取整条链
+            self.chain = list(self.store.iter_blocks())
+            self._index = None
+            self.verified_height = -1
+            self.verified_tip = ''
+            return len(self.chain)
+        for block in self.store.iter_blocks(start):
+            self.add_block(block)
+        return len(self.chain) - start
+
+    def save_to_file(self, file_path:str, save_index:bool=False)->bool:
         '''
         将当前区块链保存到文件中
+        :param save_index: 是否同时将索引保存在区块链文件旁边
         '''
         # # 写入到指定路径
         # with open(file_path,'w', encoding='utf-8') as f:
@@ -129,16 +822,125 @@ class BlockChain:
         # return False
     
         # 另一种实现
-        with open(file_path,'w',encoding='utf-8') as f:
-            json.dump(self.to_dict(), f, indent=4)
-            return True
-        return False
+        # 先写入临时文件再替换，其他用户读取时不会看到写了一半的文件
+        tmp_path = '{0}.{1}.tmp'.format(file_path, os.getpid())
+        with metrics.span('save'):
+            with metrics.span('serialize'):
+                data = self.to_dict()
+            with metrics.span('write'), open(tmp_path,'w',encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+            with open(file_path, 'r', encoding='utf-8') as f:
+                self._file_signature = BlockChain._signature(f)
+                metrics.observe('save.bytes', self._file_signature[1])
+            if save_index:
+                with metrics.span('index'):
+                    self.index.save_to_file(FileIndex.index_path(file_path))
+        return True
     
 
+def _retrieve_benchmark(large_size:int = 256 << 20, small_count:int = 2000, small_size:int = 4096):
+    '''
+    取回文件的吞吐量：一个大文件与大量小文件
+    '''
+    import io
+    import sys
+    import tempfile
+    import tracemalloc
+
+    workdir = tempfile.mkdtemp()
+    bc = BlockChain()
+    # 合成的记录没有签名
+    bc.require_signatures = False
+    # 使用较快的密钥派生，小文件测试不被 KDF 主导
+    bc.kdf = 'pbkdf2-sha256-fast'
+    bc.upload_dir = os.path.join(workdir, 'upload_data') + '/'
+    os.makedirs(bc.upload_dir)
+    owner = 'bench-owner'
+    file_keys = {}
+
+    large_path = os.path.join(workdir, 'large')
+    with open(large_path, 'wb') as f:
+        for _ in range(large_size // (1 << 20)):
+            f.write(os.urandom(1 << 20))
+    small_paths = []
+    for i in range(small_count):
+        small_paths.append(os.path.join(workdir, 'small_%d' % i))
+        with open(small_paths[-1], 'wb') as f:
+            f.write(os.urandom(small_size))
+    bc.upload_files_batch([large_path] + small_paths, owner, file_keys=file_keys)
+    large_hash = bc.chain[-1].data.files[0].file
+    small_hashes = [entry.file for entry in bc.chain[-1].data.files[1:]]
+
+    tracemalloc.start()
+    time_start = time.perf_counter()
+    bc.retrieve_file(large_hash, owner, file_keys[large_hash], os.path.join(workdir, 'large.out'))
+    elapsed = time.perf_counter() - time_start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('大文件 {0} MB: {1:.1f} MB/s, 峰值内存 {2:.1f} MB'.format(
+        large_size >> 20, large_size / elapsed / (1 << 20), peak / (1 << 20)))
+
+    # 冷启动时每个文件都要派生密钥，之后命中密钥缓存
+    BlockData.key_cache.clear()
+    BlockData.key_cache.max_entries = max(BlockData.key_cache.max_entries, small_count)
+    for name in ('冷', '热'):
+        time_start = time.perf_counter()
+        for file_enc_hash in small_hashes:
+            bc.retrieve_file(file_enc_hash, owner, file_keys[file_enc_hash], io.BytesIO())
+        elapsed = time.perf_counter() - time_start
+        print('小文件 {0} 个 x {1} 字节（{2}缓存）: {3:.0f} 个/秒, {4:.1f} MB/s'.format(
+            small_count, small_size, name, small_count / elapsed, small_count * small_size / elapsed / (1 << 20)))
+    shutil.rmtree(workdir)
+
+
+def _retarget_simulation(block_time:float = 10.0, interval:int = 16,
+                         phases:tuple = ((1e4, 320), (1e6, 320), (2e5, 320))):
+    '''
+    模拟算力变化时的出块时间：每个区块的出块时间按 期望尝试次数 / 算力 的指数分布随机生成
+    :param phases: (算力 H/s, 区块数) 的序列
+    '''
+    import math
+    import random
+
+    random.seed(0)
+    bc = BlockChain()
+    bc.difficulty = 1
+    bc.target_block_time = block_time
+    bc.retarget_interval = interval
+    timestamp = bc.chain[0].timestamp
+    print('期望出块时间 {0}s，每 {1} 个区块调整一次'.format(block_time, interval))
+    for hashrate, count in phases:
+        times = []
+        for _ in range(count):
+            target = bc.next_target()
+            interval_time = random.expovariate(hashrate / Miner.target_work(target))
+            timestamp += interval_time
+            times.append(interval_time)
+            # 只模拟出块时间，不实际挖矿
+            bc.chain.append(Block.from_fields(timestamp, BlockData(), bc.get_latest_block().hash, 0,
+                                              '%064x' % len(bc.chain), target))
+        tail = times[len(times) // 2:]
+        print('算力 {0:>9.0f} H/s: 前半段平均出块时间 {1:7.2f}s, 后半段 {2:6.2f}s, 最终难度 2^{3:.1f}'.format(
+            hashrate, sum(times[:len(times) // 2]) / (len(times) // 2), sum(tail) / len(tail),
+            math.log2(Miner.target_work(bc.get_latest_block().target))))
+
+
 if __name__ == '__main__':
     '''
     测试Block Chain的代码
+        python BlockChain.py retrieve  测试取回文件的吞吐量
+        python BlockChain.py retarget  模拟算力变化时的难度调整
     '''
+    import sys
+    if sys.argv[1:] == ['retrieve']:
+        _retrieve_benchmark()
+        sys.exit()
+    if sys.argv[1:] == ['retarget']:
+        _retarget_simulation()
+        sys.exit()
 
     # 测试从文件保存与加载功能
 
@@ -178,7 +980,12 @@ if __name__ == '__main__':
     # 取出中间部分（从第二行到倒数第二行），也就是实际的公钥部分
     public_key_content = ''.join(lines[1:-1])
 
-    new_bc.upload_files(['../workspace/data/file_example',],public_key_content)
+    # 新区块链要求文件记录有签名
+    def signer(data: bytes) -> bytes:
+        return private_key.sign(data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()),
+                                                  salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+
+    new_bc.upload_files(['../workspace/data/file_example',],public_key_content, signer=signer)
     new_bc.save_to_file('../workspace/block_chain/new_block_chain.json')
     
     print('检验区块链的合法性:')
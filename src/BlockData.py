@@ -1,42 +1,86 @@
+import hashlib
 import json
 import os
+import struct
+import time
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from KeyCache import KeyCache
+from Metrics import metrics
+from MerkleTree import MerkleTree
+from FileEntry import FileEntry
+from Owner import Owner
 
 
 class BlockData:
+    __slots__ = ('files', '_merkle_tree', '_leaves_digest')
+
+    # 流式读写文件时每次处理的字节数，决定了加解密的内存占用上限
+    CHUNK_SIZE = 1 << 20
+    # 固定的盐与初始化向量，保证相同文件得到相同密文，从而可以去重
+    SALT = b'fixedsalt123456'
+    IV = b'fixediv123456789'
+    # 可选的密钥派生配置，区块链按名称选择。较低成本的配置只适合受信任的本地部署
+    KDF_PROFILES = {
+        'pbkdf2-sha256': {'kdf': 'pbkdf2-sha256', 'iterations': 100000},
+        'pbkdf2-sha256-fast': {'kdf': 'pbkdf2-sha256', 'iterations': 10000},
+        'scrypt': {'kdf': 'scrypt', 'n': 2**14, 'r': 8, 'p': 1},
+    }
+    DEFAULT_KDF = 'pbkdf2-sha256'
+    # 密文文件头：魔数 + 2 字节参数长度 + KDF 参数(json) + 1 字节盐长度 + 盐 + IV(16)
+    # 没有魔数的旧文件为 盐 + IV，使用默认 KDF
+    ENC_MAGIC = b'SBE1'
+    # 派生密钥的缓存，相同内容重复加解密时跳过 KDF
+    key_cache = KeyCache()
+
     def __init__(self):
         '''
-        :param files: 存储当前区块记录了哪些文件
+        :param files: 存储当前区块记录了哪些文件，元素为 FileEntry
         '''
         self.files = []
+        # 文件记录的默克尔树，及构建时所有叶子的摘要。记录有任何变化（增删、替换、补充签名）时重新构建
+        self._merkle_tree = None
+        self._leaves_digest = None
     
-    def add_file(self, file_path: str, author_hash_str: str) -> str:
+    def add_file(self, file_path: str, author_hash_str: str, chunk_store=None, kdf: str = None,
+                 file_keys: dict = None, signer=None) -> str:
         '''
         添加文件，实际上生成一个（用户公钥，加密后文件的哈希）键值对
         :param file_path: 要上传的文件的路径
         :param author_hash: 文件上传者的哈希值，实际上是公钥
+        :param chunk_store: 分块存储，设置时文件分块加密存储，记录的是文件清单的哈希
+        :param kdf: 密钥派生配置名，默认为 DEFAULT_KDF
+        :param file_keys: 设置时记录 密文哈希 -> 文件密码（明文哈希），下载时需要
+        :param signer: 上传者的签名函数，设置时对记录签名
         '''
-        # 计算文件的哈希值
-        file_hash_str = BlockData.calculate_file_hash(file_path)
-        # 使用文件哈希值作为密钥，对文件进行加密
-        BlockData.encrypt_file(file_path, file_hash_str)
-        # 计算密文的哈希值
-        enc_file_hash_str = BlockData.calculate_file_hash(file_path + '.enc')
+        if chunk_store is not None:
+            enc_file_hash_str, file_hash_str = chunk_store.put_file(file_path)
+        else:
+            # 计算文件的哈希值
+            file_hash_str = BlockData.calculate_file_hash(file_path)
+            # 使用文件哈希值作为密钥，对文件进行加密，同时计算密文的哈希值
+            enc_file_hash_str = BlockData.encrypt_file(file_path, file_hash_str, kdf=kdf)
+        if file_keys is not None:
+            file_keys[enc_file_hash_str] = file_hash_str
         # 将用户信息＆密文哈希值写入数据
-        self.files.append({'User':author_hash_str, 'File':enc_file_hash_str})
+        entry = FileEntry(Owner.intern(author_hash_str), enc_file_hash_str)
+        if signer is not None:
+            entry.sign(signer)
+        self.files.append(entry)
         # 返回密文的哈希值，用于去重
         return enc_file_hash_str
 
     @classmethod
-    def calculate_file_hash(cls, file_path: str):
+    def calculate_file_hash(cls, file_path: str, chunk_size: int = None):
         '''
         计算文件的哈希值
         :param file_path: 要计算哈希值的文件路径
+        :param chunk_size: 每次读取的字节数，默认为 CHUNK_SIZE
         '''
         if not os.path.isfile(file_path):
             raise FileNotFoundError(f"The file '{file_path}' does not exist.")
@@ -45,70 +89,266 @@ class BlockData:
         hash_sha256 = hashes.Hash(hashes.SHA256(), backend=default_backend())
         
         # 读取文件并更新哈希值
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+        with metrics.span('hash'), open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size or cls.CHUNK_SIZE), b""):
                 hash_sha256.update(chunk)
         
         # 返回十六进制哈希值
         return hash_sha256.finalize().hex()
     
     @classmethod
-    def derive_key(cls, password: str, salt: bytes) -> bytes:
-        """根据密码和盐值生成密钥"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,  # AES-256
-            salt=salt,
-            iterations=100000,
-            backend=default_backend()
-        )
-        return kdf.derive(password.encode())
+    def kdf_params(cls, kdf: str = None) -> dict:
+        """根据配置名获取 KDF 参数"""
+        kdf = kdf or cls.DEFAULT_KDF
+        if kdf not in cls.KDF_PROFILES:
+            raise Exception('未知的密钥派生配置: {0}'.format(kdf))
+        return cls.KDF_PROFILES[kdf]
+
+    @classmethod
+    def derive_key(cls, password: str, salt: bytes, params: dict = None) -> bytes:
+        """根据密码和盐值生成密钥，结果会被缓存"""
+        params = params or cls.kdf_params()
+        key = cls.key_cache.get(password, salt, params)
+        if key is not None:
+            metrics.inc('kdf.cache_hits')
+            return key
+        metrics.inc('kdf.cache_misses')
+
+        if params['kdf'] == 'pbkdf2-sha256':
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,  # AES-256
+                salt=salt,
+                iterations=params['iterations'],
+                backend=default_backend()
+            )
+        elif params['kdf'] == 'scrypt':
+            kdf = Scrypt(salt=salt, length=32, n=params['n'], r=params['r'], p=params['p'],
+                         backend=default_backend())
+        else:
+            raise Exception('未知的密钥派生算法: {0}'.format(params['kdf']))
+        with metrics.span('kdf'):
+            key = kdf.derive(password.encode())
+        cls.key_cache.put(password, salt, params, key)
+        return key
+
+    @classmethod
+    def encode_enc_header(cls, params: dict) -> bytes:
+        """生成记录了 KDF 参数的密文文件头"""
+        params_bytes = json.dumps(params, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return (cls.ENC_MAGIC + struct.pack('>H', len(params_bytes)) + params_bytes
+                + struct.pack('>B', len(cls.SALT)) + cls.SALT + cls.IV)
 
     @classmethod
-    def encrypt_file(cls, file_path: str, password: str):
-        """加密文件"""
-        salt = b'fixedsalt123456' # os.urandom(16)  # 生成随机盐
-        key = BlockData.derive_key(password, salt)
+    def read_enc_header(cls, f) -> tuple:
+        """
+        从密文文件中读取文件头
+        :return: (KDF 参数, 盐, IV)，读取后文件位置位于密文开始处
+        """
+        magic = f.read(len(cls.ENC_MAGIC))
+        if magic != cls.ENC_MAGIC:
+            # 旧格式：盐 + IV
+            f.seek(-len(magic), os.SEEK_CUR)
+            salt = f.read(len(cls.SALT))
+            iv = f.read(16)
+            return cls.kdf_params(), salt, iv
+        params_length = struct.unpack('>H', f.read(2))[0]
+        params = json.loads(f.read(params_length))
+        salt_length = struct.unpack('>B', f.read(1))[0]
+        salt = f.read(salt_length)
+        iv = f.read(16)
+        return params, salt, iv
 
+    @classmethod
+    def encrypt_file(cls, file_path: str, password: str, output_path: str = None, chunk_size: int = None,
+                     kdf: str = None) -> str:
+        """
+        流式加密文件，写出密文的同时计算密文的哈希值
+        :param file_path: 明文文件路径
+        :param password: 密码，即明文的哈希值
+        :param output_path: 密文文件路径，默认为明文路径加 .enc 后缀
+        :param chunk_size: 每次处理的字节数，默认为 CHUNK_SIZE
+        :param kdf: 密钥派生配置名，参数记录在密文文件头中
+        :return: 密文的哈希值
+        """
+        salt = cls.SALT # os.urandom(16)  # 生成随机盐
+        params = cls.kdf_params(kdf)
+        key = BlockData.derive_key(password, salt, params)
+        return cls._encrypt_with_key(file_path, key, params, output_path, chunk_size)
+
+    @classmethod
+    def _encrypt_with_key(cls, file_path: str, key: bytes, params: dict, output_path: str = None,
+                          chunk_size: int = None) -> str:
+        """使用已派生的密钥流式加密文件，返回密文的哈希值"""
         # 生成随机的初始化向量（IV）
-        iv = b'fixediv123456789' # os.urandom(16)
+        iv = cls.IV # os.urandom(16)
         cipher = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
         encryptor = cipher.encryptor()
+        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+        chunk_size = chunk_size or cls.CHUNK_SIZE
 
-        with open(file_path, 'rb') as f:
-            plaintext = f.read()
+        # 将文件头（KDF 参数、盐、IV）和密文写入输出文件
+        with metrics.span('encrypt'), \
+                open(file_path, 'rb') as fin, open(output_path or file_path + '.enc', 'wb') as fout:
+            header = cls.encode_enc_header(params)
+            fout.write(header)
+            digest.update(header)
+            for chunk in iter(lambda: fin.read(chunk_size), b""):
+                ciphertext = encryptor.update(chunk)
+                fout.write(ciphertext)
+                digest.update(ciphertext)
+            ciphertext = encryptor.finalize()
+            fout.write(ciphertext)
+            digest.update(ciphertext)
+            metrics.inc('encrypt.bytes', fout.tell())
 
-        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        return digest.finalize().hex()
 
-        # 将盐、IV 和密文写入输出文件
-        with open(file_path + '.enc', 'wb') as f:
-            f.write(salt + iv + ciphertext)
+    @classmethod
+    def ingest_file(cls, file_path: str, kdf: str = None) -> dict:
+        """
+        批量上传时在工作进程中执行：计算明文哈希、派生密钥并加密
+        :param file_path: 明文文件路径
+        :param kdf: 密钥派生配置名
+        :return: 密文哈希及各阶段耗时（秒）
+        """
+        time_start = time.perf_counter()
+        file_hash_str = cls.calculate_file_hash(file_path)
+        time_hash = time.perf_counter()
+        params = cls.kdf_params(kdf)
+        key = cls.derive_key(file_hash_str, cls.SALT, params)
+        time_kdf = time.perf_counter()
+        enc_file_hash_str = cls._encrypt_with_key(file_path, key, params)
+        time_encrypt = time.perf_counter()
+        return {
+            'File': enc_file_hash_str,
+            'Key': file_hash_str,
+            'Timing': {
+                'hash': time_hash - time_start,
+                'kdf': time_kdf - time_hash,
+                'encrypt': time_encrypt - time_kdf,
+            },
+        }
 
     @classmethod
-    def decrypt_file(cls, encrypted_file_path: str, password: str):
-        """解密文件"""
-        with open(encrypted_file_path, 'rb') as f:
-            # 读取盐、IV 和密文
-            salt = f.read(16)
-            iv = f.read(16)
-            ciphertext = f.read()
+    def decrypt_stream(cls, fin, password: str, fout, expected_hash: str = None, chunk_size: int = None) -> int:
+        """
+        流式解密，内存占用不超过 chunk_size。读取的同时计算密文与明文的哈希值，结束时检验
+        :param fin: 位于密文开始处的可读二进制流
+        :param password: 密码，即明文的哈希值
+        :param fout: 可写的二进制流
+        :param expected_hash: 期望的密文哈希值，为 None 时不检验
+        :param chunk_size: 每次处理的字节数，默认为 CHUNK_SIZE
+        :return: 写出的明文字节数。检验失败时抛出异常，此时已写出的数据不可信
+        """
+        chunk_size = chunk_size or cls.CHUNK_SIZE
+        # 读取文件头中的 KDF 参数、盐、IV，文件头同样计入密文哈希
+        start = fin.tell()
+        params, salt, iv = cls.read_enc_header(fin)
+        header_length = fin.tell() - start
+        fin.seek(start)
+        cipher_digest = hashlib.sha256(fin.read(header_length))
+        plain_digest = hashlib.sha256()
 
-        key = BlockData.derive_key(password, salt)
-        cipher = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
-        decryptor = cipher.decryptor()
+        key = BlockData.derive_key(password, salt, params)
+        decryptor = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend()).decryptor()
+        written = 0
+        with metrics.span('decrypt'):
+            for chunk in iter(lambda: fin.read(chunk_size), b""):
+                cipher_digest.update(chunk)
+                plaintext = decryptor.update(chunk)
+                plain_digest.update(plaintext)
+                fout.write(plaintext)
+                written += len(plaintext)
+            plaintext = decryptor.finalize()
+            plain_digest.update(plaintext)
+            fout.write(plaintext)
+            written += len(plaintext)
+        metrics.inc('decrypt.bytes', written)
+
+        if expected_hash is not None and cipher_digest.hexdigest() != expected_hash:
+            raise Exception('密文哈希不匹配，文件已损坏')
+        # 密码即明文哈希，可以顺便检验密码与解密结果
+        if plain_digest.hexdigest() != password:
+            raise Exception('解密结果的哈希与密码不符，密码错误或文件已损坏')
+        return written
+
+    @classmethod
+    def decrypt_file(cls, encrypted_file_path: str, password: str, output_path: str = None, chunk_size: int = None,
+                     expected_hash: str = None) -> int:
+        """
+        流式解密文件。先写入临时文件，检验通过后才替换为结果文件
+        :param encrypted_file_path: 密文文件路径
+        :param password: 密码，即明文的哈希值
+        :param output_path: 解密结果路径，默认将 .enc 后缀替换为 .dec
+        :param chunk_size: 每次处理的字节数，默认为 CHUNK_SIZE
+        :param expected_hash: 期望的密文哈希值，为 None 时不检验
+        :return: 解密得到的字节数
+        """
+        output_path = output_path or encrypted_file_path[:-4] + '.dec'  # 去掉 .enc 后缀
+        tmp_path = '{0}.{1}.tmp'.format(output_path, os.getpid())
+        try:
+            with open(encrypted_file_path, 'rb') as fin, open(tmp_path, 'wb') as fout:
+                written = cls.decrypt_stream(fin, password, fout, expected_hash, chunk_size)
+            os.replace(tmp_path, output_path)
+            return written
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+    def merkle_tree(self, refresh: bool = False) -> MerkleTree:
+        '''
+        获取文件记录的默克尔树
+        :param refresh: 是否忽略缓存重新构建，检验区块时使用
+        '''
+        leaves = [entry.leaf() for entry in self.files]
+        # 只比较一次哈希的摘要，不保存叶子本身，记录较多时不额外占用内存
+        digest = hashlib.sha256(b''.join(len(leaf).to_bytes(4, 'big') + leaf for leaf in leaves)).digest()
+        if refresh or self._merkle_tree is None or digest != self._leaves_digest:
+            self._merkle_tree = MerkleTree(leaves)
+            self._leaves_digest = digest
+        return self._merkle_tree
+
+    def calculate_hash(self, refresh: bool = False) -> bytes:
+        '''
+        计算区块数据的哈希值，即文件记录的默克尔根，写入区块头
+        :param refresh: 是否忽略缓存重新计算
+        :return: 32 字节摘要
+        '''
+        return self.merkle_tree(refresh).root()
+
+    def get_inclusion_proof(self, file_enc_hash: str, owner: str = None):
+        '''
+        生成某个文件记录包含在本区块中的证明
+        :param file_enc_hash: 密文的哈希值
+        :param owner: 文件所有者，为 None 时匹配任意所有者
+        :return: 证明，未找到记录时返回 None
+        '''
+        for i, entry in enumerate(self.files):
+            if entry.file == file_enc_hash and (owner is None or entry.owner.key == owner):
+                return {
+                    'Entry': entry.to_dict(),
+                    'Index': i,
+                    'Path': [[side, sibling.hex()] for side, sibling in self.merkle_tree().proof(i)],
+                }
+        return None
+
+    @staticmethod
+    def verify_inclusion_proof(proof: dict, merkle_root: bytes) -> bool:
+        '''
+        检验文件记录的包含证明
+        :param proof: get_inclusion_proof 返回的证明
+        :param merkle_root: 区块头中记录的默克尔根
+        '''
+        path = [(side, bytes.fromhex(sibling)) for side, sibling in proof['Path']]
+        return MerkleTree.verify(FileEntry.from_dict(proof['Entry']).leaf(), path, merkle_root)
 
-        # 写入解密后的文件
-        with open(encrypted_file_path[:-4]+'.dec', 'wb') as f:  # 去掉 .enc 后缀
-            f.write(plaintext)
-            
     def to_dict(self):
         '''
         将 BlockData 实例转换为json字典
         '''
         return {
-            'Files': self.files,
+            'Files': [entry.to_dict() for entry in self.files],
         }
     
     @classmethod
@@ -117,7 +357,7 @@ class BlockData:
         从json加载一个区块链
         '''
         blockdata = cls()
-        blockdata.files = data['Files']
+        blockdata.files = [FileEntry.from_dict(entry) for entry in data['Files']]
         return blockdata
 
 if __name__ == '__main__':
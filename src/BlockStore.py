@@ -0,0 +1,245 @@
+import json
+import os
+import struct
+import sys
+from array import array
+import Codec
+from Block import Block
+from ChainLock import ChainLock
+from BlockData import BlockData
+
+
+class BlockStore:
+    # 区块日志：每个区块一条记录，记录为 4 字节大端长度 + 区块的二进制编码（见 Codec）
+    LOG_NAME = 'blocks.log'
+    # 偏移索引：第 i 个 8 字节小端整数为高度 i 的区块在日志中的偏移
+    INDEX_NAME = 'blocks.idx'
+    # 区块链的元信息（ID、难度等），很小，整体覆盖写
+    META_NAME = 'meta.json'
+    # 多个进程写入同一存储时使用的锁文件
+    LOCK_NAME = 'lock'
+    LENGTH_FORMAT = struct.Struct('>I')
+
+    def __init__(self, store_dir: str):
+        '''
+        只追加的区块存储
+        :param store_dir: 存储目录
+        '''
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.log_path = os.path.join(store_dir, BlockStore.LOG_NAME)
+        self.index_path = os.path.join(store_dir, BlockStore.INDEX_NAME)
+        self.meta_path = os.path.join(store_dir, BlockStore.META_NAME)
+
+        self._log = open(self.log_path, 'a+b')
+        self._index = open(self.index_path, 'a+b')
+        self._reader = open(self.log_path, 'rb')
+        self._offsets = array('Q')
+        # 其他进程可能正在追加，加锁后再修复，避免截断正在写入的记录
+        with ChainLock(os.path.join(store_dir, BlockStore.LOCK_NAME)):
+            self._load_offsets()
+            self._recover()
+
+    def _load_offsets(self) -> int:
+        '''
+        从索引文件读取当前尚未加载的偏移
+        :return: 新加载的偏移个数
+        '''
+        itemsize = self._offsets.itemsize
+        with open(self.index_path, 'rb') as f:
+            f.seek(len(self._offsets) * itemsize)
+            raw = f.read()
+        # 只保留完整的 8 字节偏移
+        raw = raw[:len(raw) - len(raw) % itemsize]
+        offsets = array('Q')
+        offsets.frombytes(raw)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        self._offsets.extend(offsets)
+        return len(offsets)
+
+    def refresh(self) -> int:
+        '''
+        加载其他进程在本对象打开后追加的区块
+        :return: 新增的区块数
+        '''
+        return self._load_offsets()
+
+    def _recover(self):
+        '''
+        修复意外中断留下的不一致：日志中尾部不完整的记录被截断，索引缺失的偏移被补齐
+        '''
+        log_size = os.path.getsize(self.log_path)
+        indexed = list(self._offsets)
+        # 丢弃指向日志之外的偏移
+        while len(self._offsets) and self._offsets[-1] >= log_size:
+            self._offsets.pop()
+
+        offset = 0
+        if len(self._offsets):
+            offset = self._offsets[-1]
+            length = self._read_length(offset)
+            if length is None or offset + BlockStore.LENGTH_FORMAT.size + length > log_size:
+                self._offsets.pop()
+            else:
+                offset += BlockStore.LENGTH_FORMAT.size + length
+
+        # 索引落后于日志时，从最后一个已知位置继续扫描
+        while offset < log_size:
+            length = self._read_length(offset)
+            if length is None or offset + BlockStore.LENGTH_FORMAT.size + length > log_size:
+                break
+            self._offsets.append(offset)
+            offset += BlockStore.LENGTH_FORMAT.size + length
+
+        if offset < log_size:
+            self._log.truncate(offset)
+        if list(self._offsets) != indexed:
+            self._rewrite_index()
+
+    def _rewrite_index(self):
+        offsets = array('Q', self._offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        self._index.truncate(0)
+        self._index.write(offsets.tobytes())
+        self._index.flush()
+
+    def _read_length(self, offset: int):
+        self._reader.seek(offset)
+        raw = self._reader.read(BlockStore.LENGTH_FORMAT.size)
+        if len(raw) < BlockStore.LENGTH_FORMAT.size:
+            return None
+        return BlockStore.LENGTH_FORMAT.unpack(raw)[0]
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    @staticmethod
+    def encode_block(block) -> bytes:
+        return Codec.encode_block(block)
+
+    @staticmethod
+    def decode_block(payload: bytes):
+        return Codec.decode_block(payload)
+
+    def append_block(self, block):
+        '''
+        追加一个区块，写入后立即落盘
+        '''
+        payload = BlockStore.encode_block(block)
+        self._log.seek(0, os.SEEK_END)
+        offset = self._log.tell()
+        self._log.write(BlockStore.LENGTH_FORMAT.pack(len(payload)) + payload)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+        # 索引可以由日志恢复，只需刷新
+        self._offsets.append(offset)
+        self._index.write(struct.pack('<Q', offset))
+        self._index.flush()
+
+    def record_offset(self, height: int) -> int:
+        '''
+        指定高度区块的记录在日志中的偏移
+        '''
+        return self._offsets[height]
+
+    def read_payload(self, height: int) -> bytes:
+        '''
+        读取指定高度区块的原始记录
+        '''
+        offset = self._offsets[height]
+        length = self._read_length(offset)
+        return self._reader.read(length)
+
+    def read_block(self, height: int):
+        '''
+        读取指定高度的区块，支持负数下标
+        '''
+        return BlockStore.decode_block(self.read_payload(height))
+
+    def tip(self):
+        '''
+        读取最新的区块，存储为空时返回 None
+        '''
+        if len(self._offsets) == 0:
+            return None
+        return self.read_block(-1)
+
+    def iter_blocks(self, start: int = 0):
+        '''
+        依次读取从 start 开始的区块
+        '''
+        for height in range(start, len(self._offsets)):
+            yield self.read_block(height)
+
+    def read_meta(self) -> dict:
+        if not os.path.isfile(self.meta_path):
+            return {}
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_meta(self, meta: dict):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.meta_path)
+
+    def close(self):
+        self._log.close()
+        self._index.close()
+        self._reader.close()
+
+    @staticmethod
+    def import_json(json_path: str, store_dir: str) -> 'BlockStore':
+        '''
+        一次性将 json 格式的区块链导入到区块存储中
+        :param json_path: 区块链 json 文件
+        :param store_dir: 存储目录，必须为空
+        '''
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        store = BlockStore(store_dir)
+        if len(store) != 0:
+            store.close()
+            raise Exception('区块存储 {0} 非空，无法导入'.format(store_dir))
+
+        blocks = [Block.from_dict(block_data) for block_data in data['Chain']]
+        # 旧格式的区块链先迁移为二进制区块头，区块存储中只保存新格式
+        if Block.is_legacy_chain(blocks):
+            Block.migrate_legacy_chain(blocks, data.get('Difficulty', 0))
+        for block in blocks:
+            store.append_block(block)
+        store.write_meta({'ID': data['ID'], 'Difficulty': data['Difficulty'],
+                          'KDF': data.get('KDF', BlockData.DEFAULT_KDF),
+                          'Target Block Time': data.get('Target Block Time'),
+                          'Retarget Interval': data.get('Retarget Interval', 16),
+                          'Require Signatures': data.get('Require Signatures', False)})
+        return store
+
+
+if __name__ == '__main__':
+    '''
+    将已有的 json 区块链导入为区块存储：
+        python BlockStore.py ../workspace/block_chain/block_chain.json ../workspace/block_store
+    '''
+    import glob
+
+    if len(sys.argv) == 3:
+        json_paths = [sys.argv[1]]
+        store_root = sys.argv[2]
+    else:
+        json_paths = glob.glob('../workspace/block_chain/*.json')
+        store_root = '../workspace/block_store'
+
+    for json_path in json_paths:
+        if len(json_paths) == 1:
+            store_dir = store_root
+        else:
+            store_dir = os.path.join(store_root, os.path.splitext(os.path.basename(json_path))[0])
+        store = BlockStore.import_json(json_path, store_dir)
+        print('已导入 {0} -> {1}, 共 {2} 个区块'.format(json_path, store_dir, len(store)))
+        store.close()
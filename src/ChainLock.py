@@ -0,0 +1,166 @@
+import os
+import time
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl
+    fcntl = None
+    import msvcrt
+
+
+class ChainLock:
+    def __init__(self, lock_path: str, timeout: float = None):
+        '''
+        跨进程的文件锁，用于保护共享区块链文件的短临界区（读取最新区块、追加、保存）
+            with ChainLock(path):
+                ...
+        :param lock_path: 锁文件路径，不存在时自动创建
+        :param timeout: 最长等待时间（秒），为 None 时一直等待
+        '''
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self._file = None
+        # 最近一次加锁等待与持有的时间
+        self.wait_time = 0.0
+        self.hold_time = 0.0
+        self._acquired_at = 0.0
+
+    @staticmethod
+    def for_chain_file(block_chain_file_path: str) -> 'ChainLock':
+        '''
+        区块链文件（json 文件或区块存储目录）对应的锁
+        '''
+        if os.path.isdir(block_chain_file_path):
+            # 与 BlockStore.LOCK_NAME 相同
+            return ChainLock(os.path.join(block_chain_file_path, 'lock'))
+        return ChainLock(block_chain_file_path + '.lock')
+
+    def _try_lock(self) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self):
+        time_start = time.perf_counter()
+        self._file = open(self.lock_path, 'a+b')
+        if fcntl is not None and self.timeout is None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            delay = 0.001
+            while not self._try_lock():
+                if self.timeout is not None and time.perf_counter() - time_start >= self.timeout:
+                    self._file.close()
+                    self._file = None
+                    raise Exception('等待区块链锁 {0} 超时'.format(self.lock_path))
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        self._acquired_at = time.perf_counter()
+        self.wait_time = self._acquired_at - time_start
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+        self.hold_time = time.perf_counter() - self._acquired_at
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _stress_writer(args):
+    '''
+    压力测试的写入进程：加载共享区块链后逐个提交区块
+    '''
+    import contextlib
+    import io
+    from BlockChain import BlockChain
+    from BlockData import BlockData
+    from FileEntry import FileEntry
+    from Owner import Owner
+
+    path, writer, commits, safe = args
+    with contextlib.redirect_stdout(io.StringIO()):
+        if os.path.isdir(path):
+            chain = BlockChain.load_from_store(path)
+        else:
+            chain = BlockChain.load_from_file(path)
+        for i in range(commits):
+            blockdata = BlockData()
+            blockdata.files = [FileEntry(Owner.intern('writer-%d' % writer), '%032x%032x' % (writer, i))]
+            if safe:
+                chain.commit_block(blockdata, path)
+            else:
+                # 原有方式：加载、挖矿、整体覆盖保存，没有任何锁
+                chain = BlockChain.load_from_file(path)
+                chain._seal_block(blockdata)
+                chain.save_to_file(path)
+    return chain.commit_retries
+
+
+if __name__ == '__main__':
+    '''
+    多个本地进程同时向同一条区块链提交区块，检查是否丢失区块并统计每秒提交数
+        python ChainLock.py [进程数] [每个进程的提交数]
+    '''
+    import shutil
+    import sys
+    import tempfile
+    from multiprocessing import Pool
+    from BlockChain import BlockChain
+
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    commits = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    workdir = tempfile.mkdtemp()
+
+    def run(name, path, safe):
+        time_start = time.perf_counter()
+        with Pool(writers) as pool:
+            retries = sum(pool.map(_stress_writer, [(path, w, commits, safe) for w in range(writers)]))
+        elapsed = time.perf_counter() - time_start
+        if os.path.isdir(path):
+            chain = BlockChain.load_from_store(path)
+        else:
+            chain = BlockChain.load_from_file(path)
+        recorded = {entry.file for block in chain.chain for entry in block.data.files}
+        expected = {'%032x%032x' % (w, i) for w in range(writers) for i in range(commits)}
+        lost = len(expected - recorded)
+        print('{0}: {1} 个进程共提交 {2} 个区块, 丢失 {3} 个, 重新挖矿 {4} 次, {5:.1f} 次提交/秒, 链检验 {6}'.format(
+            name, writers, writers * commits, lost, retries, writers * commits / elapsed,
+            bool(chain.verify_blockchain(full=True))))
+        return lost
+
+    def unsigned_chain():
+        chain = BlockChain()
+        # 合成的记录没有签名
+        chain.require_signatures = False
+        return chain
+
+    json_path = os.path.join(workdir, 'unsafe.json')
+    unsigned_chain().save_to_file(json_path)
+    run('无锁 json', json_path, False)
+
+    json_path = os.path.join(workdir, 'block_chain.json')
+    unsigned_chain().save_to_file(json_path)
+    assert run('加锁 json', json_path, True) == 0
+
+    store_dir = os.path.join(workdir, 'block_store')
+    chain = unsigned_chain()
+    chain.attach_store(store_dir)
+    chain.store.close()
+    assert run('加锁区块存储', store_dir, True) == 0
+    shutil.rmtree(workdir)
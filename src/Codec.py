@@ -0,0 +1,195 @@
+import struct
+from Block import Block
+from BlockData import BlockData
+from FileEntry import FileEntry
+from Owner import Owner
+from Miner import NONCE_FORMAT
+
+# 区块的二进制记录：区块头前缀(Block.HEADER_FORMATS，长度由版本号决定) + nonce(8) + 区块哈希(32) + 区块数据
+# 区块数据：所有者个数 + 各所有者公钥（变长）+ 记录个数 + 各记录（所有者序号 + 文件哈希(32)）
+#   [+ 有签名的记录个数 + 各签名（记录序号 + 签名长度 + 签名）]，没有签名的区块省略这一部分，与旧记录相同
+# 整数均为无符号 LEB128 变长编码
+HASH_SIZE = 32
+# 记录开头足以读出版本号的字节数
+VERSION_SIZE = Block.VERSION_FORMAT.size
+
+
+def record_header_size(buf, pos: int = 0) -> int:
+    '''
+    记录中区块头部分（区块头前缀 + nonce + 区块哈希）的长度，即区块数据的起始偏移
+    '''
+    version = Block.VERSION_FORMAT.unpack_from(buf, pos)[0]
+    return Block.header_format(version).size + NONCE_FORMAT.size + HASH_SIZE
+
+
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, pos: int) -> tuple:
+    '''
+    :return: (整数, 下一个位置)
+    '''
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_block_data(data: BlockData) -> bytes:
+    owners = {}
+    body = bytearray()
+    for entry in data.files:
+        index = owners.get(entry.owner.key)
+        if index is None:
+            index = owners[entry.owner.key] = len(owners)
+        body += encode_varint(index)
+        body += bytes.fromhex(entry.file)
+
+    out = bytearray(encode_varint(len(owners)))
+    for key in owners:
+        key_bytes = key.encode('utf-8')
+        out += encode_varint(len(key_bytes))
+        out += key_bytes
+    out += encode_varint(len(data.files))
+    out += body
+
+    signed = [(i, entry.signature) for i, entry in enumerate(data.files) if entry.signature is not None]
+    if signed:
+        out += encode_varint(len(signed))
+        for i, signature in signed:
+            out += encode_varint(i)
+            out += encode_varint(len(signature))
+            out += signature
+    return bytes(out)
+
+
+def decode_block_data(buf, pos: int = 0, end: int = None) -> BlockData:
+    '''
+    :param end: 区块数据的结束位置，默认为 buf 的末尾
+    '''
+    end = len(buf) if end is None else end
+    owner_count, pos = decode_varint(buf, pos)
+    owners = []
+    for _ in range(owner_count):
+        length, pos = decode_varint(buf, pos)
+        owners.append(Owner.intern(bytes(buf[pos:pos + length]).decode('utf-8')))
+        pos += length
+
+    entry_count, pos = decode_varint(buf, pos)
+    files = [None] * entry_count
+    for i in range(entry_count):
+        index = buf[pos]
+        if index < 0x80:
+            # 所有者少于 128 个时序号只占一个字节
+            pos += 1
+        else:
+            index, pos = decode_varint(buf, pos)
+        files[i] = FileEntry(owners[index], buf[pos:pos + HASH_SIZE].hex())
+        pos += HASH_SIZE
+
+    if pos < end:
+        signed_count, pos = decode_varint(buf, pos)
+        for _ in range(signed_count):
+            i, pos = decode_varint(buf, pos)
+            length, pos = decode_varint(buf, pos)
+            files[i].signature = bytes(buf[pos:pos + length])
+            pos += length
+
+    data = BlockData()
+    data.files = files
+    return data
+
+
+def encode_block(block: Block) -> bytes:
+    return block.header() + bytes.fromhex(block.hash) + encode_block_data(block.data)
+
+
+def decode_header(buf, pos: int = 0) -> tuple:
+    '''
+    只解析区块头，不解析区块数据
+    :return: (时间戳, 上一区块哈希, 默克尔根, nonce, 区块哈希, 目标值)，旧版本区块头的目标值为 None
+    '''
+    header_format = Block.header_format(Block.VERSION_FORMAT.unpack_from(buf, pos)[0])
+    fields = header_format.unpack_from(buf, pos)
+    previous_hash, timestamp, merkle_root = fields[1:4]
+    target = int.from_bytes(fields[4], 'big') if len(fields) > 4 else None
+    pos += header_format.size
+    nonce = NONCE_FORMAT.unpack_from(buf, pos)[0]
+    pos += NONCE_FORMAT.size
+    block_hash = bytes(buf[pos:pos + HASH_SIZE]).hex()
+    # 创世区块的上一区块哈希为空
+    previous_hash = '' if previous_hash == bytes(HASH_SIZE) else previous_hash.hex()
+    return timestamp, previous_hash, merkle_root, nonce, block_hash, target
+
+
+def decode_block(buf, pos: int = 0) -> Block:
+    timestamp, previous_hash, _, nonce, block_hash, target = decode_header(buf, pos)
+    data = decode_block_data(buf, pos + record_header_size(buf, pos))
+    return Block.from_fields(timestamp, data, previous_hash, nonce, block_hash, target)
+
+
+if __name__ == '__main__':
+    '''
+    对比 json 字典表示与二进制编码 + __slots__ 模型在大量文件记录下的内存占用与加载耗时
+        python Codec.py [记录数]
+    '''
+    import gc
+    import json
+    import sys
+    import time
+    import tracemalloc
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    files_per_block = 1000
+    owner_keys = ['MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA' + ('%04d' % i) * 86 for i in range(100)]
+
+    blocks = []
+    previous_hash = ''
+    for b in range(total // files_per_block):
+        data = BlockData()
+        data.files = [FileEntry(Owner.intern(owner_keys[(b + i) % len(owner_keys)]), '%064x' % (b * files_per_block + i))
+                      for i in range(files_per_block)]
+        block = Block(time.time(), data, previous_hash)
+        blocks.append(block)
+        previous_hash = block.hash
+
+    json_text = json.dumps([block.to_dict() for block in blocks])
+    binary = [encode_block(block) for block in blocks]
+    del blocks
+    gc.collect()
+
+    def measure(load):
+        # 分别测量耗时与内存，tracemalloc 本身会显著拖慢对象创建
+        gc.collect()
+        time_start = time.perf_counter()
+        result = load()
+        elapsed = time.perf_counter() - time_start
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = load()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, elapsed, memory
+
+    # 原有方式：json 解析后每条记录为一个字典，每条记录各持有一份公钥字符串（只计 json 解析，是原加载方式的下限）
+    loaded, elapsed, memory = measure(lambda: json.loads(json_text))
+    print('json 字典: 存储 {0:.1f} MB, 加载 {1:.2f}s, 内存 {2:.1f} MB'.format(
+        len(json_text) / 2**20, elapsed, memory / 2**20))
+    del loaded
+    gc.collect()
+
+    loaded, elapsed, memory = measure(lambda: [decode_block(record) for record in binary])
+    print('二进制 + __slots__: 存储 {0:.1f} MB, 加载 {1:.2f}s, 内存 {2:.1f} MB'.format(
+        sum(len(record) for record in binary) / 2**20, elapsed, memory / 2**20))
@@ -0,0 +1,60 @@
+from Owner import Owner
+
+
+class FileEntry:
+    __slots__ = ('owner', 'file', 'signature')
+    # 签名内容的前缀，避免记录的签名被用于其他用途
+    SIGNATURE_PREFIX = b'file-entry:'
+
+    def __init__(self, owner: Owner, file: str, signature: bytes = None):
+        '''
+        区块中的一条文件记录
+        :param owner: 文件所有者
+        :param file: 密文（或分块存储时文件清单）的哈希值，十六进制字符串
+        :param signature: 所有者私钥对记录的签名，旧记录没有签名
+        '''
+        self.owner = owner
+        self.file = file
+        self.signature = signature
+
+    def encode(self) -> bytes:
+        '''
+        规范的二进制编码：所有者指纹(32) + 文件哈希(32)
+        '''
+        return self.owner.fingerprint + bytes.fromhex(self.file)
+
+    def leaf(self) -> bytes:
+        '''
+        默克尔树的叶子：编码加签名，签名同样受区块哈希保护。没有签名时与旧记录相同
+        '''
+        if self.signature is None:
+            return self.encode()
+        return self.encode() + self.signature
+
+    def signing_message(self) -> bytes:
+        return FileEntry.SIGNATURE_PREFIX + self.encode()
+
+    def sign(self, signer):
+        '''
+        :param signer: 签名函数 signer(消息) -> 签名，例如 KeyStore.sign
+        '''
+        self.signature = signer(self.signing_message())
+        return self
+
+    def to_dict(self):
+        data = {
+            'User': self.owner.key,
+            'File': self.file,
+        }
+        if self.signature is not None:
+            data['Signature'] = self.signature.hex()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        signature = data.get('Signature')
+        return cls(Owner.intern(data['User']), data['File'],
+                   bytes.fromhex(signature) if signature is not None else None)
+
+    def __repr__(self) -> str:
+        return 'FileEntry({0!r}, {1})'.format(self.owner, self.file)
@@ -0,0 +1,252 @@
+import bisect
+import json
+import os
+import time
+from Owner import Owner
+
+
+class FileIndex:
+    def __init__(self):
+        '''
+        密文哈希索引，用于去重与所有权查询
+        :param files: 密文哈希 -> {'Height': 首次记录该文件的区块高度, 'Owners': 所有者 -> 该所有者首次记录的区块高度}
+        :param height: 已建立索引的最高区块高度
+        :param tip_hash: 已建立索引的最新区块的哈希
+        :param owners: 所有者公钥指纹 -> [[区块高度, 区块时间戳, 密文哈希], ...]，按高度排列，每个文件只记录首次
+        :param entry_count: 链上文件记录的总数（包括重复上传），与 files 的大小之比即去重比
+        '''
+        self.files = {}
+        self.owners = {}
+        # 与 owners 平行的时间戳列表，用于二分查找时间范围（Python 3.9 的 bisect 不支持 key）
+        self._times = {}
+        # 时间戳不随高度递增的所有者，查询时间范围时退回线性过滤
+        self._unordered = set()
+        self.entry_count = 0
+        self.height = -1
+        self.tip_hash = ''
+
+    @classmethod
+    def build(cls, chain) -> 'FileIndex':
+        '''
+        遍历整条区块链建立索引
+        :param chain: 区块列表
+        '''
+        index = cls()
+        for height, block in enumerate(chain):
+            index.add_block(height, block)
+        return index
+
+    def add_block(self, height: int, block):
+        '''
+        将新追加的区块加入索引
+        :param height: 区块高度
+        :param block: 区块
+        '''
+        self.entry_count += len(block.data.files)
+        for file in block.data.files:
+            record = self.files.get(file.file)
+            if record is None:
+                self.files[file.file] = {'Height': height, 'Owners': {file.owner.key: height}}
+            elif file.owner.key not in record['Owners']:
+                record['Owners'][file.owner.key] = height
+            else:
+                continue
+            owned = self.owners.get(file.owner.fingerprint_hex)
+            if owned is None:
+                owned = self.owners[file.owner.fingerprint_hex] = []
+            owned.append([height, block.timestamp, file.file])
+            self._add_time(file.owner.fingerprint_hex, block.timestamp)
+        self.height = height
+        self.tip_hash = block.hash
+
+    def _add_time(self, fingerprint: str, timestamp: float):
+        times = self._times.get(fingerprint)
+        if times is None:
+            times = self._times[fingerprint] = []
+        elif timestamp < times[-1]:
+            self._unordered.add(fingerprint)
+        times.append(timestamp)
+
+    def contains(self, file_enc_hash: str) -> bool:
+        '''
+        判断密文是否已被记录在链上
+        '''
+        return file_enc_hash in self.files
+
+    def get(self, file_enc_hash: str):
+        '''
+        获取密文对应的记录，不存在时返回 None
+        '''
+        return self.files.get(file_enc_hash)
+
+    def is_owner(self, file_enc_hash: str, owner: str) -> bool:
+        '''
+        判断用户是否拥有该文件
+        '''
+        record = self.files.get(file_enc_hash)
+        return record is not None and owner in record['Owners']
+
+    def owner_files(self, owner: str, since: float = None, until: float = None,
+                    offset: int = 0, limit: int = None) -> list:
+        '''
+        查询某个所有者的文件，只访问该所有者的记录
+        :param owner: 所有者公钥
+        :param since: 只返回区块时间戳不早于该时间的文件
+        :param until: 只返回区块时间戳早于该时间的文件
+        :param offset: 分页时跳过的条数
+        :param limit: 最多返回的条数，为 None 时不限制
+        :return: [{'File': 密文哈希, 'Height': 区块高度, 'Time Stamp': 区块时间戳}, ...]，按高度排列
+        '''
+        fingerprint = Owner.fingerprint_of(owner)
+        owned = self.owners.get(fingerprint, [])
+        if fingerprint in self._unordered:
+            # 链上没有保证时间戳递增，时间戳乱序时逐条过滤
+            owned = [item for item in owned
+                     if (since is None or item[1] >= since) and (until is None or item[1] < until)]
+            start, end = 0, len(owned)
+        else:
+            # 时间戳随高度递增，可以二分查找时间范围
+            times = self._times.get(fingerprint, [])
+            start = 0 if since is None else bisect.bisect_left(times, since)
+            end = len(owned) if until is None else bisect.bisect_left(times, until)
+        start += offset
+        if limit is not None:
+            end = min(end, start + limit)
+        return [{'File': file, 'Height': height, 'Time Stamp': timestamp}
+                for height, timestamp, file in owned[start:end]]
+
+    def owner_file_count(self, owner: str) -> int:
+        '''
+        某个所有者拥有的文件数
+        '''
+        return len(self.owners.get(Owner.fingerprint_of(owner), []))
+
+    def matches(self, chain) -> bool:
+        '''
+        判断索引是否与区块链的最新区块一致
+        '''
+        return self.height == len(chain) - 1 and self.tip_hash == chain[-1].hash
+
+    def to_dict(self):
+        return {
+            'Height': self.height,
+            'Tip Hash': self.tip_hash,
+            'Files': self.files,
+            'Owners': self.owners,
+            'Entries': self.entry_count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        if 'Owners' not in data or 'Entries' not in data:
+            # 旧版本的索引没有所有者索引或记录总数，返回空索引以便重建
+            return index
+        index.height = data['Height']
+        index.tip_hash = data['Tip Hash']
+        index.files = data['Files']
+        index.owners = data['Owners']
+        index.entry_count = data['Entries']
+        for fingerprint, owned in index.owners.items():
+            for _, timestamp, _ in owned:
+                index._add_time(fingerprint, timestamp)
+        return index
+
+    @staticmethod
+    def index_path(block_chain_file_path: str) -> str:
+        '''
+        索引文件保存在区块链文件旁边
+        '''
+        return block_chain_file_path + '.index'
+
+    @staticmethod
+    def load_from_file(file_path: str):
+        '''
+        从文件加载索引，文件不存在时返回 None
+        '''
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return FileIndex.from_dict(json.load(f))
+
+    def save_to_file(self, file_path: str) -> bool:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+            return True
+        return False
+
+
+if __name__ == '__main__':
+    '''
+    对比链上记录文件数增长时，线性扫描去重与索引去重的耗时
+    '''
+    import shutil
+    import tempfile
+    from Block import Block
+    from BlockData import BlockData
+    from BlockChain import BlockChain
+    from FileEntry import FileEntry
+    from Owner import Owner
+
+    owner = 'bench-owner'
+    files_per_block = 1000
+    workdir = tempfile.mkdtemp()
+    sample = os.path.join(workdir, 'sample')
+
+    bc = BlockChain()
+    # 合成的记录没有签名
+    bc.require_signatures = False
+    bc.upload_dir = os.path.join(workdir, 'upload_data') + '/'
+    os.makedirs(bc.upload_dir)
+    recorded = 0
+    for target in (10**3, 10**4, 10**5, 2 * 10**5):
+        while recorded < target:
+            blockdata = BlockData()
+            blockdata.files = [FileEntry(Owner.intern(owner), '%064x' % (recorded + i)) for i in range(files_per_block)]
+            bc.add_block(Block(time.time(), blockdata, bc.get_latest_block().hash))
+            recorded += files_per_block
+
+        probe = '%064x' % (recorded * 2)
+        time_start = time.perf_counter()
+        found = False
+        for block in bc.chain:
+            for file in block.data.files:
+                if file.file == probe:
+                    found = True
+        scan_cost = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        for _ in range(1000):
+            bc.index.contains(probe)
+        index_cost = (time.perf_counter() - time_start) / 1000
+
+        # 每次上传不同内容，避免命中去重
+        with open(sample, 'wb') as f:
+            f.write(os.urandom(4096))
+        time_start = time.perf_counter()
+        bc.upload_files([sample], owner)
+        upload_cost = time.perf_counter() - time_start
+
+        print('已记录文件数 {0:>7}: 线性扫描 {1:.6f}s  索引查询 {2:.9f}s  单文件上传 {3:.4f}s'.format(
+            recorded, scan_cost, index_cost, upload_cost))
+
+    # 按所有者分页列出文件：遍历整条链比较公钥，与只访问该所有者的记录
+    owners = ['bench-owner-%d' % i for i in range(100)]
+    for block in bc.chain:
+        for i, file in enumerate(block.data.files):
+            file.owner = Owner.intern(owners[i % len(owners)])
+    bc._index = None
+    target = owners[7]
+    middle = bc.chain[len(bc.chain) // 2].timestamp
+    time_start = time.perf_counter()
+    scanned = [file.file for block in bc.chain if block.timestamp >= middle
+               for file in block.data.files if file.owner.key == target][:50]
+    scan_cost = time.perf_counter() - time_start
+    bc.index
+    time_start = time.perf_counter()
+    page = bc.index.owner_files(target, since=middle, limit=50)
+    index_cost = time.perf_counter() - time_start
+    assert [item['File'] for item in page] == scanned
+    print('列出某所有者某时间之后的前 50 个文件: 线性扫描 {0:.6f}s  所有者索引 {1:.6f}s'.format(scan_cost, index_cost))
+
+    shutil.rmtree(workdir)
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from cryptography.hazmat.backends import default_backend
+
+
+class KeyCache:
+    # 磁盘缓存文件格式：盐(16) + nonce(12) + AES-GCM 密文
+    SALT_SIZE = 16
+    NONCE_SIZE = 12
+
+    def __init__(self, max_entries: int = 1024, path: str = None, passphrase: str = None):
+        '''
+        派生密钥的 LRU 缓存。相同内容的文件使用相同的密码与盐，重复加解密时可以跳过 KDF
+        :param max_entries: 最多缓存的密钥个数，为 0 时关闭缓存
+        :param path: 磁盘缓存文件路径，为 None 时只在内存中缓存
+        :param passphrase: 磁盘缓存的加密口令，设置 path 时必须指定，缓存中的密钥不以明文保存
+        '''
+        self.max_entries = max_entries
+        self.path = path
+        self.passphrase = passphrase
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        # 缓存被多个线程共享（如服务的线程池），读取也会调整 LRU 顺序，所有访问都需要持有锁
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            self.load()
+
+    @staticmethod
+    def cache_key(password: str, salt: bytes, params: dict) -> str:
+        '''
+        缓存的键只保存密码等的哈希，缓存文件中不出现明文哈希（即文件密码）本身
+        '''
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        digest.update(salt)
+        digest.update(password.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, password: str, salt: bytes, params: dict):
+        '''
+        查找已派生的密钥，未命中时返回 None
+        '''
+        key = KeyCache.cache_key(password, salt, params)
+        with self._lock:
+            derived = self._keys.get(key)
+            if derived is None:
+                self.misses += 1
+                return None
+            self._keys.move_to_end(key)
+            self.hits += 1
+            return derived
+
+    def put(self, password: str, salt: bytes, params: dict, derived: bytes):
+        '''
+        记录派生的密钥，超出容量时淘汰最久未使用的密钥
+        '''
+        if self.max_entries <= 0:
+            return
+        key = KeyCache.cache_key(password, salt, params)
+        with self._lock:
+            self._keys[key] = derived
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def _wrapping_key(passphrase: str, salt: bytes) -> bytes:
+        kdf = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1, backend=default_backend())
+        return kdf.derive(passphrase.encode('utf-8'))
+
+    def save(self):
+        '''
+        将缓存保存到磁盘，使用口令派生的密钥以 AES-GCM 加密。没有口令时拒绝保存，
+        缓存中是可以直接解密文件的派生密钥，不能以明文写入磁盘
+        '''
+        if self.path is None:
+            return
+        if self.passphrase is None:
+            raise Exception('没有设置口令，拒绝将派生密钥以明文保存到 {0}'.format(self.path))
+        with self._lock:
+            data = json.dumps({key: derived.hex() for key, derived in self._keys.items()}).encode('utf-8')
+        salt = os.urandom(KeyCache.SALT_SIZE)
+        nonce = os.urandom(KeyCache.NONCE_SIZE)
+        data = salt + nonce + AESGCM(KeyCache._wrapping_key(self.passphrase, salt)).encrypt(nonce, data, None)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        '''
+        从磁盘加载加密的缓存
+        '''
+        if self.passphrase is None:
+            raise Exception('没有设置口令，无法读取磁盘缓存 {0}'.format(self.path))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        salt = data[:KeyCache.SALT_SIZE]
+        nonce = data[KeyCache.SALT_SIZE:KeyCache.SALT_SIZE + KeyCache.NONCE_SIZE]
+        ciphertext = data[KeyCache.SALT_SIZE + KeyCache.NONCE_SIZE:]
+        data = AESGCM(KeyCache._wrapping_key(self.passphrase, salt)).decrypt(nonce, ciphertext, None)
+        with self._lock:
+            for key, derived in json.loads(data).items():
+                self._keys[key] = bytes.fromhex(derived)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
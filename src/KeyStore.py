@@ -0,0 +1,224 @@
+import base64
+import hashlib
+import os
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+
+
+class KeyStore:
+    KEY_TYPES = ('rsa', 'ed25519')
+    # 公钥单独保存在私钥文件旁边，启动时不需要解密私钥
+    PUBLIC_SUFFIX = '.pub'
+
+    def __init__(self, path: str = None, passphrase: str = None, key_type: str = 'rsa'):
+        '''
+        用户身份密钥的存储。私钥只在第一次使用时加载，文件不存在时才生成
+        :param path: 私钥文件路径（PEM），为 None 时密钥只保存在内存中
+        :param passphrase: 私钥文件的加密口令，为 None 时不加密
+        :param key_type: 生成新密钥时使用的类型，'rsa' 或 'ed25519'（生成与签名都更快）
+        '''
+        if key_type not in KeyStore.KEY_TYPES:
+            raise Exception('不支持的密钥类型 {0}'.format(key_type))
+        self.path = path
+        self.passphrase = passphrase
+        self.key_type = key_type
+        self._private_key = None
+        self._public_pem = None
+        self._public_key_content = None
+        self._fingerprint = None
+
+    @property
+    def public_path(self) -> str:
+        return self.path + KeyStore.PUBLIC_SUFFIX
+
+    def exists(self) -> bool:
+        return self.path is not None and os.path.isfile(self.path)
+
+    @staticmethod
+    def _write_private(path: str, data: bytes):
+        '''
+        原子地写入只有本用户可读的文件
+        '''
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def generate(self):
+        '''
+        生成新的密钥，设置了路径时保存到文件（会覆盖已有的密钥）
+        '''
+        if self.key_type == 'ed25519':
+            private_key = ed25519.Ed25519PrivateKey.generate()
+        else:
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._set_private_key(private_key)
+        if self.path is not None:
+            KeyStore._write_private(self.path, self.private_pem)
+            KeyStore._write_private(self.public_path, self._public_pem)
+        return private_key
+
+    def _set_private_key(self, private_key):
+        self._private_key = private_key
+        self._public_pem = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        self._public_key_content = None
+        self._fingerprint = None
+
+    def load(self):
+        '''
+        从文件加载私钥
+        '''
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        password = self.passphrase.encode('utf-8') if self.passphrase is not None else None
+        try:
+            private_key = serialization.load_pem_private_key(data, password=password)
+        except (TypeError, ValueError):
+            raise Exception('无法加载私钥 {0}，口令错误或文件已损坏'.format(self.path))
+        self._set_private_key(private_key)
+        return private_key
+
+    @property
+    def private_key(self):
+        '''
+        私钥，第一次使用时加载，文件不存在时生成
+        '''
+        if self._private_key is None:
+            if self.exists():
+                self.load()
+            else:
+                self.generate()
+        return self._private_key
+
+    @property
+    def private_pem(self) -> bytes:
+        if self.passphrase is not None:
+            encryption = serialization.BestAvailableEncryption(self.passphrase.encode('utf-8'))
+        else:
+            encryption = serialization.NoEncryption()
+        return self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=encryption
+        )
+
+    @property
+    def public_pem(self) -> bytes:
+        '''
+        公钥，优先读取旁边保存的公钥文件，不需要解密私钥
+        '''
+        if self._public_pem is None:
+            if self.exists() and os.path.isfile(self.public_path):
+                with open(self.public_path, 'rb') as f:
+                    self._public_pem = f.read()
+            else:
+                self.private_key
+        return self._public_pem
+
+    @property
+    def public_key_content(self) -> str:
+        '''
+        链上标记身份使用的公钥：PEM 去掉首尾两行后的 base64 部分
+        '''
+        if self._public_key_content is None:
+            lines = self.public_pem.decode('utf-8').strip().split('\n')
+            self._public_key_content = ''.join(lines[1:-1])
+        return self._public_key_content
+
+    @property
+    def fingerprint(self) -> str:
+        '''
+        公钥指纹，与 Owner 的指纹相同
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha256(self.public_key_content.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    def sign(self, data: bytes) -> bytes:
+        '''
+        使用私钥签名
+        '''
+        private_key = self.private_key
+        if isinstance(private_key, ed25519.Ed25519PrivateKey):
+            return private_key.sign(data)
+        return private_key.sign(data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()),
+                                                  salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+
+    @staticmethod
+    def load_public_key(public_key_content: str):
+        '''
+        由链上的公钥字符串还原公钥对象
+        '''
+        return serialization.load_der_public_key(base64.b64decode(public_key_content))
+
+    @staticmethod
+    def verify(public_key, data: bytes, signature: bytes) -> bool:
+        '''
+        检验签名
+        :param public_key: 公钥对象或链上的公钥字符串
+        '''
+        try:
+            if isinstance(public_key, str):
+                public_key = KeyStore.load_public_key(public_key)
+            if isinstance(public_key, ed25519.Ed25519PublicKey):
+                public_key.verify(signature, data)
+            else:
+                public_key.verify(signature, data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()),
+                                                               salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+            return True
+        except (InvalidSignature, ValueError, TypeError):
+            # 签名不匹配，或公钥无法解析
+            return False
+
+
+if __name__ == '__main__':
+    '''
+    对比冷启动（生成密钥）与热启动（从密钥文件加载）时构造 User 并取得公钥的耗时
+    '''
+    import shutil
+    import tempfile
+    import time
+    from User import User
+
+    workdir = tempfile.mkdtemp()
+    rounds = 5
+
+    def measure(make):
+        costs = []
+        for i in range(rounds):
+            time_start = time.perf_counter()
+            user = make(i)
+            user.public_key_content
+            costs.append(time.perf_counter() - time_start)
+        return sum(costs) / len(costs)
+
+    def sign_once(user):
+        user.keystore.sign(b'startup')
+        return user
+
+    cases = [
+        ('RSA 冷启动（每次生成）', lambda i: User(KeyStore(key_type='rsa'))),
+        ('Ed25519 冷启动（每次生成）', lambda i: User(KeyStore(key_type='ed25519'))),
+    ]
+    for key_type in KeyStore.KEY_TYPES:
+        for passphrase in (None, 'passphrase'):
+            path = os.path.join(workdir, '{0}_{1}.pem'.format(key_type, passphrase))
+            KeyStore(path, passphrase, key_type).generate()
+            name = '{0} 热启动（{1}）'.format('RSA' if key_type == 'rsa' else 'Ed25519',
+                                          '口令保护' if passphrase else '无口令')
+            cases.append((name, lambda i, path=path, passphrase=passphrase: User(KeyStore(path, passphrase))))
+            # 签名时才需要解密私钥
+            cases.append((name + ' + 首次签名', lambda i, path=path, passphrase=passphrase:
+                          sign_once(User(KeyStore(path, passphrase)))))
+
+    for name, make in cases:
+        print('{0}: {1:.2f} ms'.format(name, measure(make) * 1000))
+    shutil.rmtree(workdir)
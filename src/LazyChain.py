@@ -0,0 +1,166 @@
+import mmap
+import os
+from collections import OrderedDict
+import Codec
+from Block import Block
+from BlockStore import BlockStore
+
+
+class LazyBlock(Block):
+    __slots__ = ('_chain', '_height', '_merkle_root', '_data')
+
+    def __init__(self, chain: 'LazyChain', height: int, header: tuple):
+        '''
+        只解析了区块头的区块，区块数据在首次访问时才解码
+        :param chain: 所属的懒加载区块链
+        :param height: 区块高度
+        :param header: Codec.decode_header 的结果
+        '''
+        self._chain = chain
+        self._height = height
+        self._data = None
+        self.timestamp, self.previous_hash, self._merkle_root, self.nonce, self.hash, self.target = header
+
+    @property
+    def data(self):
+        if self._data is None:
+            record = self._chain.read_record(self._height)
+            self._data = Codec.decode_block_data(record, Codec.record_header_size(record))
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def header_prefix(self, refresh: bool = False) -> bytes:
+        # 未解码区块数据时直接使用区块头中记录的默克尔根
+        if not refresh and self._data is None:
+            return Block.pack_header(self.previous_hash, self.timestamp, self._merkle_root, self.target)
+        return Block.header_prefix(self, refresh)
+
+
+class LazyChain:
+    def __init__(self, store: BlockStore, cache_size: int = 256):
+        '''
+        基于内存映射的懒加载区块链视图，可以像区块列表一样使用
+        :param store: 区块存储
+        :param cache_size: 缓存最近访问的区块个数
+        '''
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._file = open(store.log_path, 'rb')
+        self._mmap = None
+        self._mapped_size = 0
+
+    def _view(self, end: int):
+        '''
+        获取至少覆盖到 end 的内存映射，日志增长后重新映射
+        '''
+        if end > self._mapped_size:
+            size = os.path.getsize(self.store.log_path)
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._mmap
+
+    def read_record(self, height: int) -> bytes:
+        '''
+        读取指定高度区块的二进制记录
+        '''
+        offset = self.store.record_offset(height)
+        view = self._view(offset + BlockStore.LENGTH_FORMAT.size)
+        length = BlockStore.LENGTH_FORMAT.unpack_from(view, offset)[0]
+        start = offset + BlockStore.LENGTH_FORMAT.size
+        return self._view(start + length)[start:start + length]
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[height] for height in range(*key.indices(len(self)))]
+        height = key + len(self) if key < 0 else key
+        if not 0 <= height < len(self):
+            raise IndexError('区块高度超出范围')
+        block = self._cache.get(height)
+        if block is None:
+            start = self.store.record_offset(height) + BlockStore.LENGTH_FORMAT.size
+            # 先读出版本号，再按版本确定区块头长度
+            view = self._view(start + Codec.VERSION_SIZE)
+            view = self._view(start + Codec.record_header_size(view, start))
+            header = Codec.decode_header(view, start)
+            block = LazyBlock(self, height, header)
+            self._cache[height] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(height)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def append(self, block: Block):
+        '''
+        追加区块，直接写入区块存储
+        '''
+        self.store.append_block(block)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+if __name__ == '__main__':
+    '''
+    对比完整加载 json 与懒加载区块存储的启动耗时与内存
+        python LazyChain.py [区块数] [每个区块的文件数]
+    '''
+    import shutil
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+    from BlockChain import BlockChain
+    from BlockData import BlockData
+    from FileEntry import FileEntry
+    from Owner import Owner
+
+    block_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    files_per_block = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    workdir = tempfile.mkdtemp()
+    json_path = os.path.join(workdir, 'block_chain.json')
+    store_dir = os.path.join(workdir, 'block_store')
+
+    bc = BlockChain()
+    # 合成的记录没有签名
+    bc.require_signatures = False
+    owners = [Owner.intern('owner-%d' % i) for i in range(50)]
+    for b in range(block_count):
+        data = BlockData()
+        data.files = [FileEntry(owners[(b + i) % len(owners)], '%064x' % (b * files_per_block + i))
+                      for i in range(files_per_block)]
+        bc.chain.append(Block(time.time(), data, bc.chain[-1].hash))
+    bc.save_to_file(json_path)
+    bc.attach_store(store_dir)
+    bc.store.close()
+    tip_hash = bc.get_latest_block().hash
+    del bc
+
+    for name, load in (('json 完整加载', lambda: BlockChain.load_from_file(json_path)),
+                       ('懒加载区块存储', lambda: BlockChain.load_from_store(store_dir, lazy=True))):
+        tracemalloc.start()
+        time_start = time.perf_counter()
+        loaded = load()
+        assert loaded.get_latest_block().hash == tip_hash
+        elapsed = time.perf_counter() - time_start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{0}: 启动并读取最新区块 {1:.3f}s, 峰值内存 {2:.1f} MB'.format(name, elapsed, memory / 2**20))
+        del loaded
+
+    shutil.rmtree(workdir)
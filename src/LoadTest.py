@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from Benchmark import percentile
+
+# 默认的请求组合：操作 -> 权重
+DEFAULT_MIX = 'tip=4,lookup=4,block=2,download=1,upload=1'
+
+
+class Connection:
+    def __init__(self, host: str, port: int):
+        '''
+        保持连接的 HTTP/1.1 客户端连接，被服务端关闭时自动重连
+        '''
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> tuple:
+        '''
+        :return: (状态码, 响应体)
+        '''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write('{0} {1} HTTP/1.1\r\nHost: {2}\r\nContent-Length: {3}\r\n\r\n'.format(
+            method, path, self.host, len(body)).encode('latin-1') + body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            self.close()
+            raise ConnectionError('服务端关闭了连接')
+        status = int(status_line.split()[1])
+        length = 0
+        close = False
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+            elif name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                close = True
+        data = await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class LoadTest:
+    def __init__(self, host: str, port: int, concurrency: int = 32, duration: float = 10.0, mix: dict = None,
+                 size: int = 4096, seed: int = 0):
+        '''
+        对本地服务施加并发负载，统计每秒请求数与延迟百分位数
+        :param concurrency: 并发的客户端（连接）数
+        :param duration: 持续时间（秒）
+        :param mix: 操作 -> 权重，操作为 tip/lookup/block/download/upload
+        :param size: 上传文件的字节数
+        :param seed: 随机种子
+        '''
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.duration = duration
+        self.mix = mix or parse_mix(DEFAULT_MIX)
+        self.size = size
+        self.seed = seed
+        # 预先上传并已上链的文件：[(密文哈希, 文件密码), ...]
+        self.files = []
+
+    async def prepare(self, count: int = 16, timeout: float = 60.0):
+        '''
+        上传 count 个文件并等待它们上链，供查询与下载使用
+        '''
+        rng = random.Random('{0}-prepare'.format(self.seed))
+        connection = Connection(self.host, self.port)
+        try:
+            for _ in range(count):
+                content = rng.randbytes(self.size)
+                status, data = await connection.request('POST', '/files', content)
+                if status != 202:
+                    raise Exception('预先上传失败: {0} {1}'.format(status, data.decode('utf-8')))
+                # 文件密码即明文哈希，由客户端自行计算，服务不返回
+                self.files.append((json.loads(data)['File'], hashlib.sha256(content).hexdigest()))
+            deadline = time.perf_counter() + timeout
+            for file_enc_hash, _ in self.files:
+                while (await connection.request('GET', '/files/' + file_enc_hash))[0] != 200:
+                    if time.perf_counter() > deadline:
+                        raise Exception('等待文件上链超时')
+                    await asyncio.sleep(0.05)
+        finally:
+            connection.close()
+
+    async def _client(self, number: int, deadline: float, samples: list):
+        rng = random.Random('{0}-client-{1}'.format(self.seed, number))
+        operations = list(self.mix)
+        weights = [self.mix[operation] for operation in operations]
+        connection = Connection(self.host, self.port)
+        height = 0
+        try:
+            while time.perf_counter() < deadline:
+                operation = rng.choices(operations, weights)[0]
+                file_enc_hash, key = rng.choice(self.files)
+                if operation == 'tip':
+                    args = ('GET', '/tip')
+                elif operation == 'lookup':
+                    args = ('GET', '/files/' + file_enc_hash)
+                elif operation == 'block':
+                    args = ('GET', '/blocks/{0}'.format(rng.randint(0, height)))
+                elif operation == 'download':
+                    args = ('GET', '/files/{0}/content?key={1}'.format(file_enc_hash, key))
+                else:
+                    args = ('POST', '/files', rng.randbytes(self.size))
+                time_start = time.perf_counter()
+                try:
+                    status, data = await connection.request(*args)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    status, data = 0, b''
+                samples.append((operation, time.perf_counter() - time_start, status < 400 and status != 0))
+                if operation == 'tip' and status == 200:
+                    height = json.loads(data)['Height']
+        finally:
+            connection.close()
+
+    async def run(self) -> dict:
+        '''
+        :return: 各操作及总计的请求数、错误数、每秒请求数与延迟百分位数（秒）
+        '''
+        if not self.files:
+            await self.prepare()
+        samples = []
+        time_start = time.perf_counter()
+        deadline = time_start + self.duration
+        await asyncio.gather(*(self._client(i, deadline, samples) for i in range(self.concurrency)))
+        elapsed = time.perf_counter() - time_start
+
+        results = {}
+        for operation in list(self.mix) + ['total']:
+            selected = [(latency, ok) for op, latency, ok in samples if operation in ('total', op)]
+            latencies = sorted(latency for latency, _ in selected)
+            results[operation] = {
+                'Requests': len(selected),
+                'Errors': sum(1 for _, ok in selected if not ok),
+                'RPS': len(selected) / elapsed,
+                'P50': percentile(latencies, 0.5),
+                'P90': percentile(latencies, 0.9),
+                'P99': percentile(latencies, 0.99),
+                'Max': latencies[-1] if latencies else 0.0,
+            }
+        return {
+            'Meta': {
+                'Time': time.time(),
+                'Concurrency': self.concurrency,
+                'Duration': elapsed,
+                'Mix': self.mix,
+                'Size': self.size,
+                'Seed': self.seed,
+            },
+            'Results': results,
+        }
+
+
+def parse_mix(text: str) -> dict:
+    '''
+    解析 "tip=4,upload=1" 形式的请求组合
+    '''
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in ('tip', 'lookup', 'block', 'download', 'upload'):
+            raise Exception('未知的操作 {0}'.format(operation))
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def spawn_service(workdir: str, args: list = None) -> tuple:
+    '''
+    在临时目录中使用新的区块链与密钥启动服务进程
+    :return: (进程, 端口)
+    '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, 'Service.py', '--port', str(port),
+               '--chain', os.path.join(workdir, 'block_chain.json'),
+               '--key', os.path.join(workdir, 'user.pem'),
+               '--upload-dir', os.path.join(workdir, 'upload_data') + '/',
+               '--incoming-dir', os.path.join(workdir, 'incoming') + '/',
+               # 较快的密钥派生，负载测试不被 KDF 主导
+               '--kdf', 'pbkdf2-sha256-fast'] + (args or [])
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 30
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, port
+        except OSError:
+            if process.poll() is not None or time.perf_counter() > deadline:
+                process.kill()
+                raise Exception('服务进程启动失败')
+            time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    '''
+    对本地服务进行负载测试，结果以 json 输出
+        python LoadTest.py [--port 8080] [--concurrency 32] [--duration 10] [--mix tip=4,upload=1,...]
+        python LoadTest.py --spawn        在临时目录中启动一个新的服务进程并测试
+    '''
+    parser = argparse.ArgumentParser(description='服务负载测试')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--spawn', action='store_true', help='启动临时的服务进程')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--size', type=int, default=4096, help='上传文件的字节数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='结果 json 文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    process = workdir = None
+    host, port = args.host, args.port
+    if args.spawn:
+        workdir = tempfile.mkdtemp()
+        process, port = spawn_service(workdir)
+        host = '127.0.0.1'
+    try:
+        test = LoadTest(host, port, args.concurrency, args.duration, parse_mix(args.mix), args.size, args.seed)
+        result = asyncio.run(test.run())
+    finally:
+        if process is not None:
+            # 服务收到中断后打包剩余记录再退出
+            process.send_signal(signal.SIGINT)
+            process.wait(timeout=60)
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    else:
+        print(json.dumps(result, indent=4))
+    for operation, summary in result['Results'].items():
+        print('{0:<10} {1:>8.1f} 次/秒  P50 {2:.1f} ms  P99 {3:.1f} ms  错误 {4}'.format(
+            operation, summary['RPS'], summary['P50'] * 1e3, summary['P99'] * 1e3, summary['Errors']),
+            file=sys.stderr)
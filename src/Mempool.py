@@ -0,0 +1,389 @@
+import contextlib
+import os
+import threading
+import time
+from collections import deque
+from functools import partial
+from Block import Block
+from BlockChain import BlockChain
+from BlockData import BlockData
+from ChainLock import ChainLock
+from FileEntry import FileEntry
+from Owner import Owner
+
+
+class Mempool:
+    def __init__(self, block_chain: BlockChain, max_entries: int = 10000, block_size: int = 1000,
+                 max_wait: float = 2.0, on_commit=None, block_chain_file_path: str = None,
+                 max_retries: int = 1000):
+        '''
+        待打包的文件记录池。多个用户的上传先进入池中，达到数量阈值或等待时间阈值后由出块线程打包为一个区块
+        :param block_chain: 出块的区块链
+        :param max_entries: 池中最多的待打包记录数，超出时拒绝提交（背压）
+        :param block_size: 池中记录数达到该值时立即出块
+        :param max_wait: 最早的记录等待超过该时间（秒）时出块
+        :param on_commit: 出块后的回调 on_commit(block)，例如保存区块链，在追加区块的锁中调用。
+                          回调失败时区块从内存中移除，记录放回池中
+        :param block_chain_file_path: 与其他写入者（如 BlockChain.commit_block）共享的区块链文件或区块存储目录。
+                                      设置时在该文件的 ChainLock 中读取其他写入者的新区块、检查最新区块后追加，
+                                      保存仍由 on_commit 完成
+        :param max_retries: 最新区块在挖矿期间改变时最多重新挖矿的次数
+        '''
+        self.block_chain = block_chain
+        self.max_entries = max_entries
+        self.block_size = block_size
+        self.max_wait = max_wait
+        self.on_commit = on_commit
+        self.block_chain_file_path = block_chain_file_path
+        self.max_retries = max_retries
+        # (密文哈希, 所有者) -> (记录, 提交时间)，保持提交顺序
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # 出块线程追加区块时持有，提交时的链上查重也需要持有
+        self._chain_lock = threading.Lock()
+        # 出块（取出记录并追加区块）时持有，flush() 与出块线程依次出块，区块中的记录保持提交顺序
+        self._seal_lock = threading.Lock()
+        self._producer = None
+        self._running = False
+
+        self.submitted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.blocks = 0
+        self.committed = 0
+        self.retries = 0
+        self.failures = 0
+        self.max_depth = 0
+        # 最近提交到出块之间的延迟
+        self.latencies = deque(maxlen=10000)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def chain_lock(self) -> threading.Lock:
+        '''
+        追加区块时持有的锁，其他线程读取区块链与索引时也需要持有
+        '''
+        return self._chain_lock
+
+    def submit_entry(self, entry: FileEntry, store=None) -> bool:
+        '''
+        提交一条文件记录，签名不合法（或区块链要求签名而记录没有签名）时拒绝
+        :param store: 记录通过检查后、加入池中之前调用的函数，例如存储密文；被拒绝或重复的记录不会调用
+        :return: 是否加入池中，池中或链上已有相同记录时返回 False
+        '''
+        if self.block_chain.first_bad_entry([entry]) is not None:
+            self.rejected += 1
+            raise Exception('文件记录 {0} 的签名不合法'.format(entry.file))
+        key = (entry.file, entry.owner.key)
+        with self._chain_lock:
+            on_chain = self.block_chain.index.is_owner(entry.file, entry.owner.key)
+            with self._lock:
+                if on_chain or key in self._pending:
+                    self.duplicates += 1
+                    return False
+                if len(self._pending) >= self.max_entries:
+                    self.rejected += 1
+                    raise Exception('待打包的记录已达上限 {0}，请稍后再提交'.format(self.max_entries))
+                if store is not None:
+                    store()
+                self._pending[key] = (entry, time.perf_counter())
+                self.submitted += 1
+                self.max_depth = max(self.max_depth, len(self._pending))
+                # 池由空变为非空时出块线程需要开始计算等待时间
+                if len(self._pending) >= self.block_size or len(self._pending) == 1:
+                    self._changed.notify()
+                return True
+
+    def submit_files(self, file_path_list: list, author_hash_str: str, file_keys: dict = None,
+                     signer=None) -> list:
+        '''
+        加密文件并提交记录，与 BlockChain.upload_files 相同地去重存储密文，但不立即出块
+        :param file_keys: 设置时记录 密文哈希 -> 文件密码（明文哈希）
+        :param signer: 上传者的签名函数，设置时对每条记录签名
+        :return: 各文件的密文哈希
+        '''
+        if len(self._pending) >= self.max_entries:
+            # 加密之前先检查，避免满载时做无用功
+            self.rejected += 1
+            raise Exception('待打包的记录已达上限 {0}，请稍后再提交'.format(self.max_entries))
+        ingest = self.ingest_function()
+        file_enc_hashes = []
+        for file_path in file_path_list:
+            result = ingest(file_path)
+            self.submit_ingested(file_path, result, author_hash_str, file_keys, signer)
+            file_enc_hashes.append(result['File'])
+        return file_enc_hashes
+
+    def ingest_function(self):
+        '''
+        区块链使用的加密函数，可在工作进程中执行，返回格式见 BlockData.ingest_file
+        '''
+        chain = self.block_chain
+        if chain.chunk_store is None:
+            return partial(BlockData.ingest_file, kdf=chain.kdf)
+        return chain.chunk_store.ingest_file
+
+    def submit_ingested(self, file_path: str, result: dict, author_hash_str: str, file_keys: dict = None,
+                        signer=None) -> bool:
+        '''
+        提交已加密的文件：去重存储密文，签名并提交记录
+        :param result: ingest_function() 对 file_path 的结果
+        :return: 是否加入池中
+        '''
+        chain = self.block_chain
+        file_enc_hash = result['File']
+        if file_keys is not None:
+            file_keys[file_enc_hash] = result['Key']
+        entry = FileEntry(Owner.intern(author_hash_str), file_enc_hash)
+        if signer is not None:
+            entry.sign(signer)
+        store = None
+        if chain.chunk_store is None:
+            # 记录通过检查后才存储密文，被拒绝的记录不在共享存储空间中留下无引用的密文。
+            # 不在池中记录已存储的密文：相同的密文再次移入只会覆盖为相同的内容，池的内存不随上传次数增长
+            store = partial(chain._store_if_new, file_path, file_enc_hash, set())
+        return self.submit_entry(entry, store)
+
+    def _take(self, limit: int) -> list:
+        '''
+        取出最早提交的至多 limit 条记录，调用时需持有 self._lock
+        '''
+        taken = []
+        for key in list(self._pending)[:limit]:
+            taken.append(self._pending.pop(key))
+        return taken
+
+    def _ready(self) -> bool:
+        if len(self._pending) >= self.block_size:
+            return True
+        if not self._pending:
+            return False
+        oldest = next(iter(self._pending.values()))[1]
+        return time.perf_counter() - oldest >= self.max_wait
+
+    def _requeue(self, taken: list):
+        '''
+        出块失败时将取出的记录按原顺序放回池首，调用时不能持有 self._lock
+        '''
+        with self._lock:
+            pending = {(entry.file, entry.owner.key): (entry, submitted) for entry, submitted in taken}
+            pending.update(self._pending)
+            self._pending = pending
+
+    def _take_and_seal(self):
+        '''
+        取出最早的一批记录并出块，出块失败时放回记录并抛出异常
+        :return: 产生的区块，池为空时返回 None
+        '''
+        with self._seal_lock:
+            with self._lock:
+                taken = self._take(self.block_size)
+            if not taken:
+                return None
+            try:
+                return self._seal(taken)
+            except BaseException:
+                self._requeue(taken)
+                with self._lock:
+                    self.failures += 1
+                raise
+
+    def flush(self):
+        '''
+        立即将池中所有记录打包出块，可以与出块线程同时调用
+        :return: 产生的区块列表
+        '''
+        blocks = []
+        while True:
+            block = self._take_and_seal()
+            if block is None:
+                return blocks
+            blocks.append(block)
+
+    def _seal(self, taken: list) -> Block:
+        '''
+        挖矿在锁外进行，加锁后检查最新区块未改变时追加，否则（如其他写入者提交了区块）在新的最新区块上重新挖矿
+        '''
+        blockdata = BlockData()
+        blockdata.files = [entry for entry, _ in taken]
+        path = self.block_chain_file_path
+        for _ in range(self.max_retries + 1):
+            with self._chain_lock:
+                block = self.block_chain.new_block(blockdata)
+            block.mine_block()
+            file_lock = ChainLock.for_chain_file(path) if path is not None else contextlib.nullcontext()
+            with self._chain_lock, file_lock:
+                if path is not None and os.path.exists(path):
+                    self.block_chain._refresh(path, persist_migration=False)
+                if self.block_chain.get_latest_block().hash == block.previous_hash:
+                    self.block_chain.add_block(block)
+                    if self.on_commit is not None:
+                        try:
+                            self.on_commit(block)
+                        except BaseException:
+                            # 未保存的区块从内存中移除，记录由 _take_and_seal 放回池中重新出块。
+                            # 否则之后读取其他写入者修改的文件时，区块与其中的记录会被丢弃
+                            self.block_chain.chain.pop()
+                            raise
+                    break
+            self.retries += 1
+        else:
+            raise Exception('出块失败：最新区块持续变化，已重试 {0} 次'.format(self.max_retries))
+        now = time.perf_counter()
+        with self._lock:
+            self.blocks += 1
+            self.committed += len(taken)
+            self.latencies.extend(now - submitted for _, submitted in taken)
+        return block
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running and not self._ready():
+                    timeout = None
+                    if self._pending:
+                        oldest = next(iter(self._pending.values()))[1]
+                        timeout = max(0.0, oldest + self.max_wait - time.perf_counter())
+                    self._changed.wait(timeout)
+                if not self._running:
+                    break
+            try:
+                self._take_and_seal()
+            except Exception as e:
+                # 记录已放回池中，出块线程继续运行，等待一段时间后重试
+                print('出块失败，稍后重试: {0}'.format(e))
+                with self._lock:
+                    self._changed.wait(max(self.max_wait, 0.1))
+        # 停止时打包剩余的记录
+        self.flush()
+
+    def start(self):
+        '''
+        启动后台出块线程
+        '''
+        if self._producer is not None:
+            return
+        self._running = True
+        self._producer = threading.Thread(target=self._run, name='mempool-producer', daemon=True)
+        self._producer.start()
+
+    def stop(self):
+        '''
+        停止出块线程，并打包剩余的记录
+        '''
+        if self._producer is None:
+            return
+        with self._lock:
+            self._running = False
+            self._changed.notify_all()
+        self._producer.join()
+        self._producer = None
+
+    def metrics(self) -> dict:
+        '''
+        队列深度与提交延迟（提交到出块的时间，秒）统计
+        '''
+        with self._lock:
+            latencies = sorted(self.latencies)
+            depth = len(self._pending)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'Depth': depth,
+            'Max Depth': self.max_depth,
+            'Submitted': self.submitted,
+            'Duplicates': self.duplicates,
+            'Rejected': self.rejected,
+            'Blocks': self.blocks,
+            'Committed': self.committed,
+            'Retries': self.retries,
+            'Failures': self.failures,
+            'Latency Mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'Latency P50': percentile(0.5),
+            'Latency P95': percentile(0.95),
+            'Latency Max': latencies[-1] if latencies else 0.0,
+        }
+
+
+if __name__ == '__main__':
+    '''
+    多个用户并发上传小文件，对比每次上传出一个块与记录池批量出块
+        python Mempool.py [用户数] [每个用户的上传次数]
+    '''
+    import io
+    import json
+    import shutil
+    import sys
+    import tempfile
+
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    uploads_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    workdir = tempfile.mkdtemp()
+    BlockData.key_cache.max_entries = 0
+
+    def make_chain(name):
+        chain = BlockChain()
+        # 合成的记录没有签名
+        chain.require_signatures = False
+        # 使用较快的密钥派生，突出出块与保存的开销
+        chain.kdf = 'pbkdf2-sha256-fast'
+        chain.upload_dir = os.path.join(workdir, name, 'upload_data') + '/'
+        os.makedirs(chain.upload_dir)
+        return chain
+
+    def make_files(name):
+        # 每个用户各自的小文件，其中一部分与其他用户相同
+        paths = []
+        for u in range(user_count):
+            for i in range(uploads_per_user):
+                path = os.path.join(workdir, name, 'user%d_file%d' % (u, i))
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(2048) if i % 5 else b'shared %d' % i)
+                paths.append((u, path))
+        return paths
+
+    # 原有方式：每次上传挖矿出块并保存整条链
+    chain = make_chain('immediate')
+    json_path = os.path.join(workdir, 'immediate', 'block_chain.json')
+    files = make_files('immediate')
+    time_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for u, path in files:
+            chain.upload_files([path], 'user-%d' % u)
+            chain.save_to_file(json_path)
+    elapsed = time.perf_counter() - time_start
+    print('每次上传出块: {0} 次上传, {1} 个区块, 耗时 {2:.3f}s'.format(len(files), len(chain.chain) - 1, elapsed))
+
+    # 记录池：多个用户线程并发提交，出块线程按阈值出块后保存
+    chain = make_chain('mempool')
+    json_path = os.path.join(workdir, 'mempool', 'block_chain.json')
+    files = make_files('mempool')
+    pool = Mempool(chain, block_size=64, max_wait=0.05, on_commit=lambda block: chain.save_to_file(json_path),
+                   block_chain_file_path=json_path)
+
+    def upload(u):
+        for user, path in files:
+            if user == u:
+                pool.submit_files([path], 'user-%d' % u)
+
+    time_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool.start()
+        threads = [threading.Thread(target=upload, args=(u,)) for u in range(user_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.stop()
+    elapsed = time.perf_counter() - time_start
+    print('记录池批量出块: {0} 次上传, {1} 个区块, 耗时 {2:.3f}s'.format(len(files), len(chain.chain) - 1, elapsed))
+    print(json.dumps(pool.metrics(), indent=4))
+    print('区块链检验:', chain.verify_blockchain(full=True))
+    shutil.rmtree(workdir)
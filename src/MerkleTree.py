@@ -0,0 +1,65 @@
+import hashlib
+
+# 叶子与内部节点使用不同前缀，防止把内部节点伪造成叶子
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(data: bytes) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+
+def hash_node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree:
+    # 空树的根
+    EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+    def __init__(self, leaves: list):
+        '''
+        由叶子数据构建默克尔树。某一层节点数为奇数时，最后一个节点直接提升到上一层
+        :param leaves: 叶子数据（bytes）列表
+        '''
+        self.levels = [[hash_leaf(leaf) for leaf in leaves]]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parent = [hash_node(level[i], level[i+1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2 == 1:
+                parent.append(level[-1])
+            self.levels.append(parent)
+
+    def root(self) -> bytes:
+        '''
+        默克尔根，32 字节
+        '''
+        if len(self.levels[0]) == 0:
+            return MerkleTree.EMPTY_ROOT
+        return self.levels[-1][0]
+
+    def proof(self, index: int) -> list:
+        '''
+        生成第 index 个叶子的包含证明
+        :return: 从叶子到根的兄弟节点列表，每项为 ('L' 或 'R', 兄弟节点哈希)，'L' 表示兄弟在左侧
+        '''
+        path = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                path.append(('L' if sibling < index else 'R', level[sibling]))
+            index //= 2
+        return path
+
+    @staticmethod
+    def verify(leaf: bytes, path: list, root: bytes) -> bool:
+        '''
+        检验包含证明
+        :param leaf: 叶子数据
+        :param path: proof 返回的兄弟节点列表
+        :param root: 期望的默克尔根
+        '''
+        node = hash_leaf(leaf)
+        for side, sibling in path:
+            node = hash_node(sibling, node) if side == 'L' else hash_node(node, sibling)
+        return node == root
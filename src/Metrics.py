@@ -0,0 +1,390 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        '''
+        以 2 的幂为桶边界的直方图，内存占用与取值范围的数量级成正比，与观测次数无关
+        :param buckets: 指数 e -> 落在 [2^(e-1), 2^e) 中的观测次数，非正数记在 None 中
+        '''
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = {}
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        bucket = math.frexp(value)[1] if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p: float) -> float:
+        '''
+        估计百分位数：所在桶的上界，不超过观测到的最大值
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -math.inf if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0.0 if bucket is None else min(math.ldexp(1.0, bucket), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'Count': self.count,
+            'Sum': self.total,
+            'Mean': self.total / self.count if self.count else 0.0,
+            'Min': self.min if self.count else 0.0,
+            'Max': self.max if self.count else 0.0,
+            'P50': self.percentile(0.5),
+            'P90': self.percentile(0.9),
+            'P99': self.percentile(0.99),
+        }
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'path', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        stack = self.metrics._stack()
+        # 嵌套的阶段以路径命名，例如 upload/encrypt/kdf
+        self.path = stack[-1] + '/' + self.name if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        self.metrics._stack().pop()
+        self.metrics._observe(self.metrics.spans, self.path, elapsed)
+
+
+class _NullSpan:
+    '''
+    关闭统计时使用的空阶段，所有 span 共享同一个实例
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, thread_id: int = None):
+        '''
+        采样分析器：后台线程定时记录目标线程的调用栈，开销与采样间隔有关，与被分析代码的调用次数无关
+        :param interval: 采样间隔（秒）
+        :param thread_id: 目标线程，默认为调用 start 的线程
+        '''
+        self.interval = interval
+        self.thread_id = thread_id
+        # 折叠的调用栈 "外层;...;内层" -> 采样次数
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return '{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(SamplingProfiler._frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, limit: int = 10) -> list:
+        '''
+        采样次数最多的函数
+        :return: [(函数, 位于栈顶的次数, 位于栈中的次数), ...]，按位于栈中的次数排列
+        '''
+        own = Counter()
+        total = Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(frame, own[frame], count) for frame, count in total.most_common(limit)]
+
+    def write_collapsed(self, path: str):
+        '''
+        以折叠调用栈格式（每行 "栈 次数"）保存，可直接用 flamegraph 工具生成火焰图
+        '''
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        '''
+        计数器、直方图与嵌套阶段耗时的统计。关闭时所有记录方法立即返回
+            with metrics.span('upload'):
+                ...
+        :param enabled: 是否开启统计
+        '''
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        # 阶段路径 -> 耗时（秒）的直方图
+        self.spans = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._server = None
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _observe(self, table: dict, name: str, value: float):
+        with self._lock:
+            histogram = table.get(name)
+            if histogram is None:
+                histogram = table[name] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1):
+        '''
+        计数器加 value
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        '''
+        在直方图中记录一次观测
+        '''
+        if not self.enabled:
+            return
+        self._observe(self.histograms, name, value)
+
+    def span(self, name: str):
+        '''
+        记录一个阶段的耗时，在其他阶段之内时记为其子阶段
+        '''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.spans = {}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'Time': time.time(),
+                'Counters': dict(self.counters),
+                'Histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                'Spans': {path: histogram.to_dict() for path, histogram in self.spans.items()},
+            }
+
+    def to_text(self) -> str:
+        '''
+        便于阅读与 grep 的文本格式，每行一个数值
+        '''
+        data = self.to_dict()
+        lines = []
+        for name, value in sorted(data['Counters'].items()):
+            lines.append('counter {0} {1}'.format(name, value))
+        for kind, table in (('histogram', data['Histograms']), ('span', data['Spans'])):
+            for name, summary in sorted(table.items()):
+                for field in ('Count', 'Sum', 'Mean', 'P50', 'P90', 'P99', 'Max'):
+                    lines.append('{0} {1} {2} {3:.6g}'.format(kind, name, field.lower(), summary[field]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        '''
+        导出到文件，扩展名为 .json 时为 json，否则为文本格式
+        '''
+        content = json.dumps(self.to_dict(), indent=4) if path.endswith('.json') else self.to_text()
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int = 9464, host: str = '127.0.0.1'):
+        '''
+        在后台线程中启动本地 HTTP 端点：/metrics 为文本格式，/metrics.json 为 json
+        :return: 实际监听的端口（port 为 0 时随机选择）
+        '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.to_dict()), 'application/json'
+                elif self.path == '/metrics':
+                    body, content_type = metrics.to_text(), 'text/plain; charset=utf-8'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        return self._server.server_address[1]
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def profile(self, path: str = None, interval: float = 0.005) -> SamplingProfiler:
+        '''
+        对一段代码（例如一次批量上传）开启采样分析，与统计是否开启无关
+            with metrics.profile('upload.folded') as profiler:
+                ...
+        :param path: 设置时结束后将折叠调用栈保存到该文件
+        '''
+        metrics = self
+
+        class _Profile(SamplingProfiler):
+            def __exit__(self, exc_type, exc_value, traceback):
+                SamplingProfiler.__exit__(self, exc_type, exc_value, traceback)
+                if path is not None:
+                    self.write_collapsed(path)
+                metrics.inc('profile.samples', sum(self.samples.values()))
+
+        return _Profile(interval)
+
+
+# 进程内共享的统计，设置环境变量 SBC_METRICS=1 或 metrics.enabled = True 时开启
+metrics = Metrics(enabled=os.environ.get('SBC_METRICS') == '1')
+
+
+if __name__ == '__main__':
+    '''
+    统计关闭与开启时每个阶段的开销，以及一次上传各阶段的耗时和批量上传的采样分析结果
+        python Metrics.py [导出文件.json|导出文件.txt]
+    '''
+    import contextlib
+    import io
+    import shutil
+    import tempfile
+    import urllib.request
+    from BlockChain import BlockChain
+    # 使用其他模块导入的同一个实例，而不是 __main__ 中新建的
+    from Metrics import metrics, SamplingProfiler
+
+    calls = 200000
+    time_start = time.perf_counter()
+    for _ in range(calls):
+        pass
+    baseline = time.perf_counter() - time_start
+    for enabled in (False, True):
+        metrics.enabled = enabled
+        time_start = time.perf_counter()
+        for _ in range(calls):
+            with metrics.span('noop'):
+                pass
+        elapsed = time.perf_counter() - time_start - baseline
+        print('统计{0}时每个阶段的开销: {1:.0f} ns'.format('开启' if enabled else '关闭', elapsed / calls * 1e9))
+    metrics.reset()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        bc = BlockChain()
+        # 合成的记录没有签名
+        bc.require_signatures = False
+        bc.kdf = 'pbkdf2-sha256-fast'
+        bc.upload_dir = os.path.join(workdir, 'upload_data') + '/'
+        os.makedirs(bc.upload_dir)
+        paths = []
+        for i in range(20):
+            paths.append(os.path.join(workdir, 'file%d' % i))
+            with open(paths[-1], 'wb') as f:
+                # 每 4 个文件内容相同，用于去重
+                f.write(os.urandom(1 << 20) if i % 4 else b'duplicate' * 100000)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            for path in paths[:10]:
+                bc.upload_files([path], 'metrics-owner')
+            bc.save_to_file(os.path.join(workdir, 'block_chain.json'), save_index=True)
+            folded_path = os.path.join(workdir, 'upload.folded')
+            bc.upload_files_batch(paths[10:], 'metrics-owner', workers=1, profile_path=folded_path)
+
+        port = metrics.serve(0)
+        with urllib.request.urlopen('http://127.0.0.1:{0}/metrics'.format(port)) as response:
+            print(response.read().decode('utf-8'))
+        metrics.shutdown()
+
+        profiler = SamplingProfiler()
+        with open(folded_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                profiler.samples[stack] = int(count)
+        print('批量上传采样 {0} 次，耗时最多的函数:'.format(sum(profiler.samples.values())))
+        for frame, own, total in profiler.top(10):
+            print('  {0:<50} 栈顶 {1:>5}  栈中 {2:>5}'.format(frame, own, total))
+
+        if len(sys.argv) > 1:
+            metrics.write(sys.argv[1])
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,310 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# nonce 以 8 字节大端无符号整数追加在区块头末尾
+NONCE_FORMAT = struct.Struct('>Q')
+MAX_NONCE = 2**64 - 1
+MAX_HASH = 2**256 - 1
+
+# 进程池中每个工作进程持有的停止信号，由 _init_worker 设置
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    '''
+    工作进程初始化，保存共享的停止信号
+    '''
+    global _stop_event
+    _stop_event = stop_event
+
+
+def search_nonce_range(prefix: bytes, target: int, start: int, count: int, stop_event=None, check_interval: int = 4096):
+    '''
+    在 [start, start+count) 区间内搜索使区块头哈希小于 target 的 nonce
+    :param prefix: 区块头中除 nonce 以外的固定部分
+    :param target: 256 位目标值，哈希（按大端整数）必须小于该值
+    :param start: 起始 nonce
+    :param count: 搜索的 nonce 个数
+    :param stop_event: 停止信号，其他进程找到结果后被置位
+    :param check_interval: 每隔多少次尝试检查一次停止信号
+    :return: (nonce, 哈希十六进制字符串, 尝试次数)，未找到时 nonce 与哈希为 None
+    '''
+    end = min(start + count, MAX_NONCE + 1)
+    if target > MAX_HASH:
+        # 难度为 0 时任何哈希都满足要求
+        digest = hashlib.sha256(prefix + NONCE_FORMAT.pack(start)).hexdigest()
+        return start, digest, 1
+    target_bytes = target.to_bytes(32, 'big')
+
+    # 固定前缀只哈希一次，之后每次尝试复制该中间状态
+    midstate = hashlib.sha256(prefix)
+    pack = NONCE_FORMAT.pack
+    nonce = start
+    while nonce < end:
+        if stop_event is not None and stop_event.is_set():
+            break
+        batch_end = min(nonce + check_interval, end)
+        for n in range(nonce, batch_end):
+            h = midstate.copy()
+            h.update(pack(n))
+            digest = h.digest()
+            # 等长字节串的字典序比较即大端整数比较
+            if digest < target_bytes:
+                return n, digest.hex(), n - start + 1
+        nonce = batch_end
+    return None, None, nonce - start
+
+
+def _worker_search(prefix: bytes, target: int, start: int, count: int):
+    return search_nonce_range(prefix, target, start, count, _stop_event)
+
+
+class MineResult:
+    def __init__(self, nonce: int, hash: str, attempts: int, elapsed: float):
+        '''
+        一次挖矿的结果
+        :param nonce: 找到的 nonce
+        :param hash: 区块哈希
+        :param attempts: 总尝试次数
+        :param elapsed: 耗时（秒）
+        '''
+        self.nonce = nonce
+        self.hash = hash
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    @property
+    def hashrate(self) -> float:
+        '''
+        每秒计算的哈希次数
+        '''
+        return self.attempts / self.elapsed if self.elapsed > 0 else float(self.attempts)
+
+
+class Miner:
+    # 各区块共享的默认矿工，进程池只创建一次
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, workers: int = None, chunk_size: int = 1 << 16, probe_size: int = 1 << 12):
+        '''
+        多进程工作量证明矿工
+        :param workers: 工作进程数，默认为 CPU 核数
+        :param chunk_size: 每个任务搜索的 nonce 个数
+        :param probe_size: 启动进程池之前先在本进程中尝试的 nonce 个数，低难度时无需启动进程池
+        '''
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.probe_size = probe_size
+        self.last_result = None
+        self._executor = None
+        self._stop_event = None
+        # 进程池与停止信号只有一份，出块线程、提交区块与服务线程可能同时挖矿，依次使用进程池
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> 'Miner':
+        '''
+        获取默认矿工
+        '''
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @staticmethod
+    def difficulty_to_target(difficulty: int) -> int:
+        '''
+        将“前导十六进制 0 的个数”表示的难度转换为 256 位目标值
+        '''
+        return 1 << (256 - 4 * difficulty)
+
+    @staticmethod
+    def retarget(target: int, actual_time: float, expected_time: float, max_factor: int = 4) -> int:
+        '''
+        按实际出块时间调整目标值：出块过快时目标值变小（难度变大），过慢时变大
+        :param target: 当前目标值
+        :param actual_time: 最近一个调整周期实际经过的时间
+        :param expected_time: 一个调整周期期望经过的时间
+        :param max_factor: 单次调整的最大倍数，限制时间戳异常的影响
+        '''
+        actual_time = min(max(actual_time, expected_time / max_factor), expected_time * max_factor)
+        # 以微秒为单位做整数运算，避免 256 位整数转换为浮点数时丢失精度
+        new_target = target * int(actual_time * 1e6) // max(1, int(expected_time * 1e6))
+        return max(1, min(new_target, MAX_HASH))
+
+    @staticmethod
+    def target_work(target: int) -> int:
+        '''
+        满足目标值的期望尝试次数，即一个区块代表的工作量
+        '''
+        return (1 << 256) // (target + 1)
+
+    @staticmethod
+    def suggest_difficulty(hashrate: float, block_time: float) -> int:
+        '''
+        根据算力与期望出块时间给出难度，期望尝试次数为 16^difficulty
+        :param hashrate: 每秒哈希次数
+        :param block_time: 期望出块时间（秒）
+        '''
+        expected = hashrate * block_time
+        if expected <= 1:
+            return 0
+        return int(math.log(expected, 16))
+
+    def mine(self, prefix: bytes, target: int, start_nonce: int = 0) -> MineResult:
+        '''
+        搜索满足目标值的 nonce
+        :param prefix: 区块头中除 nonce 以外的固定部分
+        :param target: 256 位目标值
+        :param start_nonce: 起始 nonce
+        :return: 挖矿结果
+        '''
+        with self._lock:
+            return self._mine(prefix, target, start_nonce)
+
+    def _mine(self, prefix: bytes, target: int, start_nonce: int) -> MineResult:
+        time_start = time.time()
+        nonce, block_hash, attempts = search_nonce_range(prefix, target, start_nonce, self.probe_size)
+        next_start = start_nonce + self.probe_size
+        if nonce is None:
+            if self.workers > 1:
+                nonce, block_hash, extra = self._mine_parallel(prefix, target, next_start)
+                attempts += extra
+            else:
+                while nonce is None:
+                    if next_start > MAX_NONCE:
+                        raise Exception('nonce 空间已耗尽，未能挖到区块')
+                    nonce, block_hash, count = search_nonce_range(prefix, target, next_start, self.chunk_size)
+                    next_start += self.chunk_size
+                    attempts += count
+
+        self.last_result = MineResult(nonce, block_hash, attempts, time.time() - time_start)
+        return self.last_result
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._stop_event = multiprocessing.Event()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_init_worker,
+                                                 initargs=(self._stop_event,))
+        return self._executor
+
+    def _mine_parallel(self, prefix: bytes, target: int, start: int):
+        '''
+        将 nonce 区间分片提交到进程池，任一进程找到结果后通知其余进程停止
+        '''
+        executor = self._get_executor()
+        self._stop_event.clear()
+        pending = set()
+        next_start = start
+        attempts = 0
+        found = None
+
+        def submit():
+            nonlocal next_start
+            if next_start <= MAX_NONCE:
+                pending.add(executor.submit(_worker_search, prefix, target, next_start, self.chunk_size))
+                next_start += self.chunk_size
+
+        # 每个进程保持两个任务在队列中，避免任务切换时空闲
+        for _ in range(self.workers * 2):
+            submit()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                nonce, block_hash, count = future.result()
+                attempts += count
+                if nonce is not None and (found is None or nonce < found[0]):
+                    found = (nonce, block_hash)
+            if found is not None:
+                break
+            for _ in done:
+                submit()
+
+        if found is None:
+            raise Exception('nonce 空间已耗尽，未能挖到区块')
+
+        # 提前结束：取消尚未开始的任务，正在运行的任务看到停止信号后很快返回
+        self._stop_event.set()
+        for future in pending:
+            future.cancel()
+        for future in pending:
+            if not future.cancelled():
+                attempts += future.result()[2]
+        return found[0], found[1], attempts
+
+    def benchmark(self, seconds: float = 2.0) -> float:
+        '''
+        测量当前机器的算力，多进程时通过挖矿使用的进程池测量，包括任务分发的开销
+        :param seconds: 测量时长
+        :return: 每秒哈希次数
+        '''
+        # 目标值为 1 时几乎不可能命中，相当于纯粹计算哈希
+        prefix = os.urandom(76)
+        attempts = 0
+        nonce = 0
+        with self._lock:
+            if self.workers == 1:
+                time_start = time.time()
+                while time.time() - time_start < seconds:
+                    _, _, count = search_nonce_range(prefix, 1, nonce, self.chunk_size)
+                    nonce += self.chunk_size
+                    attempts += count
+                return attempts / (time.time() - time_start)
+
+            executor = self._get_executor()
+            self._stop_event.clear()
+            # 先让所有工作进程启动，进程创建时间不计入
+            list(executor.map(_worker_search, [prefix] * self.workers, [1] * self.workers,
+                              range(0, self.workers), [1] * self.workers))
+            nonce = self.workers
+            pending = set()
+            time_start = time.time()
+            deadline = time_start + seconds
+            # 与挖矿相同，每个进程保持两个任务在队列中
+            for _ in range(self.workers * 2):
+                pending.add(executor.submit(_worker_search, prefix, 1, nonce, self.chunk_size))
+                nonce += self.chunk_size
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    attempts += future.result()[2]
+                    if time.time() < deadline:
+                        pending.add(executor.submit(_worker_search, prefix, 1, nonce, self.chunk_size))
+                        nonce += self.chunk_size
+            return attempts / (time.time() - time_start)
+
+    def close(self):
+        '''
+        关闭进程池
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+if __name__ == '__main__':
+    '''
+    测量算力并给出建议的挖矿难度
+    '''
+    miner = Miner()
+    hashrate = miner.benchmark()
+    print('进程数:\n \t{0}\n估计算力:\n \t{1:.0f} H/s'.format(miner.workers, hashrate))
+    for block_time in (1, 10, 60):
+        print('期望出块时间 {0}s 时建议难度: {1}'.format(block_time, Miner.suggest_difficulty(hashrate, block_time)))
+
+    prefix = os.urandom(76)
+    for difficulty in range(0, 6):
+        result = miner.mine(prefix, Miner.difficulty_to_target(difficulty))
+        print('难度 {0}: nonce={1} 耗时={2:.3f}s 算力={3:.0f} H/s'.format(
+            difficulty, result.nonce, result.elapsed, result.hashrate))
+    miner.close()
@@ -0,0 +1,369 @@
+import asyncio
+import base64
+import json
+import time
+import Codec
+from Block import Block
+from BlockChain import BlockChain
+from Miner import Miner, MAX_HASH
+
+
+class _CandidateChain:
+    def __init__(self, chain, start: int, blocks: list):
+        '''
+        本地链[:start] + blocks 的只读视图，检验分叉时不必复制整条链
+        '''
+        self.chain = chain
+        self.start = start
+        self.blocks = blocks
+
+    def __len__(self) -> int:
+        return self.start + len(self.blocks)
+
+    def __getitem__(self, height: int):
+        if height >= self.start:
+            return self.blocks[height - self.start]
+        return self.chain[height]
+
+
+class Node:
+    # 单条消息最多携带的区块数，更长的区间分多条消息发送
+    MAX_BLOCKS_PER_MESSAGE = 500
+    # 单行消息的最大长度
+    LINE_LIMIT = 1 << 26
+    # 向某个节点请求区块后，在该时间内不重复请求同一个最新区块
+    REQUEST_TIMEOUT = 2.0
+
+    def __init__(self, name: str, block_chain: BlockChain, host: str = '127.0.0.1', port: int = 0):
+        '''
+        本地区块链节点。节点之间通过 TCP 连接交换按行分隔的 json 消息：
+            Tip       {'Name', 'Height', 'Hash', 'Work'} 通告自己的最新区块与累计工作量
+            GetBlocks {'Locator': [[高度, 哈希], ...]} 请求对方链上自己缺少的区块
+            Blocks    {'Start', 'Blocks', 'More'}     返回从 Start 开始的区块（Codec 二进制编码后 base64）
+        收到工作量更大的链时只下载分叉点之后的区块，检验通过后采用累计工作量最大的合法链
+        :param name: 节点名称
+        :param block_chain: 节点持有的区块链
+        :param host: 监听地址
+        :param port: 监听端口，为 0 时由系统分配
+        '''
+        self.name = name
+        self.block_chain = block_chain
+        self.host = host
+        self.port = port
+        self.server = None
+        # writer -> 对方节点名称
+        self.peers = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # 区块哈希 -> 本节点采用该区块为最新区块的时间
+        self.adopted = {self.block_chain.get_latest_block().hash: time.perf_counter()}
+        self.reorgs = 0
+        # (高度, 区块哈希, 到该高度为止的累计工作量)
+        self._work_cache = (-1, '', 0)
+        self._tasks = set()
+        self._requested = {}
+        # writer -> (起始高度, 已收到的区块)，对方分多条消息发送时暂存
+        self._pending = {}
+        self._tip_changed = asyncio.Event()
+
+    async def start(self):
+        '''
+        开始监听其他节点的连接
+        '''
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port, limit=Node.LINE_LIMIT)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def connect(self, host: str, port: int):
+        '''
+        主动连接另一个节点
+        '''
+        reader, writer = await asyncio.open_connection(host, port, limit=Node.LINE_LIMIT)
+        self._spawn(self._handle_connection(reader, writer))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.peers):
+            writer.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def tip_message(self) -> dict:
+        tip = self.block_chain.get_latest_block()
+        return {'Type': 'Tip', 'Name': self.name, 'Height': len(self.block_chain.chain) - 1, 'Hash': tip.hash,
+                'Work': '%x' % self.chain_work()}
+
+    def block_work(self, block: Block) -> int:
+        target = block.target
+        if target is None:
+            target = min(Miner.difficulty_to_target(self.block_chain.difficulty), MAX_HASH)
+        return Miner.target_work(target)
+
+    def chain_work(self) -> int:
+        '''
+        本地链的累计工作量，链只是延长时只累加新区块
+        '''
+        chain = self.block_chain.chain
+        height, tip_hash, work = self._work_cache
+        if not (0 <= height < len(chain) and chain[height].hash == tip_hash):
+            height, work = -1, 0
+        for h in range(height + 1, len(chain)):
+            work += self.block_work(chain[h])
+        self._work_cache = (len(chain) - 1, chain[-1].hash, work)
+        return work
+
+    async def announce(self, exclude=None):
+        '''
+        向所有相连的节点通告本节点的最新区块。本地产生新区块后调用
+        :param exclude: 不需要通告的连接（新区块的来源）
+        '''
+        tip_hash = self.block_chain.get_latest_block().hash
+        if tip_hash not in self.adopted:
+            self._mark_adopted(tip_hash)
+        message = self.tip_message()
+        for writer in list(self.peers):
+            if writer is not exclude:
+                await self._send(writer, message)
+
+    def _mark_adopted(self, tip_hash: str):
+        self.adopted[tip_hash] = time.perf_counter()
+        self._tip_changed.set()
+
+    async def wait_for_tip(self, tip_hash: str, timeout: float = 10.0) -> float:
+        '''
+        等待本节点采用指定的最新区块
+        :return: 采用该区块的时间（time.perf_counter）
+        '''
+        deadline = time.perf_counter() + timeout
+        while tip_hash not in self.adopted:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise Exception('节点 {0} 等待区块 {1} 超时'.format(self.name, tip_hash))
+            self._tip_changed.clear()
+            try:
+                await asyncio.wait_for(self._tip_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return self.adopted[tip_hash]
+
+    async def _send(self, writer, message: dict):
+        line = json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.bytes_sent += len(line)
+        try:
+            writer.write(line)
+            await writer.drain()
+        except ConnectionError:
+            self.peers.pop(writer, None)
+
+    async def _handle_connection(self, reader, writer):
+        self.peers[writer] = None
+        await self._send(writer, self.tip_message())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.bytes_received += len(line)
+                message = json.loads(line)
+                handler = getattr(self, '_on_' + message['Type'].lower(), None)
+                if handler is None:
+                    raise Exception('未知的消息类型 {0}'.format(message['Type']))
+                await handler(writer, message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.peers.pop(writer, None)
+            self._pending.pop(writer, None)
+            writer.close()
+
+    def locator(self) -> list:
+        '''
+        本地链的区块定位器：最近 10 个区块之后按指数间隔向前取样，最后为创世区块。
+        对方据此找到分叉点，只需 O(log n) 个哈希
+        '''
+        chain = self.block_chain.chain
+        locator = []
+        height = len(chain) - 1
+        step = 1
+        while height > 0:
+            locator.append([height, chain[height].hash])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append([0, chain[0].hash])
+        return locator
+
+    async def _on_tip(self, writer, message: dict):
+        self.peers[writer] = message['Name']
+        if int(message['Work'], 16) <= self.chain_work() or message['Hash'] in self.adopted:
+            return
+        requested = self._requested.get(message['Hash'])
+        if requested is not None and time.perf_counter() - requested < Node.REQUEST_TIMEOUT:
+            return
+        self._requested[message['Hash']] = time.perf_counter()
+        await self._send(writer, {'Type': 'GetBlocks', 'Locator': self.locator()})
+
+    async def _on_getblocks(self, writer, message: dict):
+        chain = self.block_chain.chain
+        fork = -1
+        for height, block_hash in message['Locator']:
+            if height < len(chain) and chain[height].hash == block_hash:
+                fork = height
+                break
+        start = fork + 1
+        end = len(chain)
+        while True:
+            stop = min(start + Node.MAX_BLOCKS_PER_MESSAGE, end)
+            blocks = [base64.b64encode(Codec.encode_block(chain[height])).decode('ascii')
+                      for height in range(start, stop)]
+            await self._send(writer, {'Type': 'Blocks', 'Start': start, 'Blocks': blocks, 'More': stop < end})
+            if stop >= end:
+                break
+            start = stop
+
+    async def _on_blocks(self, writer, message: dict):
+        blocks = [Codec.decode_block(base64.b64decode(record)) for record in message['Blocks']]
+        pending = self._pending.pop(writer, None)
+        if pending is not None and pending[0] + len(pending[1]) == message['Start']:
+            start, blocks = pending[0], pending[1] + blocks
+        else:
+            start = message['Start']
+        if message['More']:
+            self._pending[writer] = (start, blocks)
+            return
+        if self.try_adopt(start, blocks):
+            await self.announce(exclude=writer)
+
+    def validate_segment(self, start: int, blocks: list) -> bool:
+        '''
+        检验一段接在本地 start - 1 高度之后的区块：链接、哈希、目标值与工作量，最后检验文件记录的签名
+        '''
+        candidate = _CandidateChain(self.block_chain.chain, start, blocks)
+        previous_hash = self.block_chain.chain[start - 1].hash
+        for height, block in enumerate(blocks, start):
+            if block.previous_hash != previous_hash or block.calculate_hash(refresh=True) != block.hash:
+                return False
+            if not self.block_chain._valid_target(height, candidate):
+                return False
+            previous_hash = block.hash
+        return self.block_chain.first_bad_signature(blocks) is None
+
+    def try_adopt(self, start: int, blocks: list) -> bool:
+        '''
+        若 本地链[:start] + blocks 的累计工作量大于本地链且合法，则采用它
+        :return: 是否采用
+        '''
+        chain = self.block_chain.chain
+        if not blocks or start == 0 or start > len(chain):
+            # 创世区块不同，或与本地链无法衔接
+            return False
+        # 只需比较分叉点之后两段的工作量，工作量相等的分叉保留先收到的链
+        replaced = sum(self.block_work(chain[height]) for height in range(start, len(chain)))
+        if sum(self.block_work(block) for block in blocks) <= replaced:
+            return False
+        if start < len(chain) and self.block_chain.store is not None and start < len(self.block_chain.store):
+            # 只追加的区块存储无法回滚已写入的区块
+            return False
+        if not self.validate_segment(start, blocks):
+            return False
+
+        if start < len(chain):
+            # 切换到更长的分叉，索引与检验进度在访问时按最新区块自动重建
+            self.block_chain.chain = list(chain[:start]) + blocks
+            self.reorgs += 1
+        else:
+            for block in blocks:
+                self.block_chain.chain.append(block)
+        self._mark_adopted(blocks[-1].hash)
+        return True
+
+
+if __name__ == '__main__':
+    '''
+    在本机启动 N 个节点，随机节点依次产生新区块，统计传播延迟与每个区块的传输字节数
+        python Node.py [节点数] [区块数] [每个区块的文件数]
+    '''
+    import random
+    import statistics
+    import sys
+    from BlockData import BlockData
+    from FileEntry import FileEntry
+    from Owner import Owner
+
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    block_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    files_per_block = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    random.seed(0)
+
+    def new_block(node: Node) -> Block:
+        data = BlockData()
+        data.files = [FileEntry(Owner.intern('owner-%d' % random.randrange(10)), '%064x' % random.getrandbits(256))
+                      for _ in range(files_per_block)]
+        # 难度为 0 时目标值为最大值，不需要挖矿
+        return node.block_chain.new_block(data)
+
+    async def simulate():
+        origin = BlockChain()
+        # 合成的记录没有签名
+        origin.require_signatures = False
+        chain_dict = origin.to_dict()
+        nodes = [Node('node-%d' % i, BlockChain.from_dict(chain_dict)) for i in range(node_count)]
+        for node in nodes:
+            await node.start()
+        # 环形连接，再随机加一些连接
+        for i, node in enumerate(nodes):
+            await node.connect(nodes[(i + 1) % node_count].host, nodes[(i + 1) % node_count].port)
+            other = random.randrange(node_count)
+            if other not in (i, (i + 1) % node_count):
+                await node.connect(nodes[other].host, nodes[other].port)
+        await asyncio.sleep(0.1)
+
+        latencies = []
+        transferred = []
+        for _ in range(block_count):
+            producer = random.choice(nodes)
+            block = new_block(producer)
+            bytes_before = sum(node.bytes_sent for node in nodes)
+            time_start = time.perf_counter()
+            producer.block_chain.add_block(block)
+            await producer.announce()
+            done = await asyncio.gather(*(node.wait_for_tip(block.hash) for node in nodes))
+            latencies.append(max(done) - time_start)
+            # 等待迟到的重复通告发送完毕
+            await asyncio.sleep(0.01)
+            transferred.append(sum(node.bytes_sent for node in nodes) - bytes_before)
+
+        # 两个节点同时在同一高度产生区块形成分叉，其中一个分叉再延长一个区块
+        first, second = nodes[0], nodes[node_count // 2]
+        fork_a, fork_b = new_block(first), new_block(second)
+        first.block_chain.add_block(fork_a)
+        second.block_chain.add_block(fork_b)
+        await asyncio.gather(first.announce(), second.announce())
+        await asyncio.sleep(0.1)
+        extension = new_block(second)
+        second.block_chain.add_block(extension)
+        await second.announce()
+        await asyncio.gather(*(node.wait_for_tip(extension.hash) for node in nodes))
+        tips = {node.block_chain.get_latest_block().hash for node in nodes}
+
+        json_size = len(json.dumps(nodes[0].block_chain.to_dict(), indent=4))
+        for node in nodes:
+            await node.close()
+
+        print('{0} 个节点, {1} 个区块, 每个区块 {2} 条记录'.format(node_count, block_count, files_per_block))
+        print('传播延迟: 平均 {0:.2f} ms, 中位数 {1:.2f} ms, 最大 {2:.2f} ms'.format(
+            statistics.mean(latencies) * 1000, statistics.median(latencies) * 1000, max(latencies) * 1000))
+        print('每个新区块的传输量: 平均 {0:.0f} 字节 (整条链 json 为 {1} 字节，原方式每个节点需重读一次)'.format(
+            statistics.mean(transferred), json_size))
+        print('分叉后所有节点收敛到同一最新区块: {0}，发生链切换 {1} 次'.format(
+            len(tips) == 1 and extension.hash in tips, sum(node.reorgs for node in nodes)))
+
+    asyncio.run(simulate())
@@ -0,0 +1,41 @@
+import hashlib
+
+
+class Owner:
+    __slots__ = ('key', 'fingerprint')
+    # 公钥 -> Owner，同一个公钥在内存中只保存一份
+    _registry = {}
+
+    def __init__(self, key: str):
+        '''
+        文件所有者的身份
+        :param key: 公钥（base64 字符串）
+        :param fingerprint: 公钥的 SHA-256 指纹，32 字节
+        '''
+        self.key = key
+        self.fingerprint = hashlib.sha256(key.encode('utf-8')).digest()
+
+    @classmethod
+    def intern(cls, key: str) -> 'Owner':
+        '''
+        获取公钥对应的共享 Owner 实例
+        '''
+        owner = cls._registry.get(key)
+        if owner is None:
+            owner = cls(key)
+            cls._registry[key] = owner
+        return owner
+
+    @staticmethod
+    def fingerprint_of(key: str) -> str:
+        '''
+        公钥的十六进制指纹，不登记到共享实例中，用于哈希客户端传入等不可信的公钥
+        '''
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @property
+    def fingerprint_hex(self) -> str:
+        return self.fingerprint.hex()
+
+    def __repr__(self) -> str:
+        return 'Owner({0})'.format(self.fingerprint_hex[:16])
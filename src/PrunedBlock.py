@@ -0,0 +1,66 @@
+from Block import Block
+
+
+class PrunedBlock(Block):
+    __slots__ = ('merkle_root',)
+
+    @classmethod
+    def from_header(cls, header: tuple) -> 'PrunedBlock':
+        '''
+        由区块头构造只有区块头的区块
+        :param header: Codec.decode_header 的结果
+        '''
+        block = cls.__new__(cls)
+        block.timestamp, block.previous_hash, block.merkle_root, block.nonce, block.hash, block.target = header
+        return block
+
+    @classmethod
+    def prune(cls, block: Block) -> 'PrunedBlock':
+        '''
+        丢弃区块数据，只保留区块头。区块哈希、链接与目标值仍可检验
+        '''
+        if isinstance(block, PrunedBlock):
+            return block
+        pruned = cls.__new__(cls)
+        pruned.timestamp = block.timestamp
+        pruned.previous_hash = block.previous_hash
+        pruned.merkle_root = Block.merkle_root_of(block.header())
+        pruned.nonce = block.nonce
+        pruned.hash = block.hash
+        pruned.target = block.target
+        return pruned
+
+    @property
+    def data(self):
+        raise Exception('区块 {0} 的数据已被裁剪，需要从快照启动'.format(self.hash))
+
+    def header_prefix(self, refresh: bool = False) -> bytes:
+        # 区块数据已丢弃，始终使用区块头中记录的默克尔根
+        return Block.pack_header(self.previous_hash, self.timestamp, self.merkle_root, self.target)
+
+    def to_dict(self):
+        data = {
+            'Time Stamp': self.timestamp,
+            'Merkle Root': self.merkle_root.hex(),
+            'Previous Hash': self.previous_hash,
+            'Block Hash': self.hash,
+            'Nonce': self.nonce,
+        }
+        if self.target is not None:
+            data['Target'] = '%064x' % self.target
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        target = int(data['Target'], 16) if 'Target' in data else None
+        return cls.from_header((data['Time Stamp'], data['Previous Hash'], bytes.fromhex(data['Merkle Root']),
+                                data['Nonce'], data['Block Hash'], target))
+
+    @staticmethod
+    def block_from_dict(data) -> Block:
+        '''
+        从 json 字典加载区块，被裁剪的区块没有区块数据，只有默克尔根
+        '''
+        if 'Block Data' not in data:
+            return PrunedBlock.from_dict(data)
+        return Block.from_dict(data)
@@ -0,0 +1,342 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from BlockChain import BlockChain
+
+
+class Throttle:
+    def __init__(self, rate: float = None):
+        '''
+        多个线程共享的读取速率限制（令牌桶），桶容量为一秒的读取量
+        :param rate: 每秒最多读取的字节数，为 None 时不限制
+        '''
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = rate or 0.0
+        self._last = time.perf_counter()
+
+    def consume(self, amount: int):
+        '''
+        取得读取 amount 字节的许可，超出速率时等待
+        '''
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.perf_counter()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Scrubber:
+    # 读取存储文件时每次处理的字节数
+    CHUNK_SIZE = 1 << 20
+    # 进度至少每隔该时间（秒）保存一次
+    SAVE_INTERVAL = 5.0
+
+    def __init__(self, block_chain: BlockChain, progress_path: str = None, workers: int = 4, rate: float = None,
+                 orphan_grace: float = 3600.0, file_keys: dict = None):
+        '''
+        存储完整性检查：按链上的文件记录重新计算共享存储空间中密文的哈希，报告缺失、损坏与无记录引用的密文。
+        使用分块存储时，所有分块按其名称（分块密文的哈希）重新计算，无引用的文件清单与分块同样报告
+        :param block_chain: 区块链，使用其索引中的文件、存储目录与分块存储
+        :param progress_path: 进度文件，记录每个密文最近一次检验通过的时间，中断后可以继续
+        :param workers: 并行读取的线程数。hashlib 与文件读取都会释放 GIL，线程足以并行
+        :param rate: 每秒最多读取的字节数，为 None 时不限制
+        :param orphan_grace: 修改时间在该时间（秒）之内的密文不算作无引用，它们可能属于尚未出块的上传
+        :param file_keys: 文件清单哈希 -> 文件密码。分块的引用记录在加密的文件清单中，
+                          只有链上所有清单都能解密时才能确定无引用的分块
+        '''
+        self.block_chain = block_chain
+        self.progress_path = progress_path
+        self.workers = workers
+        self.throttle = Throttle(rate)
+        self.orphan_grace = orphan_grace
+        self.file_keys = file_keys or {}
+        self._lock = threading.Lock()
+        self._saved = time.perf_counter()
+        self.progress = self.load_progress()
+
+    def load_progress(self) -> dict:
+        '''
+        读取进度文件，不存在或属于其他区块链时从头开始
+        :return: {'Chain ID', 'Verified': 密文哈希 -> 最近检验通过的时间, 'Run Started': 未完成的检查的开始时间}
+        '''
+        if self.progress_path is not None and os.path.isfile(self.progress_path):
+            with open(self.progress_path, 'r', encoding='utf-8') as f:
+                progress = json.load(f)
+            if progress.get('Chain ID') == self.block_chain.id:
+                return progress
+        return {'Chain ID': self.block_chain.id, 'Verified': {}, 'Run Started': None}
+
+    def save_progress(self):
+        if self.progress_path is None:
+            return
+        with self._lock:
+            content = json.dumps(self.progress)
+        tmp_path = '{0}.{1}.tmp'.format(self.progress_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, self.progress_path)
+
+    def blob_path(self, file_enc_hash: str) -> str:
+        '''
+        密文在存储空间中的路径：整文件密文，或分块存储的文件清单
+        '''
+        stored_path = self.block_chain.stored_file_path(file_enc_hash)
+        chunk_store = self.block_chain.chunk_store
+        if not os.path.isfile(stored_path) and chunk_store is not None:
+            return chunk_store.manifest_path(file_enc_hash)
+        return stored_path
+
+    def check(self, file_enc_hash: str, path: str = None):
+        '''
+        重新计算密文的哈希。整文件密文、文件清单与分块的名称都是对整个文件计算的哈希
+        :param path: 文件路径，默认为链上记录的密文的路径
+        :return: (问题, 读取的字节数)，问题为 None 表示通过，否则为 'missing' 或 'corrupt'
+        '''
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(path or self.blob_path(file_enc_hash), 'rb') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    self.throttle.consume(len(chunk))
+                    digest.update(chunk)
+                    size += len(chunk)
+        except FileNotFoundError:
+            return 'missing', 0
+        return (None if digest.hexdigest() == file_enc_hash else 'corrupt'), size
+
+    def chunks(self) -> dict:
+        '''
+        分块存储中的所有分块
+        :return: 分块哈希 -> 路径，没有使用分块存储时为空
+        '''
+        chunk_store = self.block_chain.chunk_store
+        if chunk_store is None or not os.path.isdir(chunk_store.chunk_dir):
+            return {}
+        chunks = {}
+        with os.scandir(chunk_store.chunk_dir) as prefixes:
+            for prefix in prefixes:
+                if not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as entries:
+                    for entry in entries:
+                        # 跳过写入中的临时文件
+                        if len(entry.name) == 64 and entry.name.startswith(prefix.name):
+                            chunks[entry.name] = entry.path
+        return chunks
+
+    def targets(self, max_age: float = None, chunks: dict = None) -> list:
+        '''
+        需要检验的密文与分块
+        :param max_age: 增量模式，只检验最近一次通过超过该时间（秒）的密文；为 None 时检验本次检查开始后未检验的密文
+        :param chunks: chunks() 的结果
+        :return: [(类别, 哈希, 路径), ...]，类别为 'file' 或 'chunk'，文件的路径为 None
+        '''
+        verified = self.progress['Verified']
+        if max_age is not None:
+            threshold = time.time() - max_age
+        else:
+            threshold = self.progress['Run Started']
+        targets = [('file', file_enc_hash, None) for file_enc_hash in self.block_chain.index.files
+                   if verified.get(file_enc_hash, 0) < threshold]
+        targets += [('chunk', chunk_id, path) for chunk_id, path in sorted((chunks or {}).items())
+                    if verified.get(chunk_id, 0) < threshold]
+        return targets
+
+    def _unreferenced(self, objects, referenced) -> list:
+        '''
+        没有被引用、且修改时间超过宽限期的对象
+        :param objects: [(名称, 路径), ...]
+        '''
+        now = time.time()
+        orphans = []
+        for name, path in objects:
+            if name in referenced:
+                continue
+            try:
+                if now - os.stat(path).st_mtime >= self.orphan_grace:
+                    orphans.append(name)
+            except FileNotFoundError:
+                continue
+        return sorted(orphans)
+
+    def orphans(self) -> list:
+        '''
+        存储目录中没有被任何记录引用的整文件密文
+        '''
+        upload_dir = self.block_chain.upload_dir
+        if not os.path.isdir(upload_dir):
+            return []
+        with os.scandir(upload_dir) as entries:
+            objects = [(entry.name[:-4], entry.path) for entry in entries if entry.name.endswith('.enc')]
+        return self._unreferenced(objects, self.block_chain.index.files)
+
+    def orphan_manifests(self) -> list:
+        '''
+        分块存储中没有被任何记录引用的文件清单
+        '''
+        chunk_store = self.block_chain.chunk_store
+        if chunk_store is None or not os.path.isdir(chunk_store.manifest_dir):
+            return []
+        with os.scandir(chunk_store.manifest_dir) as entries:
+            objects = [(entry.name, entry.path) for entry in entries if len(entry.name) == 64]
+        return self._unreferenced(objects, self.block_chain.index.files)
+
+    def chunk_references(self) -> tuple:
+        '''
+        解密链上引用的文件清单，收集其中引用的分块
+        :return: (被引用的分块哈希集合, 无法解密的清单列表)
+        '''
+        chunk_store = self.block_chain.chunk_store
+        referenced = set()
+        unreadable = []
+        if chunk_store is None:
+            return referenced, unreadable
+        for file_enc_hash in self.block_chain.index.files:
+            if not os.path.isfile(chunk_store.manifest_path(file_enc_hash)):
+                continue
+            password = self.file_keys.get(file_enc_hash)
+            if password is None:
+                unreadable.append(file_enc_hash)
+                continue
+            try:
+                manifest = chunk_store.read_manifest(file_enc_hash, password)
+            except Exception:
+                # 清单已损坏或密码不正确，损坏会在检验中报告
+                unreadable.append(file_enc_hash)
+                continue
+            referenced.update(chunk_id for chunk_id, _, _ in manifest['Chunks'])
+        return referenced, sorted(unreadable)
+
+    def _check_and_record(self, target: tuple) -> tuple:
+        _, file_enc_hash, path = target
+        problem, size = self.check(file_enc_hash, path)
+        with self._lock:
+            if problem is None:
+                self.progress['Verified'][file_enc_hash] = time.time()
+            save = time.perf_counter() - self._saved >= self.SAVE_INTERVAL
+            if save:
+                self._saved = time.perf_counter()
+        if save:
+            self.save_progress()
+        return problem, size
+
+    def run(self, max_age: float = None) -> dict:
+        '''
+        执行一次检查。非增量模式下，上次中断的检查从断点继续
+        :param max_age: 增量模式，只检验最近一次通过超过该时间（秒）的密文
+        :return: {'Checked', 'Skipped', 'Bytes', 'Missing', 'Corrupt', 'Corrupt Chunks', 'Missing Chunks',
+                  'Orphaned', 'Orphaned Manifests', 'Orphaned Chunks', 'Unreadable Manifests', 'Elapsed'}。
+                 有无法解密的清单时无法确定无引用的分块，'Orphaned Chunks' 为 None
+        '''
+        time_start = time.perf_counter()
+        if max_age is None and self.progress['Run Started'] is None:
+            self.progress['Run Started'] = time.time()
+        chunks = self.chunks()
+        targets = self.targets(max_age, chunks)
+        total = len(self.block_chain.index.files) + len(chunks)
+        problems = {('file', 'missing'): [], ('file', 'corrupt'): [],
+                    ('chunk', 'missing'): [], ('chunk', 'corrupt'): []}
+        checked_bytes = 0
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            results = executor.map(self._check_and_record, targets)
+            for (kind, file_enc_hash, _), (problem, size) in zip(targets, results):
+                checked_bytes += size
+                if problem is not None:
+                    problems[(kind, problem)].append(file_enc_hash)
+            if max_age is None:
+                self.progress['Run Started'] = None
+        finally:
+            # 中断时丢弃尚未开始的检验，已完成的部分保存到进度文件
+            executor.shutdown(cancel_futures=True)
+            self.save_progress()
+        referenced, unreadable = self.chunk_references()
+        return {
+            'Checked': len(targets),
+            'Skipped': total - len(targets),
+            'Bytes': checked_bytes,
+            'Missing': problems[('file', 'missing')],
+            'Corrupt': problems[('file', 'corrupt')],
+            'Corrupt Chunks': problems[('chunk', 'corrupt')],
+            # 清单引用但分块存储中没有的分块，包括检验期间被删除的分块
+            'Missing Chunks': sorted(set(problems[('chunk', 'missing')]) | (referenced - set(chunks))),
+            'Orphaned': self.orphans(),
+            'Orphaned Manifests': self.orphan_manifests(),
+            'Orphaned Chunks': None if unreadable else self._unreferenced(chunks.items(), referenced),
+            'Unreadable Manifests': unreadable,
+            'Elapsed': time.perf_counter() - time_start,
+        }
+
+
+if __name__ == '__main__':
+    '''
+    检查区块链引用的密文
+        python Scrubber.py 区块链文件或存储目录 [--upload-dir 目录] [--chunk-store 目录] [--keys 密码.json]
+                           [--progress 进度文件] [--workers 4] [--rate 每秒MB] [--days 天数]
+                           [--snapshot-dir 快照目录] [--output 报告.json]
+    --days 为增量模式，只检验最近 N 天内没有检验通过的密文；否则完整检查，中断后再次运行从断点继续。
+    发现缺失或损坏的密文或分块时退出码为 1
+    '''
+    import argparse
+    import sys
+    from ChunkStore import ChunkStore
+    from Snapshot import Snapshot
+
+    parser = argparse.ArgumentParser(description='存储完整性检查')
+    parser.add_argument('chain', help='区块链 json 文件或区块存储目录')
+    parser.add_argument('--upload-dir', default=BlockChain.upload_dir)
+    parser.add_argument('--chunk-store', help='分块存储的根目录，上传使用分块存储时需要指定')
+    parser.add_argument('--keys', help='json 文件：文件清单哈希 -> 文件密码，用于确定无引用的分块')
+    parser.add_argument('--progress', help='进度文件，默认为区块链文件旁的 .scrub.json')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, help='每秒最多读取的 MB 数')
+    parser.add_argument('--days', type=float, help='增量模式：只检验 N 天内没有检验通过的密文')
+    parser.add_argument('--snapshot-dir', help='裁剪过的区块链需要从快照启动')
+    parser.add_argument('--output', help='报告 json 文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    if args.snapshot_dir:
+        block_chain = Snapshot.bootstrap_latest(args.chain, args.snapshot_dir)
+    elif os.path.isdir(args.chain):
+        block_chain = BlockChain.load_from_store(args.chain, lazy=True)
+    else:
+        block_chain = BlockChain.load_from_file(args.chain)
+    block_chain.upload_dir = args.upload_dir
+    if args.chunk_store:
+        if not os.path.isdir(args.chunk_store):
+            raise Exception('分块存储目录 {0} 不存在'.format(args.chunk_store))
+        block_chain.chunk_store = ChunkStore(args.chunk_store)
+    file_keys = None
+    if args.keys:
+        with open(args.keys, 'r', encoding='utf-8') as f:
+            file_keys = json.load(f)
+    progress_path = args.progress or args.chain.rstrip('/') + '.scrub.json'
+    scrubber = Scrubber(block_chain, progress_path, args.workers, args.rate * 2**20 if args.rate else None,
+                        file_keys=file_keys)
+    report = scrubber.run(args.days * 86400 if args.days is not None else None)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    print('检验 {0} 个（跳过 {1} 个），{2:.1f} MB，缺失 {3}，损坏 {4}，分块损坏 {5}，分块缺失 {6}，'
+          '无引用 {7}，耗时 {8:.2f}s'.format(
+              report['Checked'], report['Skipped'], report['Bytes'] / 2**20, len(report['Missing']),
+              len(report['Corrupt']), len(report['Corrupt Chunks']), len(report['Missing Chunks']),
+              len(report['Orphaned']) + len(report['Orphaned Manifests']) + len(report['Orphaned Chunks'] or []),
+              report['Elapsed']), file=sys.stderr)
+    if report['Unreadable Manifests']:
+        print('{0} 个文件清单没有密码或无法解密，未检查无引用的分块'.format(len(report['Unreadable Manifests'])),
+              file=sys.stderr)
+    if report['Missing'] or report['Corrupt'] or report['Corrupt Chunks'] or report['Missing Chunks']:
+        sys.exit(1)
@@ -0,0 +1,364 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+from Mempool import Mempool
+from Metrics import metrics
+from Owner import Owner
+from User import User
+
+
+class Service:
+    # 上传的文件在加密前暂存的目录，与 upload_data 位于同一文件系统时密文可直接移动
+    incoming_dir = '../workspace/incoming/'
+    # 每次读写请求体与下载文件的字节数
+    CHUNK_SIZE = 1 << 20
+    # 所有者文件列表的默认与最大分页大小
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
+    def __init__(self, user: User, host: str = '127.0.0.1', port: int = 8080, workers: int = None,
+                 threads: int = 32, block_size: int = 256, max_wait: float = 0.5, max_upload: int = 1 << 30):
+        '''
+        区块链节点的本地 HTTP/JSON 服务。所有请求共享同一条内存中的区块链与索引，上传的文件由服务的用户签名，
+        经记录池批量出块后保存。服务应当是区块链文件的唯一写入者
+            POST /files[?return_key=1]         上传文件（请求体为文件内容），返回密文哈希，指定 return_key 时同时返回文件密码
+            GET  /files/<密文哈希>[?owner=]     所有权查询
+            GET  /files/<密文哈希>/content?key=  下载并解密文件
+            GET  /owners/files[?owner=&page=&page_size=]  某个所有者的文件，默认为服务的用户
+            GET  /blocks/<高度>                 区块
+            GET  /tip                          最新区块
+        :param user: 已设置区块链的用户
+        :param workers: 哈希、密钥派生与加密的工作进程数，默认为 CPU 核数
+        :param threads: 执行阻塞操作（读取索引、存储、签名、解密）的线程数
+        :param block_size: 记录池中记录数达到该值时立即出块
+        :param max_wait: 最早的记录等待超过该时间（秒）时出块
+        :param max_upload: 上传文件的最大字节数
+        '''
+        if not hasattr(user, 'block_chain'):
+            raise Exception('启动服务之前未指定区块链')
+        self.user = user
+        self.host = host
+        self.port = port
+        self.max_upload = max_upload
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        # 挖矿由记录池的出块线程执行，出块后保存区块链
+        self.mempool = Mempool(user.block_chain, block_size=block_size, max_wait=max_wait,
+                               on_commit=lambda block: user.save_working_block_chain(user.block_chain_file_path),
+                               block_chain_file_path=user.block_chain_file_path)
+        self.routes = [
+            ('POST', ('files',), self.upload),
+            ('GET', ('files', None), self.lookup),
+            ('GET', ('files', None, 'content'), self.download),
+            ('GET', ('owners', 'files'), self.owner_files),
+            ('GET', ('blocks', None), self.block),
+            ('GET', ('tip',), self.tip),
+        ]
+        self._server = None
+        self._processes = None
+        self._threads = None
+
+    async def start(self):
+        '''
+        启动出块线程、执行器与监听
+        '''
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self._processes = ProcessPoolExecutor(max_workers=self.workers)
+        self._threads = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='service')
+        self.mempool.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port 为 0 时使用实际监听的端口
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        '''
+        停止监听，打包剩余的记录后关闭执行器
+        '''
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await asyncio.get_running_loop().run_in_executor(self._threads, self.mempool.stop)
+        self._threads.shutdown()
+        self._processes.shutdown()
+
+    def run(self):
+        '''
+        启动服务直到被中断
+        '''
+        async def main():
+            await self.start()
+            print('服务运行在 http://{0}:{1}'.format(self.host, self.port))
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await self.stop()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+
+    def _run_locked(self, function, *args):
+        # 出块线程追加区块时会更新索引，读取区块链与索引时需要持有同一把锁
+        with self.mempool.chain_lock:
+            return function(*args)
+
+    async def _read(self, function, *args):
+        '''
+        在线程中持有区块链的锁执行 function，不阻塞事件循环
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self._threads, self._run_locked, function, *args)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        处理一个连接上的请求，HTTP/1.1 默认保持连接
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                request = {
+                    'Method': method,
+                    'Headers': headers,
+                    'Query': dict(parse_qsl(urlsplit(target).query)),
+                    'Length': int(headers.get('content-length', 0)),
+                    'Reader': reader,
+                }
+                time_start = time.perf_counter()
+                keep_alive = await self._dispatch(request, urlsplit(target).path, writer) \
+                    and headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                await writer.drain()
+                # 协程交替执行，不能使用按线程嵌套的阶段，只记录每个请求的延迟
+                metrics.observe('service.request', time.perf_counter() - time_start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: dict, path: str, writer: asyncio.StreamWriter) -> bool:
+        '''
+        按路径调用处理函数并写出响应
+        :return: 是否可以继续使用该连接
+        '''
+        parts = tuple(part for part in path.split('/') if part)
+        handler = None
+        params = []
+        for method, pattern, route_handler in self.routes:
+            if len(pattern) == len(parts) and all(p is None or p == part for p, part in zip(pattern, parts)):
+                if method == request['Method']:
+                    handler = route_handler
+                    params = [part for p, part in zip(pattern, parts) if p is None]
+                    break
+        metrics.inc('service.requests')
+        try:
+            if handler is None:
+                status, payload = HTTPStatus.NOT_FOUND, {'Error': '没有路径 {0} {1}'.format(request['Method'], path)}
+            else:
+                status, payload = await handler(request, *params)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            metrics.inc('service.errors')
+            status, payload = HTTPStatus.BAD_REQUEST, {'Error': str(e)}
+        # 未读取的请求体需要丢弃，之后才能读取同一连接上的下一个请求
+        if request['Length'] > 0:
+            if request['Length'] > self.max_upload:
+                Service._send(writer, status, payload, close=True)
+                return False
+            await request['Reader'].readexactly(request['Length'])
+        if isinstance(payload, str):
+            # 处理函数返回文件路径时流式发送，发送后删除
+            await self._send_file(writer, payload)
+        else:
+            Service._send(writer, status, payload)
+        return True
+
+    @staticmethod
+    def _send(writer: asyncio.StreamWriter, status: HTTPStatus, payload, close: bool = False):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                     'Content-Length: {2}\r\n{3}\r\n'.format(status.value, status.phrase, len(body),
+                                                             'Connection: close\r\n' if close else '')
+                     .encode('latin-1') + body)
+
+    async def _send_file(self, writer: asyncio.StreamWriter, path: str):
+        try:
+            with open(path, 'rb') as f:
+                writer.write('HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: {0}\r\n\r\n'
+                             .format(os.fstat(f.fileno()).st_size).encode('latin-1'))
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    writer.write(chunk)
+                    # 等待发送缓冲区排空，内存占用不超过一个分块
+                    await writer.drain()
+        finally:
+            os.remove(path)
+
+    async def upload(self, request: dict):
+        '''
+        请求体写入暂存文件，在工作进程中哈希与加密，之后在线程中去重存储、签名并提交到记录池
+        :return: 202，记录在下一次出块后上链，之后可通过所有权查询确认。文件密码即明文哈希，
+                 客户端可以自行计算，只有请求中指定 return_key=1 时才返回
+        '''
+        length = request['Length']
+        if length > self.max_upload:
+            raise Exception('文件超过 {0} 字节的上限'.format(self.max_upload))
+        fd, path = tempfile.mkstemp(dir=self.incoming_dir)
+        loop = asyncio.get_running_loop()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while request['Length'] > 0:
+                    chunk = await request['Reader'].read(min(request['Length'], self.CHUNK_SIZE))
+                    if not chunk:
+                        raise ConnectionError('请求体不完整')
+                    f.write(chunk)
+                    request['Length'] -= len(chunk)
+            result = await loop.run_in_executor(self._processes, self.mempool.ingest_function(), path)
+            queued = await loop.run_in_executor(self._threads, self.mempool.submit_ingested, path, result,
+                                                self.user.public_key_content, self.user.file_keys,
+                                                self.user.keystore.sign)
+        finally:
+            os.remove(path)
+            # 重复的密文没有被移动到共享存储空间
+            if os.path.exists(path + '.enc'):
+                os.remove(path + '.enc')
+        response = {'File': result['File'], 'Queued': queued}
+        if request['Query'].get('return_key') == '1':
+            response['Key'] = result['Key']
+        return HTTPStatus.ACCEPTED, response
+
+    async def lookup(self, request: dict, file_enc_hash: str):
+        '''
+        文件所在区块与所有者指纹；设置 owner 时返回该公钥是否拥有文件
+        '''
+        def read():
+            record = self.user.block_chain.index.get(file_enc_hash)
+            if record is None:
+                return None
+            return {
+                'File': file_enc_hash,
+                'Height': record['Height'],
+                'Owners': [Owner.intern(key).fingerprint_hex for key in record['Owners']],
+            }
+
+        result = await self._read(read)
+        if result is None:
+            return HTTPStatus.NOT_FOUND, {'Error': '链上没有文件 {0}'.format(file_enc_hash)}
+        owner = request['Query'].get('owner')
+        if owner is not None:
+            result['Owner'] = Owner.fingerprint_of(owner) in result['Owners']
+        return HTTPStatus.OK, result
+
+    async def download(self, request: dict, file_enc_hash: str):
+        '''
+        检查服务的用户拥有该文件后，在线程中解密到临时文件，检验通过后发送。
+        请求必须带有文件密码，服务不使用自己保存的密码代替，否则知道密文哈希即可下载
+        '''
+        block_chain = self.user.block_chain
+        owner = self.user.public_key_content
+        password = request['Query'].get('key')
+        if not password:
+            raise Exception('下载文件 {0} 需要指定文件密码 key'.format(file_enc_hash))
+        if not await self._read(lambda: block_chain.index.is_owner(file_enc_hash, owner)):
+            return HTTPStatus.NOT_FOUND, {'Error': '链上没有该用户拥有文件 {0} 的记录'.format(file_enc_hash)}
+
+        def decrypt():
+            fd, path = tempfile.mkstemp(dir=self.incoming_dir)
+            try:
+                with os.fdopen(fd, 'wb') as fout:
+                    block_chain.read_stored_file(file_enc_hash, password, fout)
+            except Exception:
+                os.remove(path)
+                raise
+            return path
+
+        return HTTPStatus.OK, await asyncio.get_running_loop().run_in_executor(self._threads, decrypt)
+
+    async def owner_files(self, request: dict):
+        query = request['Query']
+        owner = query.get('owner') or self.user.public_key_content
+        try:
+            page = int(query.get('page', 0))
+            page_size = int(query.get('page_size', Service.PAGE_SIZE))
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, {'Error': 'page 与 page_size 必须是整数'}
+        if page < 0 or not 1 <= page_size <= Service.MAX_PAGE_SIZE:
+            return HTTPStatus.BAD_REQUEST, {
+                'Error': 'page 不能为负数，page_size 必须在 1 到 {0} 之间'.format(Service.MAX_PAGE_SIZE)}
+        files = await self._read(lambda: self.user.block_chain.index.owner_files(
+            owner, offset=page * page_size, limit=page_size))
+        return HTTPStatus.OK, {'Owner': Owner.fingerprint_of(owner), 'Page': page, 'Files': files}
+
+    async def block(self, request: dict, height: str):
+        chain = self.user.block_chain.chain
+        height = int(height)
+        result = await self._read(lambda: chain[height].to_dict() if 0 <= height < len(chain) else None)
+        if result is None:
+            return HTTPStatus.NOT_FOUND, {'Error': '没有高度为 {0} 的区块'.format(height)}
+        return HTTPStatus.OK, result
+
+    async def tip(self, request: dict):
+        def read():
+            block = self.user.block_chain.get_latest_block()
+            return {
+                'Height': len(self.user.block_chain.chain) - 1,
+                'Hash': block.hash,
+                'Time Stamp': block.timestamp,
+            }
+
+        result = await self._read(read)
+        result['Pending'] = len(self.mempool)
+        return HTTPStatus.OK, result
+
+
+if __name__ == '__main__':
+    '''
+    启动服务，区块链文件不存在时新建
+        python Service.py [--port 8080] [--chain 区块链文件] [--key 密钥文件] [--workers 进程数]
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(description='区块链节点服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--chain', default='../workspace/block_chain/block_chain.json')
+    parser.add_argument('--key', default=User.key_path)
+    parser.add_argument('--upload-dir', help='密文的共享存储目录')
+    parser.add_argument('--incoming-dir', help='上传文件的暂存目录')
+    parser.add_argument('--kdf', help='新建区块链使用的密钥派生配置')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--block-size', type=int, default=256)
+    parser.add_argument('--max-wait', type=float, default=0.5)
+    args = parser.parse_args()
+
+    user = User.from_key_file(args.key)
+    if os.path.exists(args.chain):
+        user.set_working_block_chain(args.chain)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.chain)), exist_ok=True)
+        user.create_working_block_chain(args.chain)
+        if args.kdf:
+            user.block_chain.kdf = args.kdf
+            user.save_working_block_chain(args.chain)
+    if args.upload_dir:
+        user.block_chain.upload_dir = args.upload_dir
+        os.makedirs(args.upload_dir, exist_ok=True)
+    if args.incoming_dir:
+        Service.incoming_dir = args.incoming_dir
+    Service(user, args.host, args.port, args.workers, block_size=args.block_size, max_wait=args.max_wait).run()
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from KeyStore import KeyStore
+
+# 每个进程中已解析的公钥：公钥字符串 -> 公钥对象，无法解析时为 None
+_public_keys = {}
+_MAX_PUBLIC_KEYS = 4096
+
+
+def _public_key(key: str):
+    public_key = _public_keys.get(key, False)
+    if public_key is False:
+        try:
+            public_key = KeyStore.load_public_key(key)
+        except ValueError:
+            public_key = None
+        if len(_public_keys) >= _MAX_PUBLIC_KEYS:
+            _public_keys.clear()
+        _public_keys[key] = public_key
+    return public_key
+
+
+def _verify_items(items: list) -> list:
+    '''
+    在工作进程中检验一批 (公钥字符串, 消息, 签名)
+    :return: 各自是否通过
+    '''
+    results = []
+    for key, message, signature in items:
+        public_key = _public_key(key)
+        results.append(public_key is not None and KeyStore.verify(public_key, message, signature))
+    return results
+
+
+class SignatureVerifier:
+    def __init__(self, max_entries: int = 100000):
+        '''
+        文件记录签名的检验器，缓存已检验通过的记录，同一记录再次出现时（重新检验、分叉切换）不再检验
+        :param max_entries: 最多缓存的记录个数，为 0 时关闭缓存
+        '''
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._verified = OrderedDict()
+        # 检验器是类属性，被多个线程共享；只在访问缓存时持有锁，检验签名时不持有
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(entry) -> bytes:
+        '''
+        叶子包含所有者指纹、文件哈希与签名，任何一项改变都会使缓存失效
+        '''
+        return hashlib.sha256(entry.leaf()).digest()
+
+    def first_invalid(self, entries: list, require_signatures: bool = False, workers: int = None,
+                      parallel_threshold: int = 256):
+        '''
+        检验一组文件记录的签名
+        :param entries: 文件记录列表
+        :param require_signatures: 是否拒绝没有签名的记录，否则只检验有签名的记录
+        :param workers: 并行检验的进程数，默认为 CPU 核数
+        :param parallel_threshold: 待检验的签名数达到该值时才使用进程池
+        :return: 第一个不合法记录的下标，全部合法时返回 None
+        '''
+        pending = []
+        # 第一条没有签名的记录，之前的记录仍需检验才能确定第一个不合法的记录
+        unsigned = None
+        with self._lock:
+            for i, entry in enumerate(entries):
+                if entry.signature is None:
+                    if require_signatures:
+                        unsigned = i
+                        break
+                    continue
+                key = SignatureVerifier.cache_key(entry)
+                if key in self._verified:
+                    self._verified.move_to_end(key)
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                pending.append((i, key, (entry.owner.key, entry.signing_message(), entry.signature)))
+
+        results = self._verify([item for _, _, item in pending], workers, parallel_threshold)
+        with self._lock:
+            for (i, key, _), valid in zip(pending, results):
+                if not valid:
+                    return i
+                if self.max_entries > 0:
+                    self._verified[key] = None
+            while len(self._verified) > self.max_entries:
+                self._verified.popitem(last=False)
+        return unsigned
+
+    @staticmethod
+    def _verify(items: list, workers: int, parallel_threshold: int) -> list:
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(items) < parallel_threshold:
+            return _verify_items(items)
+        chunk = -(-len(items) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(_verify_items, [items[i:i + chunk] for i in range(0, len(items), chunk)])
+            return [valid for results in chunks for valid in results]
+
+    def clear(self):
+        with self._lock:
+            self._verified.clear()
+
+    def __len__(self) -> int:
+        return len(self._verified)
+
+
+if __name__ == '__main__':
+    '''
+    统计签名检验速度（每核每秒检验数），以及缓存命中时重新检验的速度
+        python SignatureVerifier.py [记录数] [进程数]
+    '''
+    import sys
+    import time
+    from FileEntry import FileEntry
+    from Owner import Owner
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    for key_type in KeyStore.KEY_TYPES:
+        keystores = [KeyStore(key_type=key_type) for _ in range(8)]
+        entries = []
+        for i in range(total):
+            keystore = keystores[i % len(keystores)]
+            entry = FileEntry(Owner.intern(keystore.public_key_content), '%064x' % i)
+            entries.append(entry.sign(keystore.sign))
+        # 篡改最后一条记录的文件哈希，签名不再匹配
+        forged = FileEntry(entries[-1].owner, '%064x' % (total + 1), entries[-1].signature)
+
+        for name, count in (('单进程', 1), ('{0} 个进程'.format(workers), workers)):
+            verifier = SignatureVerifier()
+            time_start = time.perf_counter()
+            assert verifier.first_invalid(entries, True, count) is None
+            elapsed = time.perf_counter() - time_start
+            print('{0} {1}: {2:.0f} 次/秒, 每核 {3:.0f} 次/秒'.format(
+                key_type, name, total / elapsed, total / elapsed / count))
+
+        time_start = time.perf_counter()
+        assert verifier.first_invalid(entries, True, workers) is None
+        elapsed = time.perf_counter() - time_start
+        print('{0} 缓存命中: {1:.0f} 次/秒'.format(key_type, total / elapsed))
+        assert verifier.first_invalid(entries + [forged], True, workers) == total
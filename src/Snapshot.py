@@ -0,0 +1,424 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+import Codec
+from BlockChain import BlockChain
+from BlockStore import BlockStore
+from ChainLock import ChainLock
+from FileIndex import FileIndex
+from PrunedBlock import PrunedBlock
+
+
+class SnapshotError(Exception):
+    '''
+    快照损坏、版本不支持，或与区块链不一致。从最新快照启动时跳过这类快照
+    '''
+
+
+class Snapshot:
+    VERSION = 1
+    # 快照文件：第一行为摘要，第二行为元信息（高度、最新区块哈希、设置、区块头），第三行为索引，均为 json
+    # 摘要覆盖后两行，加载时检查文件是否损坏
+    NAME_FORMAT = 'snapshot-{0}-{1:010d}-{2}.json'
+    NAME_PATTERN = re.compile(r'^snapshot-([0-9a-f]{16})-(\d{10})-([0-9a-f]{16})\.json$')
+    # 快照默认存放的目录
+    snapshot_dir = '../workspace/snapshots/'
+
+    def __init__(self, meta: dict, index_text: str):
+        '''
+        区块链在某一高度的状态：去重与所有权索引，以及该高度及之前所有区块的区块头。
+        快照由节点自己在检验区块链之后建立，从快照启动时只需检验之后的新区块
+        :param meta: 元信息
+        :param index_text: 该高度的 FileIndex 的 json 文本，建立时即序列化，不随区块链继续增长而改变
+        '''
+        self.meta = meta
+        self.index_text = index_text
+        self.path = None
+
+    @property
+    def chain_id(self) -> str:
+        return self.meta['Chain ID']
+
+    @property
+    def height(self) -> int:
+        return self.meta['Height']
+
+    @property
+    def tip_hash(self) -> str:
+        return self.meta['Tip Hash']
+
+    @property
+    def created(self) -> float:
+        return self.meta['Created']
+
+    def meta_text(self) -> str:
+        return json.dumps(self.meta, sort_keys=True, separators=(',', ':'))
+
+    def digest(self) -> str:
+        return hashlib.sha256((self.meta_text() + '\n' + self.index_text).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def create(cls, block_chain: BlockChain, height: int = None) -> 'Snapshot':
+        '''
+        为已检验的区块链建立快照
+        :param height: 快照的高度，默认为最新区块
+        '''
+        height = len(block_chain.chain) - 1 if height is None else height
+        if not 0 <= height < len(block_chain.chain):
+            raise Exception('区块高度 {0} 超出范围'.format(height))
+        block_chain.verify_blockchain()
+        if block_chain.verified_height < height:
+            raise Exception('区块链在高度 {0} 检验未通过，无法建立快照'.format(block_chain.verified_height + 1))
+
+        if height == len(block_chain.chain) - 1:
+            index = block_chain.index
+        else:
+            index = FileIndex.build(block_chain.chain[:height + 1])
+        blocks = block_chain.chain[:height + 1]
+        headers = b''.join(block.header() + bytes.fromhex(block.hash) for block in blocks)
+        meta = {
+            'Version': Snapshot.VERSION,
+            'Chain ID': block_chain.id,
+            'Height': height,
+            'Tip Hash': blocks[-1].hash,
+            'Created': time.time(),
+            'Settings': block_chain.settings(),
+            'Headers': base64.b64encode(headers).decode('ascii'),
+        }
+        return cls(meta, json.dumps(index.to_dict(), separators=(',', ':')))
+
+    def headers(self) -> list:
+        '''
+        快照高度及之前的区块，只有区块头
+        '''
+        headers = base64.b64decode(self.meta['Headers'])
+        blocks = []
+        pos = 0
+        while pos < len(headers):
+            blocks.append(PrunedBlock.from_header(Codec.decode_header(headers, pos)))
+            pos += Codec.record_header_size(headers, pos)
+        return blocks
+
+    def index(self) -> FileIndex:
+        return FileIndex.from_dict(json.loads(self.index_text))
+
+    def file_name(self) -> str:
+        return Snapshot.NAME_FORMAT.format(self.chain_id[:16], self.height, self.tip_hash[:16])
+
+    def save(self, snapshot_dir: str = None) -> str:
+        '''
+        保存到快照目录，先写入临时文件再替换
+        :return: 快照文件路径
+        '''
+        snapshot_dir = snapshot_dir or Snapshot.snapshot_dir
+        os.makedirs(snapshot_dir, exist_ok=True)
+        path = os.path.join(snapshot_dir, self.file_name())
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.digest() + '\n' + self.meta_text() + '\n' + self.index_text + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.path = path
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> 'Snapshot':
+        '''
+        加载快照，摘要不一致（文件损坏）时抛出异常
+        '''
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                digest = f.readline().strip()
+                meta_text = f.readline().rstrip('\n')
+                index_text = f.readline().rstrip('\n')
+        except UnicodeDecodeError:
+            raise SnapshotError('快照 {0} 已损坏'.format(path))
+        if hashlib.sha256((meta_text + '\n' + index_text).encode('utf-8')).hexdigest() != digest:
+            raise SnapshotError('快照 {0} 已损坏'.format(path))
+        meta = json.loads(meta_text)
+        if meta.get('Version') != Snapshot.VERSION:
+            raise SnapshotError('不支持的快照版本 {0}'.format(meta.get('Version')))
+        snapshot = cls(meta, index_text)
+        snapshot.path = path
+        return snapshot
+
+    @staticmethod
+    def list_snapshots(snapshot_dir: str = None, chain_id: str = None) -> list:
+        '''
+        列出快照目录中的快照，只读取文件名
+        :param chain_id: 只列出该区块链的快照
+        :return: [{'Chain ID': ID 前 16 位, 'Height', 'Tip Hash': 哈希前 16 位, 'Path'}, ...]，按高度排列
+        '''
+        snapshot_dir = snapshot_dir or Snapshot.snapshot_dir
+        if not os.path.isdir(snapshot_dir):
+            return []
+        snapshots = []
+        for name in os.listdir(snapshot_dir):
+            match = Snapshot.NAME_PATTERN.match(name)
+            if match is None or (chain_id is not None and match.group(1) != chain_id[:16]):
+                continue
+            snapshots.append({'Chain ID': match.group(1), 'Height': int(match.group(2)),
+                              'Tip Hash': match.group(3), 'Path': os.path.join(snapshot_dir, name)})
+        snapshots.sort(key=lambda item: item['Height'])
+        return snapshots
+
+    @staticmethod
+    def latest(snapshot_dir: str = None, chain_id: str = None):
+        '''
+        最新的快照，没有快照时返回 None
+        '''
+        snapshots = Snapshot.list_snapshots(snapshot_dir, chain_id)
+        return Snapshot.load(snapshots[-1]['Path']) if snapshots else None
+
+    def verify(self, block_chain: BlockChain = None) -> bool:
+        '''
+        检验快照：区块头的哈希、链接与目标值，索引与区块头一致
+        :param block_chain: 设置时还检查该区块链在快照高度的区块与快照一致
+        '''
+        headers = self.headers()
+        if len(headers) != self.height + 1 or headers[-1].hash != self.tip_hash:
+            return False
+        header_chain = BlockChain(headers, self.chain_id)
+        header_chain.apply_settings(self.meta['Settings'])
+        if not header_chain.verify_blockchain(full=True):
+            return False
+        index = self.index()
+        if index.height != self.height or index.tip_hash != self.tip_hash:
+            return False
+        if block_chain is not None:
+            if block_chain.id != self.chain_id or len(block_chain.chain) <= self.height \
+                    or block_chain.chain[self.height].hash != self.tip_hash:
+                return False
+        return True
+
+    def bootstrap(self, block_chain_file_path: str, loaded: tuple = None) -> BlockChain:
+        '''
+        从快照启动：快照高度及之前只使用快照中的区块头与索引，只读取并在之后检验快照之后的区块
+        :param block_chain_file_path: json 文件或区块存储目录
+        :param loaded: 已读取的 json 文件 (内容, 文件签名)，为 None 时读取
+        '''
+        if os.path.isdir(block_chain_file_path):
+            store = BlockStore(block_chain_file_path)
+            try:
+                meta = store.read_meta()
+                if meta.get('ID') != self.chain_id:
+                    raise SnapshotError('快照属于另一条区块链')
+                if len(store) <= self.height or \
+                        Codec.decode_header(store.read_payload(self.height))[4] != self.tip_hash:
+                    raise SnapshotError('区块存储与快照不一致')
+                blockchain = BlockChain(self.headers() + list(store.iter_blocks(self.height + 1)), meta.get('ID'))
+                blockchain.apply_settings(meta)
+            except BaseException:
+                # 调用者可能继续尝试其他快照，不能留下打开的存储
+                store.close()
+                raise
+            blockchain.store = store
+        else:
+            data, signature = loaded if loaded is not None else _read_json(block_chain_file_path)
+            if data['ID'] != self.chain_id:
+                raise SnapshotError('快照属于另一条区块链')
+            blocks = data['Chain']
+            if len(blocks) <= self.height or blocks[self.height]['Block Hash'] != self.tip_hash:
+                raise SnapshotError('区块链文件与快照不一致')
+            chain = self.headers() + [PrunedBlock.block_from_dict(block_data)
+                                      for block_data in blocks[self.height + 1:]]
+            blockchain = BlockChain.from_dict(data, chain)
+            blockchain._file_signature = signature
+        # 索引与检验进度从快照高度继续，之后重建索引时同样从快照开始
+        blockchain.base_snapshot = self
+        blockchain._index = self.index()
+        blockchain.verified_height = self.height
+        blockchain.verified_tip = self.tip_hash
+        return blockchain
+
+    @staticmethod
+    def bootstrap_latest(block_chain_file_path: str, snapshot_dir: str = None) -> BlockChain:
+        '''
+        从快照目录中该区块链最新的可用快照启动，没有可用快照时完整加载
+        '''
+        if not Snapshot.list_snapshots(snapshot_dir):
+            return _load_chain(block_chain_file_path)
+        # 快照目录可能由多条区块链共享，只尝试属于这条区块链的快照
+        loaded = None
+        if os.path.isdir(block_chain_file_path):
+            meta_path = os.path.join(block_chain_file_path, BlockStore.META_NAME)
+            chain_id = None
+            if os.path.isfile(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    chain_id = json.load(f).get('ID')
+        else:
+            loaded = _read_json(block_chain_file_path)
+            chain_id = loaded[0]['ID']
+        if chain_id is not None:
+            for item in reversed(Snapshot.list_snapshots(snapshot_dir, chain_id)):
+                try:
+                    return Snapshot.load(item['Path']).bootstrap(block_chain_file_path, loaded)
+                except SnapshotError:
+                    # 快照损坏，或与区块链不一致
+                    continue
+                except FileNotFoundError:
+                    if os.path.exists(item['Path']):
+                        raise
+                    # 快照在列出之后被删除（只保留最新的几个快照）
+                    continue
+        return _load_chain(block_chain_file_path)
+
+    @staticmethod
+    def take(block_chain: BlockChain, snapshot_dir: str = None, interval: int = 1000, keep: int = 3):
+        '''
+        定期建立快照：最新区块比最新的快照高出 interval 个区块时建立新快照，只保留最新的 keep 个
+        :return: 新快照的路径，未建立时返回 None
+        '''
+        snapshot_dir = snapshot_dir or Snapshot.snapshot_dir
+        snapshots = Snapshot.list_snapshots(snapshot_dir, block_chain.id)
+        height = len(block_chain.chain) - 1
+        if snapshots and height - snapshots[-1]['Height'] < interval:
+            return None
+        path = Snapshot.create(block_chain, height).save(snapshot_dir)
+        for old in Snapshot.list_snapshots(snapshot_dir, block_chain.id)[:-keep]:
+            os.remove(old['Path'])
+        return path
+
+    @staticmethod
+    def prune(block_chain_file_path: str, snapshot_dir: str = None) -> int:
+        '''
+        按最新的快照裁剪 json 区块链文件：快照高度及之前的区块只保留区块头
+        :return: 新裁剪的区块数
+        '''
+        with ChainLock.for_chain_file(block_chain_file_path):
+            blockchain = BlockChain.load_from_file(block_chain_file_path, persist_migration=False)
+            snapshot = Snapshot.latest(snapshot_dir, blockchain.id)
+            if snapshot is None:
+                raise Exception('没有该区块链的快照')
+            if len(blockchain.chain) <= snapshot.height or blockchain.chain[snapshot.height].hash != snapshot.tip_hash:
+                raise Exception('区块链文件与快照不一致')
+            # 已裁剪的区块无法重建索引，使用快照中的索引
+            blockchain.base_snapshot = snapshot
+            blockchain._index = snapshot.index()
+            pruned = blockchain.prune(snapshot.height)
+            blockchain.save_to_file(block_chain_file_path)
+        return pruned
+
+
+def _read_json(path: str) -> tuple:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+        return data, BlockChain._signature(f)
+
+
+def _load_chain(path: str) -> BlockChain:
+    if os.path.isdir(path):
+        return BlockChain.load_from_store(path, lazy=True)
+    return BlockChain.load_from_file(path)
+
+
+def _bootstrap_benchmark(block_count: int = 2000, files_per_block: int = 20, tail: int = 20):
+    '''
+    对比完整重放（从创世区块检验并建立索引）与从快照启动的耗时
+    '''
+    import contextlib
+    import io
+    import shutil
+    import tempfile
+    from Block import Block
+    from BlockData import BlockData
+    from FileEntry import FileEntry
+    from KeyStore import KeyStore
+    from Owner import Owner
+
+    workdir = tempfile.mkdtemp()
+    json_path = os.path.join(workdir, 'block_chain.json')
+    store_dir = os.path.join(workdir, 'block_store')
+    snapshot_dir = os.path.join(workdir, 'snapshots')
+
+    # 有签名的区块链，完整重放需要检验所有签名
+    keystores = [KeyStore(key_type='ed25519') for _ in range(8)]
+    bc = BlockChain()
+    bc.require_signatures = True
+    for b in range(block_count + tail):
+        data = BlockData()
+        for i in range(files_per_block):
+            keystore = keystores[(b + i) % len(keystores)]
+            entry = FileEntry(Owner.intern(keystore.public_key_content), '%064x' % (b * files_per_block + i))
+            data.files.append(entry.sign(keystore.sign))
+        bc.chain.append(Block(time.time(), data, bc.chain[-1].hash))
+        if b == block_count - 1:
+            Snapshot.create(bc).save(snapshot_dir)
+    bc.save_to_file(json_path)
+    bc.attach_store(store_dir)
+    bc.store.close()
+    pruned_path = os.path.join(workdir, 'pruned.json')
+    shutil.copy(json_path, pruned_path)
+    Snapshot.prune(pruned_path, snapshot_dir)
+
+    def replay(path):
+        blockchain = _load_chain(path)
+        assert blockchain.verify_blockchain(full=True)
+        blockchain.index
+        return blockchain
+
+    def bootstrap(path):
+        blockchain = Snapshot.latest(snapshot_dir, bc.id).bootstrap(path)
+        assert blockchain.verify_blockchain()
+        blockchain.index
+        return blockchain
+
+    print('{0} 个区块，每个区块 {1} 条有签名的记录，快照之后 {2} 个区块'.format(
+        block_count + tail, files_per_block, tail))
+    for name, load, path in (('json 完整重放', replay, json_path),
+                             ('json 从快照启动', bootstrap, json_path),
+                             ('裁剪后的 json 从快照启动', bootstrap, pruned_path),
+                             ('区块存储完整重放', replay, store_dir),
+                             ('区块存储从快照启动', bootstrap, store_dir)):
+        # 清空签名缓存，每次都实际检验
+        BlockChain.signature_verifier.clear()
+        time_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            blockchain = load(path)
+        elapsed = time.perf_counter() - time_start
+        assert blockchain.get_latest_block().hash == bc.get_latest_block().hash
+        assert blockchain.index.owner_file_count(keystores[0].public_key_content) == \
+            bc.index.owner_file_count(keystores[0].public_key_content)
+        print('{0}: {1:.3f}s (文件 {2:.1f} MB)'.format(
+            name, elapsed, os.path.getsize(path) / 2**20 if os.path.isfile(path) else
+            os.path.getsize(os.path.join(path, BlockStore.LOG_NAME)) / 2**20))
+        if blockchain.store is not None:
+            blockchain.store.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    '''
+    快照工具
+        python Snapshot.py create <区块链文件或存储目录> [快照目录] [高度]
+        python Snapshot.py list [快照目录]
+        python Snapshot.py verify <快照文件> [区块链文件或存储目录]
+        python Snapshot.py prune <区块链 json 文件> [快照目录]
+        python Snapshot.py bench [区块数] [每个区块的文件数]
+    '''
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    args = sys.argv[2:]
+    if command == 'create':
+        block_chain = _load_chain(args[0])
+        snapshot = Snapshot.create(block_chain, int(args[2]) if len(args) > 2 else None)
+        print('已建立快照:', snapshot.save(args[1] if len(args) > 1 else None))
+    elif command == 'list':
+        for item in Snapshot.list_snapshots(args[0] if args else None):
+            print('{0}  高度 {1:>8}  最新区块 {2}  {3}'.format(
+                item['Chain ID'], item['Height'], item['Tip Hash'], item['Path']))
+    elif command == 'verify':
+        snapshot = Snapshot.load(args[0])
+        block_chain = _load_chain(args[1]) if len(args) > 1 else None
+        print('快照检验:', snapshot.verify(block_chain))
+    elif command == 'prune':
+        print('裁剪区块数:', Snapshot.prune(args[0], args[1] if len(args) > 1 else None))
+    elif command == 'bench':
+        _bootstrap_benchmark(*[int(arg) for arg in args])
+    else:
+        raise Exception('未知的命令 {0}'.format(command))
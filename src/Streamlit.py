@@ -1,22 +1,102 @@
+import time
 import streamlit as st
 import graphviz
+from PrunedBlock import PrunedBlock
 from User import User
 
+# 每页展示的区块数
+PAGE_SIZE = 20
 
-# TODO:打印出当前区块链
-def show_block_chain(user:User):
+
+def current_user() -> User:
+    '''
+    每个会话各自的用户与区块链。同一会话的页面依次运行，不同会话之间不共享可变的区块链，
+    多个会话写入同一个区块链文件时由 commit_block 的文件锁保证安全
+    '''
+    return st.session_state.user
+
+
+# 以下缓存在会话之间共享，只缓存由区块链得出的展示数据。最新区块的哈希决定了整条链的内容，
+# 以它为键，区块链没有新区块时直接复用；以下划线开头的参数不参与缓存键的计算
+@st.cache_data(max_entries=16)
+def chain_stats(_block_chain, tip_hash: str) -> dict:
+    '''
+    汇总统计，由索引中增量维护的数据得出
+    '''
+    return _block_chain.stats()
+
+
+@st.cache_data(max_entries=64)
+def recent_blocks(_block_chain, tip_hash: str, page: int, page_size: int = PAGE_SIZE) -> list:
+    '''
+    第 page 页的区块摘要，第 0 页为最新的区块，只访问这一页的区块
+    '''
+    end = len(_block_chain.chain) - page * page_size
+    rows = []
+    for height in range(end - 1, max(end - page_size, 0) - 1, -1):
+        block = _block_chain.chain[height]
+        rows.append({
+            'Height': height,
+            'Hash': block.hash[0:16],
+            'Previous Hash': block.previous_hash[0:16],
+            'Time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block.timestamp)),
+            # 被裁剪的区块没有文件记录
+            'Files': None if isinstance(block, PrunedBlock) else len(block.data.files),
+        })
+    return rows
+
+
+@st.cache_data(max_entries=64)
+def block_graph(tip_hash: str, rows: list) -> str:
     '''
-    打印当前用户正在使用的区块链
+    一页区块的链接关系图（DOT 文本）
     '''
-    # Create a graphlib graph object
     graph = graphviz.Digraph()
-    previous_hash = ''
-    for block in user.block_chain.chain:
-        graph.edge(previous_hash, block.hash[0:6])
-        previous_hash = block.hash[0:6]
+    for row in reversed(rows):
+        graph.edge(row['Previous Hash'][0:6], row['Hash'][0:6])
+    return graph.source
+
+
+@st.cache_data(max_entries=64)
+def block_files(_block_chain, tip_hash: str, height: int) -> list:
+    '''
+    某个区块中的文件记录，选中时才读取
+    '''
+    block = _block_chain.chain[height]
+    if isinstance(block, PrunedBlock):
+        return []
+    return [{
+        'File': entry.file,
+        'Owner': entry.owner.fingerprint_hex[0:16],
+        'Signed': entry.signature is not None,
+    } for entry in block.data.files]
+
+
+def show_block_chain(user:User):
+    '''
+    分页展示当前用户正在使用的区块链，可以查看某个区块中的文件
+    '''
+    block_chain = user.block_chain
+    user.update_working_block_chain()
+    tip_hash = block_chain.get_latest_block().hash
+
+    stats = chain_stats(block_chain, tip_hash)
+    columns = st.columns(4)
+    columns[0].metric('区块高度', stats['Height'])
+    columns[1].metric('文件记录数', stats['Entries'])
+    columns[2].metric('去重比', '{0:.2f}'.format(stats['Dedup Ratio']))
+    columns[3].metric('存储字节数', stats['Stored Bytes'])
+
+    page_count = -(-len(block_chain.chain) // PAGE_SIZE)
+    page = st.number_input('页码（0 为最新的区块）', min_value=0, max_value=page_count - 1, value=0, step=1)
+    rows = recent_blocks(block_chain, tip_hash, int(page))
     # 打印区块链
-    st.graphviz_chart(graph)
+    st.graphviz_chart(block_graph(tip_hash, rows))
+    st.dataframe(rows)
 
+    height = st.selectbox('查看区块中的文件', [row['Height'] for row in rows])
+    if height is not None:
+        st.dataframe(block_files(block_chain, tip_hash, height))
 
 
 # 用于存储用户输入的文件路径
@@ -26,12 +106,14 @@ if 'uploaded_files' not in st.session_state:
     st.session_state.file_input_visible = False  # Initially hide the input field
     st.session_state.blockchain_buttons_visible = True  # Initially show blockchain buttons
     st.session_state.user_created = False  # Track if user is created
-    st.session_state.user = None  # Store user instance
+    st.session_state.user = None  # 本会话的用户实例
+    st.session_state.chain_visible = False  # 是否展示区块链
 
 # 创建用户
 if not st.session_state.user_created:
     if st.button('创建用户'):
-        st.session_state.user = User()  # 创建用户实例并存储在 session_state
+        # 沿用已保存的密钥，密钥文件不存在时才生成
+        st.session_state.user = User.from_key_file()  # 创建用户实例并存储在 session_state
         st.session_state.user_created = True  # 用户创建状态
         st.success('用户创建成功！')  # 显示成功信息
         st.session_state.blockchain_buttons_visible = True  # 允许显示区块链按钮
@@ -45,14 +127,14 @@ if st.session_state.user_created:
     # 创建新的区块链
     if st.session_state.blockchain_buttons_visible:
         if st.button('创建新的区块链'):
-            st.session_state.user.create_working_block_chain()  # 使用 session_state 中的 user
+            current_user().create_working_block_chain()
             st.session_state.blockchain_buttons_visible = False  # 隐藏区块链按钮
             st.success('新的区块链已创建！')  # 显示成功信息
             
         # 从文件加载区块链
         block_chain_path = st.text_input('输入区块链路径')
         if st.button('从文件加载区块链'):
-            st.session_state.user.set_working_block_chain(block_chain_path)  # 使用 session_state 中的 user
+            current_user().set_working_block_chain(block_chain_path)
             st.session_state.blockchain_buttons_visible = False  # 隐藏区块链按钮
             st.success('区块链已从文件加载！')  # 显示成功信息
 
@@ -83,13 +165,16 @@ if st.session_state.file_input_visible:
             for file in st.session_state.uploaded_files:
                 st.write(file)
             # 这里可以添加您希望执行的上传动作
-            st.session_state.user.upload_files(st.session_state.uploaded_files)
+            current_user().upload_files(st.session_state.uploaded_files)
             st.session_state.uploaded_files = []  # 可选: 重置文件列表
             st.session_state.file_input_visible = False  # 隐藏输入框
         else:
             st.error('请至少添加一个文件路径')
 
-if 'user' in st.session_state:
-    if hasattr(st.session_state.user, 'block_chain'):
+if st.session_state.user_created:
+    if hasattr(current_user(), 'block_chain'):
         if st.button('展示区块链'):
-            show_block_chain(st.session_state.user)
\ No newline at end of file
+            st.session_state.chain_visible = True
+        # 翻页与选择区块时页面会重新运行，展示状态保存在 session_state 中
+        if st.session_state.chain_visible:
+            show_block_chain(current_user())
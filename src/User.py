@@ -1,38 +1,55 @@
 from BlockChain import BlockChain
 from Block import Block
+from ChunkStore import ChunkStore
 import os
 import random
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import time
+from KeyStore import KeyStore
+from Metrics import metrics
+from Snapshot import Snapshot
 
 
 class User:
-    def __init__(self):
-        # 生成 RSA 私钥
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,  # 可以选择 2048 或 4096 位的密钥长度
-        )
-
-        # 从私钥生成公钥
-        public_key = private_key.public_key()
-
-        # 将私钥序列化为 PEM 格式（以便存储或导出）
-        self.private_pem = private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption()  # 可以选择加密密钥
-        )
-
-        # 将公钥序列化为 PEM 格式
-        self.public_pem = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
+    # 默认的密钥文件，保存后再次启动时沿用同一身份
+    key_path = '../workspace/keys/user.pem'
+
+    def __init__(self, keystore: KeyStore = None):
+        '''
+        :param keystore: 用户的密钥存储，为 None 时使用只在内存中的 RSA 密钥。
+            密钥在第一次使用时才加载或生成
+        '''
+        self.keystore = keystore if keystore is not None else KeyStore()
+
+        # 已上传文件的密码：密文哈希 -> 明文哈希，下载时需要
+        self.file_keys = {}
+
+    @staticmethod
+    def from_key_file(key_path: str = None, passphrase: str = None, key_type: str = 'rsa') -> 'User':
+        '''
+        使用密钥文件的用户，文件不存在时在第一次使用时生成并保存
+        :param passphrase: 密钥文件的加密口令
+        :param key_type: 新生成密钥的类型，'rsa' 或 'ed25519'
+        '''
+        return User(KeyStore(key_path or User.key_path, passphrase, key_type))
+
+    @property
+    def private_pem(self) -> bytes:
+        return self.keystore.private_pem
+
+    @property
+    def public_pem(self) -> bytes:
+        return self.keystore.public_pem
+
+    @property
+    def public_key_content(self) -> str:
+        '''
+        链上标记身份使用的公钥：PEM 去掉首尾两行后的 base64 部分
+        '''
+        return self.keystore.public_key_content
+
+    @property
+    def fingerprint(self) -> str:
+        return self.keystore.fingerprint
 
     def create_working_block_chain(self, block_chain_file_path = '../workspace/block_chain/block_chain.json'):
         '''
@@ -40,27 +57,85 @@ class User:
         '''
         self.block_chain_file_path = block_chain_file_path
         self.block_chain = BlockChain()
+        # 新的区块链只接受有签名的文件记录
+        self.block_chain.require_signatures = True
         # 自动保存区块链
         self.save_working_block_chain(self.block_chain_file_path)
     
-    def set_working_block_chain(self, block_chain_file_path:str):
+    def set_working_block_chain(self, block_chain_file_path:str, snapshot_dir:str = None):
         '''
         设置用户使用的区块链
+        :param snapshot_dir: 设置时从其中最新的快照启动，只检验快照之后的区块。裁剪过的区块链必须从快照启动
         '''
         self.block_chain_file_path = block_chain_file_path
-        self.block_chain = BlockChain.load_from_file(block_chain_file_path)
+        if snapshot_dir is not None:
+            self.block_chain = Snapshot.bootstrap_latest(block_chain_file_path, snapshot_dir)
+        else:
+            self.block_chain = BlockChain.load_from_file(block_chain_file_path)
+
+    def create_working_block_store(self, block_store_dir:str = '../workspace/block_store'):
+        '''
+        重新创建一个用户使用的区块链，使用只追加的区块存储保存
+        '''
+        self.block_chain_file_path = block_store_dir
+        self.block_chain = BlockChain()
+        self.block_chain.require_signatures = True
+        self.block_chain.attach_store(block_store_dir)
+
+    def set_working_block_store(self, block_store_dir:str):
+        '''
+        设置用户使用的区块链，从区块存储加载
+        '''
+        self.block_chain_file_path = block_store_dir
+        self.block_chain = BlockChain.load_from_store(block_store_dir, lazy=True)
 
     def update_working_block_chain(self):
         '''
         更新用户使用的区块链。避免自己持有的区块链非最新版
         '''
-        self.block_chain = BlockChain.load_from_file(self.block_chain_file_path)
+        if self.block_chain.store is not None:
+            # 只读取新增的区块
+            self.block_chain.sync_from_store()
+        else:
+            # 文件未被修改时不重新读取
+            self.block_chain.refresh_from_file(self.block_chain_file_path)
 
     def save_working_block_chain(self, block_chain_file_path:str = '../workspace/block_chain/block_chain.json'):
         '''
-        保存（发布）最新的区块链
+        保存（发布）最新的区块链。使用区块存储时只追加新区块
+        '''
+        if self.block_chain.store is not None:
+            self.block_chain.commit_to_store()
+        else:
+            self.block_chain.save_to_file(block_chain_file_path)
+        self._take_snapshot()
+
+    def use_chunk_store(self, root_dir:str = '../workspace/upload_data/'):
+        '''
+        之后上传的文件按内容分块去重存储
+        '''
+        if not hasattr(self, 'block_chain'):
+            raise Exception('设置存储之前未指定区块链')
+        self.block_chain.chunk_store = ChunkStore(root_dir, kdf=self.block_chain.kdf)
+
+    def use_snapshots(self, snapshot_dir:str = None, interval:int = 1000, keep:int = 3):
+        '''
+        之后每次提交或保存区块链后，最新区块比最新的快照高出 interval 个区块时建立新快照，只保留最新的 keep 个
+        '''
+        self.snapshot_dir = snapshot_dir or Snapshot.snapshot_dir
+        self.snapshot_interval = interval
+        self.snapshot_keep = keep
+
+    def _take_snapshot(self):
+        if getattr(self, 'snapshot_dir', None) is not None:
+            Snapshot.take(self.block_chain, self.snapshot_dir, self.snapshot_interval, self.snapshot_keep)
+
+    def use_mempool(self, mempool):
         '''
-        self.block_chain.save_to_file(block_chain_file_path)
+        之后的上传提交到（可由多个用户共享的）记录池，由记录池的出块线程批量出块。
+        传入 None 时恢复每次上传出一个块
+        '''
+        self.mempool = mempool
 
     def get_latest_block(self)-> Block:
         '''
@@ -75,58 +150,113 @@ class User:
         '''
         上传（多个）文件
         '''
-        if hasattr(self, 'block_chain') and hasattr(self, 'public_pem'):
+        if hasattr(self, 'block_chain') and self.keystore is not None:
             # 首先更新区块链
             self.update_working_block_chain()
-            public_key_str = self.public_pem.decode('utf-8')
-
-            # 按行分割字符串
-            lines = public_key_str.strip().split('\n')
-            # 取出中间部分（从第二行到倒数第二行），也就是实际的公钥部分
-            public_key_content = ''.join(lines[1:-1])
-            self.block_chain.upload_files(file_paths, public_key_content)
+            public_key_content = self.public_key_content
+            if getattr(self, 'mempool', None) is not None:
+                # 记录在出块后由记录池的回调保存
+                self.mempool.submit_files(file_paths, public_key_content, self.file_keys, self.keystore.sign)
+                return
+            # 加密在锁外进行，提交时只在最新区块未改变的情况下追加，否则自动重新挖矿
+            # 每条记录都由当前用户的私钥签名
+            blockdata = self.block_chain.prepare_upload(file_paths, public_key_content, self.file_keys,
+                                                        self.keystore.sign)
+            self.block_chain.commit_block(blockdata, self.block_chain_file_path)
+            self._take_snapshot()
+        else :
+            raise Exception('当前用户没有秘钥，或区块链未初始化')
 
-            # 自动保存区块链
-            self.save_working_block_chain(self.block_chain_file_path)
+    def upload_files_batch(self, file_paths:dict[str], workers:int = None, profile_path:str = None) -> dict:
+        '''
+        使用进程池批量上传（多个）文件，所有文件记录在同一个区块中
+        :param profile_path: 设置时对本次上传（包括保存区块链）采样分析，折叠调用栈保存到该文件
+        :return: 各阶段耗时（秒），commit 为挖矿与在锁中追加、保存区块链的时间
+        '''
+        if profile_path is not None:
+            with metrics.profile(profile_path):
+                return self.upload_files_batch(file_paths, workers)
+        if hasattr(self, 'block_chain') and self.keystore is not None:
+            # 首先更新区块链
+            self.update_working_block_chain()
+            time_start = time.perf_counter()
+            blockdata, timing = self.block_chain.prepare_upload_batch(file_paths, self.public_key_content, workers,
+                                                                      self.file_keys, self.keystore.sign)
+            # 与 upload_files 相同，挖矿在锁外进行，最新区块改变时自动重新挖矿
+            time_commit = time.perf_counter()
+            self.block_chain.commit_block(blockdata, self.block_chain_file_path)
+            self._take_snapshot()
+            time_end = time.perf_counter()
+            timing['commit'] = time_end - time_commit
+            timing['total'] = time_end - time_start
+            return timing
         else :
             raise Exception('当前用户没有秘钥，或区块链未初始化')
 
-    def download_file(self, file_enc_hash:str):
+    # 下载的文件默认存放的目录
+    download_dir = '../workspace/download_data/'
+
+    def download_file(self, file_enc_hash:str, output = None, password:str = None, chunk_size:int = None):
         '''
         根据密文的哈希值，下载文件
+        :param output: 结果文件路径或可写的二进制流，默认保存到 download_dir 下以密文哈希命名的文件
+        :param password: 文件密码（明文哈希），默认使用上传时记录的密码
+        :param chunk_size: 每次解密的字节数，决定内存占用
+        :return: 结果文件路径或传入的流
+        '''
+        if not hasattr(self, 'block_chain'):
+            raise Exception('获取区块之前未指定区块链')
+        password = password or self.file_keys.get(file_enc_hash)
+        if password is None:
+            raise Exception('没有文件 {0} 的密码'.format(file_enc_hash))
+        # 首先更新区块链，本地链已是最新时不会重新读取
+        self.update_working_block_chain()
+        # 判断当前用户对文件的所有权。实际上应当由其他节点判断
+        if not self.block_chain.index.is_owner(file_enc_hash, self.public_key_content):
+            raise Exception('当前用户不拥有文件 {0}'.format(file_enc_hash))
+        proof = self.block_chain.get_inclusion_proof(file_enc_hash, self.public_key_content)
+        # 记录所在区块被裁剪时没有证明，所有权由快照中已检验的索引保证
+        if proof is not None and not self.block_chain.verify_inclusion_proof(proof):
+            raise Exception('当前用户不拥有文件 {0}'.format(file_enc_hash))
+        # 通过所有权验证，从存储区取回并解密
+        if output is None:
+            os.makedirs(self.download_dir, exist_ok=True)
+            output = os.path.join(self.download_dir, file_enc_hash)
+        self.block_chain.retrieve_file(file_enc_hash, self.public_key_content, password, output, chunk_size)
+        return output
+
+    def list_files(self, owner:str = None, since:float = None, until:float = None,
+                   page:int = 0, page_size:int = 50) -> list:
+        '''
+        分页查询某个所有者在链上的文件，只访问该所有者的记录
+        :param owner: 所有者公钥，默认为当前用户
+        :param since: 只返回该时间之后上传的文件
+        :param until: 只返回该时间之前上传的文件
+        :param page: 页码，从 0 开始
+        :param page_size: 每页条数
+        :return: [{'File', 'Height', 'Time Stamp'}, ...]
         '''
         if not hasattr(self, 'block_chain'):
             raise Exception('获取区块之前未指定区块链')
-        # 首先更新区块链
+        # 本地链已是最新时不会重新读取
         self.update_working_block_chain()
-        # 遍历区块链
-        for block in self.block_chain.chain:
-            for file in block.data.files:
-                if file['File'] == file_enc_hash:
-                    # 判断当前用户对文件的所有权。实际上应当由其他节点判断
-                    public_key_str = self.public_pem.decode('utf-8')
-                    lines = public_key_str.strip().split('\n')
-                    public_key_content = ''.join(lines[1:-1])
-                    if file['User'] == public_key_content:
-                        # 通过所有权验证
-                        os.system("echo TODO:将文件从存储区下载下来")
-                        return
-                    else:
-                        pass
-
-    def show_files_on_chain(self):
-        '''
-        显示在区块链上所有的文件及所有者
-        '''
-        for block in self.block_chain.chain:
-            for file in block.data.files:
-                print('File:' + '\n' + '\t' + file['File'])
-                print('Owner:' + '\n' + '\t' + file['User'])
- 
+        owner = owner or self.public_key_content
+        return self.block_chain.index.owner_files(owner, since, until, page * page_size, page_size)
+
+    def show_files_on_chain(self, owner:str = None, since:float = None, until:float = None,
+                            page:int = 0, page_size:int = 50):
+        '''
+        分页显示某个所有者（默认为当前用户）在区块链上的文件
+        '''
+        for item in self.list_files(owner, since, until, page, page_size):
+            print('File:' + '\n' + '\t' + item['File'])
+            print('Block:' + '\n' + '\t' + '{0} ({1})'.format(
+                item['Height'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item['Time Stamp']))))
 
 
 if __name__ == '__main__':
-    user = User()
+    # 再次运行时沿用已保存的密钥
+    user = User.from_key_file()
 
     user.create_working_block_chain()
     # 查看当前创建的区块链
@@ -134,10 +264,15 @@ if __name__ == '__main__':
     # 上传自己的文件
     user.upload_files(['../workspace/data/file_example',])
     # 下载自己的文件
+    for file_enc_hash in user.file_keys:
+        print('下载到:', user.download_file(file_enc_hash))
 
     
     # 上传多个自己的文件测试
     for i in range(0,80):
         n = random.randint(1,10)
         file_list = ['../workspace/data/file_example',] * n
-        user.upload_files(file_list)
\ No newline at end of file
+        user.upload_files(file_list)
+    # 批量上传测试，查看各阶段耗时
+    timing = user.upload_files_batch(['../workspace/data/file_example',] * 10)
+    print(timing)